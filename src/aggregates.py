@@ -0,0 +1,412 @@
+'''
+Mergeable aggregate state of the MPD slices, updated as new slices arrive
+instead of recounting the whole dataset.
+
+The state holds the inclusion counts of the tracks, the number of playlists
+that include each artist and album, the distinct tracks and the inclusions
+of each artist (for the one-hit wonders) and one row of statistics per
+playlist. Every count is a sum over playlists, and every playlist is in
+exactly one slice, so a new slice is folded in by adding its counts, in time
+proportional to the slice. The keys are URIs, which unlike the track ids of
+the pre-processed data do not depend on which slices were processed.
+
+The state is saved in a directory: the URI tables and the playlist
+statistics are only appended to, the counts are rewritten to a new file,
+and state.json, written last, records the folded slices and how many rows
+and bytes of every table belong to the state. The next save truncates the
+tables to those bytes before appending, so the rows of an interrupted save
+are dropped.
+
+Run `python aggregates.py [directory of dataset] [aggregates dir]` to fold
+the slices that are not in the state yet, or pass --aggregates to
+pre_processing.py.
+'''
+from argparse import ArgumentParser
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from pre_processing import load_slice, validate_slice, VALIDATION_MODES
+from profiling import stage
+
+AGGREGATES_PATH = "../data/aggregates"
+STATE_FILENAME = "state.json"
+TABLE_FILENAMES = {"tracks": "tracks.csv", "artists": "artists.csv", "albums": "albums.csv",
+                   "playlists": "playlist_stats.csv"}
+ONE_HIT_MIN_POPULARITY = 1000
+# the integer columns of the tracks table and the arrays that hold them
+TRACK_CODE_COLUMNS = {"artist_code": "_track_artist", "album_code": "_track_album",
+                      "duration_s": "_track_duration"}
+
+
+def _grow(array, size):
+    """Get array with room for size entries, doubling its capacity."""
+    if size <= len(array):
+        return array
+    grown = np.zeros(max(size, 2 * len(array), 1024), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class _Table:
+    '''An append-only table of URIs with integer codes and count columns.'''
+
+    def __init__(self, columns, counts):
+        self.columns = columns
+        self.rows = {column: [] for column in columns}
+        self.codes = {}
+        self.counts = {name: np.zeros(0, dtype=np.int64) for name in counts}
+        self.saved = 0
+
+    def __len__(self):
+        return len(self.codes)
+
+    def code(self, uri, *values):
+        """Get the code of a URI, adding a row with values if it is new."""
+        code = self.codes.get(uri)
+        if code is None:
+            code = self.codes[uri] = len(self.codes)
+            for column, value in zip(self.columns, (uri, *values)):
+                self.rows[column].append(value)
+            for name, counts in self.counts.items():
+                self.counts[name] = _grow(counts, code + 1)
+        return code
+
+    def add(self, name, codes):
+        """Count codes in a count column, in time proportional to codes."""
+        codes, counts = np.unique(codes, return_counts=True)
+        self.counts[name][codes] += counts
+
+    def count(self, name):
+        """Get a count column."""
+        return self.counts[name][:len(self)]
+
+    def frame(self):
+        """Get the rows as a DataFrame."""
+        return pd.DataFrame(self.rows, columns=self.columns)
+
+    def load(self, df):
+        """Restore the rows saved by frame."""
+        for column in self.columns:
+            self.rows[column] = df[column].tolist()
+        self.codes = {uri: code for code, uri in enumerate(self.rows[self.columns[0]])}
+        self.saved = len(df)
+
+
+class AggregateState:
+    '''The counts and playlist statistics of the folded slices.'''
+
+    def __init__(self):
+        self.tracks = _Table(("track_uri", "track_name", "artist_code", "album_code", "duration_s"),
+                             ("count",))
+        self.artists = _Table(("artist_uri", "artist_name"), ("playlists", "tracks", "relations"))
+        self.albums = _Table(("album_uri", "album_name"), ("playlists",))
+        # the artist, album and duration of every track code, as arrays
+        self._track_artist = np.zeros(0, dtype=np.int64)
+        self._track_album = np.zeros(0, dtype=np.int64)
+        self._track_duration = np.zeros(0, dtype=np.int64)
+        self.playlist_chunks = []
+        self.n_playlists = 0
+        self.saved_playlists = 0
+        # the bytes of every table file that belong to the saved state
+        self.saved_sizes = {}
+        self.slices = []
+
+    def _track_code(self, track):
+        """Get the code of a track, adding it and its artist and album if new."""
+        code = self.tracks.codes.get(track["track_uri"])
+        if code is not None:
+            return code
+        artist = self.artists.code(track["artist_uri"], track["artist_name"])
+        album = self.albums.code(track["album_uri"], track["album_name"])
+        duration_s = track["duration_ms"] // 1000
+        code = self.tracks.code(track["track_uri"], track["track_name"], artist, album, duration_s)
+        self._track_artist = _grow(self._track_artist, code + 1)
+        self._track_album = _grow(self._track_album, code + 1)
+        self._track_duration = _grow(self._track_duration, code + 1)
+        self._track_artist[code], self._track_album[code] = artist, album
+        self._track_duration[code] = duration_s
+        # a new distinct track of its artist
+        self.artists.counts["tracks"][artist] += 1
+        return code
+
+    def fold_slice(self, name, slice, pids=None):
+        """Add the counts of a slice to the state.
+
+        Args:
+            name (str): The slice filename, a slice is only folded once.
+            slice (dict): The slice, as loaded by pre_processing.load_slice.
+            pids (list): Only fold the playlists with these pids, e.g. the
+                valid ones, all if None.
+
+        Returns:
+            bool: Whether the slice was folded, False if it already was.
+        """
+        if name in self.slices:
+            return False
+        playlists = slice["playlists"]
+        if pids is not None:
+            pids = set(pids)
+            playlists = [p for p in playlists if p["pid"] in pids]
+        n_playlists = len(playlists)
+        lengths = np.fromiter((len(p["tracks"]) for p in playlists), dtype=np.int64, count=n_playlists)
+        codes = np.fromiter((self._track_code(track) for p in playlists for track in p["tracks"]),
+                            dtype=np.int64, count=lengths.sum())
+        owners = np.repeat(np.arange(n_playlists), lengths)
+
+        self.tracks.add("count", codes)
+        artists = self._track_artist[codes]
+        self.artists.add("relations", artists)
+        # each playlist counts once per artist and album
+        artist_pairs = np.unique(owners * len(self.artists) + artists)
+        self.artists.add("playlists", artist_pairs % len(self.artists))
+        album_pairs = np.unique(owners * len(self.albums) + self._track_album[codes])
+        self.albums.add("playlists", album_pairs % len(self.albums))
+        distinct_artists = np.bincount(artist_pairs // len(self.artists), minlength=n_playlists)
+
+        # population standard deviation of the durations, in two passes
+        durations = self._track_duration[codes].astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.bincount(owners, durations, minlength=n_playlists) / lengths
+            variances = np.bincount(owners, (durations - means[owners]) ** 2, minlength=n_playlists) / lengths
+            diversity = distinct_artists / lengths
+        self.playlist_chunks.append(pd.DataFrame({
+            "pid": np.fromiter((p["pid"] for p in playlists), dtype=np.int64, count=n_playlists),
+            "num_tracks": lengths,
+            "duration_s_stdev": np.sqrt(variances),
+            "artist_diversity": diversity,
+        }))
+        self.n_playlists += n_playlists
+        self.slices.append(name)
+        return True
+
+    def _top(self, counts, n, mask=None):
+        """Get the codes of the n largest counts, ties by code."""
+        codes = np.arange(len(counts)) if mask is None else np.flatnonzero(mask)
+        counts = counts[codes]
+        if len(codes) > n:
+            # keep every code tied with the n-th count before the exact sort
+            threshold = np.partition(counts, len(counts) - n)[len(counts) - n]
+            keep = counts >= threshold
+            codes, counts = codes[keep], counts[keep]
+        return codes[np.lexsort((codes, -counts))][:n]
+
+    def most_common_tracks(self, n=10):
+        """Get the most included tracks, like analysis.get_most_common_tracks.
+
+        Args:
+            n (int): The number of tracks.
+
+        Returns:
+            A DataFrame of the track_name, track_uri and count of the tracks.
+        """
+        counts = self.tracks.count("count")
+        top = self._top(counts, n)
+        rows = self.tracks.rows
+        return pd.DataFrame({"track_name": [rows["track_name"][code] for code in top],
+                             "track_uri": [rows["track_uri"][code] for code in top],
+                             "count": counts[top]})
+
+    def _most_common(self, table, kind, n):
+        counts = table.count("playlists")
+        top = self._top(counts, n)
+        df = pd.DataFrame({f"{kind}_name": [table.rows[f"{kind}_name"][code] for code in top],
+                           f"{kind}_uri": [table.rows[f"{kind}_uri"][code] for code in top],
+                           "count": counts[top]})
+        return df.set_index(f"{kind}_name")
+
+    def most_common_artists(self, n=10):
+        """Get the artists included in the most playlists, like
+        analysis.get_most_common_artists.
+
+        Args:
+            n (int): The number of artists.
+
+        Returns:
+            A DataFrame of the artist_uri and count indexed by artist_name.
+        """
+        return self._most_common(self.artists, "artist", n)
+
+    def most_common_albums(self, n=10):
+        """Get the albums included in the most playlists, like
+        analysis.get_most_common_albums.
+
+        Args:
+            n (int): The number of albums.
+
+        Returns:
+            A DataFrame of the album_uri and count indexed by album_name.
+        """
+        return self._most_common(self.albums, "album", n)
+
+    def one_hit_wonders(self, n=10, min_popularity=ONE_HIT_MIN_POPULARITY):
+        """Get the most included artists with a single track, like
+        analysis.get_most_popular_one_hit_wonder.
+
+        Args:
+            n (int): The number of artists.
+            min_popularity (int): The fewest inclusions of a candidate.
+
+        Returns:
+            A DataFrame of the artist_name, track_count and popularity of the
+            artists.
+        """
+        track_counts = self.artists.count("tracks")
+        popularity = self.artists.count("relations")
+        top = self._top(popularity, n, (track_counts <= 1) & (popularity >= min_popularity))
+        return pd.DataFrame({"artist_name": [self.artists.rows["artist_name"][code] for code in top],
+                             "track_count": track_counts[top], "popularity": popularity[top]})
+
+    def playlist_stats(self):
+        """Get the statistics of the folded playlists.
+
+        Returns:
+            A DataFrame of the pid, num_tracks, duration_s_stdev and
+            artist_diversity of every playlist.
+        """
+        return pd.concat(self.playlist_chunks, ignore_index=True)
+
+    def _append_rows(self, path, key, df, saved):
+        """Append the rows of a table past the saved ones to its file.
+
+        The file is first truncated to the saved state, dropping the rows of
+        a save that did not finish. Without a recorded size the whole table
+        is rewritten.
+        """
+        filename = os.path.join(path, TABLE_FILENAMES[key])
+        size = self.saved_sizes.get(key)
+        if saved and size is not None and os.path.isfile(filename):
+            os.truncate(filename, size)
+            df.iloc[saved:].to_csv(filename, mode="a", header=False, index=False)
+        else:
+            df.to_csv(filename, index=False)
+        self.saved_sizes[key] = os.path.getsize(filename)
+
+    def save(self, path):
+        """Save the state, appending the new rows of the tables.
+
+        Args:
+            path (str): The directory of the state.
+        """
+        os.makedirs(path, exist_ok=True)
+        with stage("write"):
+            tables = {"tracks": self.tracks, "artists": self.artists, "albums": self.albums}
+            for key, table in tables.items():
+                self._append_rows(path, key, table.frame(), table.saved)
+                table.saved = len(table)
+            if self.playlist_chunks:
+                self._append_rows(path, "playlists", self.playlist_stats(), self.saved_playlists)
+                self.saved_playlists = self.n_playlists
+
+            # a new counts file per version, so state.json always names a
+            # complete one
+            counts_filename = f"counts-{len(self.slices)}.npz"
+            np.savez(os.path.join(path, counts_filename), track_count=self.tracks.count("count"),
+                     **{f"artist_{name}": self.artists.count(name) for name in self.artists.counts},
+                     album_playlists=self.albums.count("playlists"))
+            state = {"slices": self.slices, "counts": counts_filename, "tracks": len(self.tracks),
+                     "artists": len(self.artists), "albums": len(self.albums),
+                     "playlists": self.n_playlists, "sizes": self.saved_sizes}
+            state_filename = os.path.join(path, STATE_FILENAME)
+            previous = None
+            if os.path.isfile(state_filename):
+                with open(state_filename) as f:
+                    previous = json.load(f)["counts"]
+            with open(state_filename + ".tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(state_filename + ".tmp", state_filename)
+            if previous is not None and previous != counts_filename:
+                os.remove(os.path.join(path, previous))
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved state, or get an empty one if there is none.
+
+        Args:
+            path (str): The directory of the state.
+
+        Returns:
+            AggregateState: The state.
+        """
+        state = cls()
+        state_filename = os.path.join(path, STATE_FILENAME)
+        if not os.path.isfile(state_filename):
+            return state
+        with open(state_filename) as f:
+            saved = json.load(f)
+
+        with stage("load"):
+            for key, table in (("tracks", state.tracks), ("artists", state.artists), ("albums", state.albums)):
+                # rows past the saved count were appended by a save that did
+                # not finish
+                if saved[key]:
+                    table.load(pd.read_csv(os.path.join(path, TABLE_FILENAMES[key]), dtype=str,
+                                           keep_default_na=False, nrows=saved[key]))
+            with np.load(os.path.join(path, saved["counts"])) as counts:
+                state.tracks.counts["count"] = counts["track_count"].copy()
+                for name in state.artists.counts:
+                    state.artists.counts[name] = counts[f"artist_{name}"].copy()
+                state.albums.counts["playlists"] = counts["album_playlists"].copy()
+            for column, attribute in TRACK_CODE_COLUMNS.items():
+                values = np.array(state.tracks.rows[column], dtype=np.int64)
+                setattr(state, attribute, values)
+                state.tracks.rows[column] = values.tolist()
+            if saved["playlists"]:
+                state.playlist_chunks = [pd.read_csv(os.path.join(path, TABLE_FILENAMES["playlists"]),
+                                                     nrows=saved["playlists"])]
+        state.n_playlists = state.saved_playlists = saved["playlists"]
+        state.saved_sizes = saved.get("sizes", {})
+        state.slices = saved["slices"]
+        return state
+
+
+def fold_new_slices(path, aggregates_path, validation="full", sample_frac=0.1):
+    """Fold the slices of a dataset directory that are not in the saved
+    state yet, and save it.
+
+    Args:
+        path (str): The directory of the MPD dataset.
+        aggregates_path (str): The directory of the state.
+        validation (str): One of VALIDATION_MODES, invalid playlists are not
+            folded.
+        sample_frac (float): Fraction of playlists validated in "sampled" mode.
+
+    Returns:
+        AggregateState: The updated state.
+    """
+    state = AggregateState.load(aggregates_path)
+    filenames = sorted(filename for filename in os.listdir(path)
+                       if filename.startswith("mpd.slice.") and filename.endswith(".json")
+                       and filename not in state.slices)
+    for filename in tqdm(filenames):
+        with stage("load"):
+            mpd_slice = load_slice(os.path.join(path, filename))
+        valid, invalid = validate_slice(mpd_slice, validation, sample_frac)
+        if not valid:
+            print(f"Skipping invalid slice {filename}")
+            continue
+        pids = [p["pid"] for i, p in enumerate(mpd_slice["playlists"]) if i not in invalid]
+        with stage("aggregate"):
+            state.fold_slice(filename, mpd_slice, pids)
+    if filenames:
+        state.save(aggregates_path)
+    return state
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Fold new MPD slices into the aggregate state.")
+    parser.add_argument("path", help="Directory of the MPD dataset.")
+    parser.add_argument("aggregates", nargs="?", default=AGGREGATES_PATH, help="Directory of the aggregate state.")
+    parser.add_argument("-N", type=int, default=10, help="The number of top tracks, artists and albums to print.")
+    parser.add_argument("--validation", choices=VALIDATION_MODES, default="full", help="Validate every playlist, a sample, or none.")
+    args = parser.parse_args()
+
+    state = fold_new_slices(args.path, args.aggregates, args.validation)
+    print(f"{len(state.slices)} slices, {state.n_playlists} playlists, {len(state.tracks)} tracks")
+    print(state.most_common_tracks(args.N).to_string(index=False))
+    print(state.most_common_artists(args.N).to_string())
+    print(state.most_common_albums(args.N).to_string())
+    print(state.one_hit_wonders(args.N).to_string(index=False))
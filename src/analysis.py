@@ -1,12 +1,17 @@
 from argparse import ArgumentParser
 import sys
 import pandas as pd
-from tqdm import tqdm
 import numpy as np
 
-from pre_processing import read_pre_processed_data
-from plots import save_bar_plot, save_audio_features_hist
+from pre_processing import read_pre_processed_data, relation_multiplicity, MULTIPLICITY_COLUMN
+from partitions import is_partitioned, get_period_aggregates
+from playlist_filters import pid_bitmap, select_playlists
+from plots import bar_plot_spec, accumulated_hist_plot_spec, render_plots
+from histograms import HistogramAccumulator
+from audio_comparison import (load_audio_feature_store, track_popularity,
+                              compare_top_vs_sample, SAMPLING_METHODS)
 from utils import get_spotipy_client
+from profiling import stage, add_profile_arguments, profile_from_args
 
 
 def get_top_tracks_audio_features_cmp(
@@ -27,13 +32,39 @@ def get_top_tracks_audio_features_cmp(
         sampled tracks combined together with appropriate labels.
     """
     # Join dataframes and label distributions for plotting
-    topN_audio_df["label"] = f"top_{N}"
-    sampleN_audio_df["label"] = f"sample_{N}"
-    hist_df = pd.concat([topN_audio_df, sampleN_audio_df], ignore_index=True)
+    hist_df = pd.concat([topN_audio_df.assign(label=f"top_{N}"),
+                         sampleN_audio_df.assign(label=f"sample_{N}")],
+                        ignore_index=True)
     return hist_df
 
 
-def get_top_tracks_cmp(tracks_df, playlists_tracks_df):
+def get_top_tracks_audio_features_hists(topN_audio_df, sampleN_audio_df, N=1000, bins=50):
+    """Get the histograms of the audio features for the top tracks and a random
+    sampling of tracks to compare distributions of audio characteristics.
+
+    Either argument may also be an iterable of DataFrame chunks, so that the
+    distributions of the full catalogue can be computed in one pass.
+
+    Args:
+        topN_audio_df (DataFrame): A DataFrame of the top tracks data.
+        sampleN_audio_df (DataFrame): A DataFrame of randomly sampled tracks.
+        N (int): The number of samples the distributions are compared for.
+        bins (int): The number of bins of every feature.
+
+    Returns:
+        A dict mapping the labels of the top and sampled tracks to their
+        HistogramAccumulator.
+    """
+    hists = {}
+    for label, audio_df in ((f"top_{N}", topN_audio_df), (f"sample_{N}", sampleN_audio_df)):
+        chunks = [audio_df] if isinstance(audio_df, pd.DataFrame) else audio_df
+        hists[label] = HistogramAccumulator(bins=bins)
+        for chunk in chunks:
+            hists[label].update(chunk)
+    return hists
+
+
+def get_top_tracks_cmp(tracks_df, playlists_tracks_df, bitmap=None):
     """Get the top tracks dataframes compared to a random sampling of tracks to
     compare distributions of audio characteristics.
 
@@ -41,19 +72,21 @@ def get_top_tracks_cmp(tracks_df, playlists_tracks_df):
         tracks_df (DataFrame): A DataFrame of the unique tracks data.
         playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
             associations.
+        bitmap (array): A pid bitmap from playlist_filters.pid_bitmap, only
+            the selected playlists are used if given.
     
     Returns:
         The DataFrames of the the top tracks and randomly sampled tracks as a
         triplet pair.
     """
     # Get top 10000 and random sample of 10000 tracks
-    top1000_tracks_df = get_most_common_tracks(tracks_df, playlists_tracks_df, n=1000)
+    top1000_tracks_df = get_most_common_tracks(tracks_df, playlists_tracks_df, n=1000, bitmap=bitmap)
     top1000_tracks_df = top1000_tracks_df.join(tracks_df, lsuffix="_left")
     sample1000_tracks_df = tracks_df.sample(1000)
     return top1000_tracks_df, sample1000_tracks_df
 
 
-def get_top_artists_tracks_cmp(tracks_df, playlists_tracks_df):
+def get_top_artists_tracks_cmp(tracks_df, playlists_tracks_df, bitmap=None):
     """Get the tracks of top artists dataframes compared to a random sampling of
     artist tracks to compare distributions of audio characteristics.
 
@@ -61,20 +94,67 @@ def get_top_artists_tracks_cmp(tracks_df, playlists_tracks_df):
         tracks_df (DataFrame): A DataFrame of the unique tracks data.
         playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
             associations.
+        bitmap (array): A pid bitmap from playlist_filters.pid_bitmap, only
+            the selected playlists are used if given.
     
     Returns:
         The DataFrames of the the top tracks and randomly sampled tracks as a
         tuple pair.
     """
     # Get top 10, top 10000, and random sample of 10000 tracks
-    top100_artists_df = get_most_common_artists(tracks_df, playlists_tracks_df, n=100)
+    top100_artists_df = get_most_common_artists(tracks_df, playlists_tracks_df, n=100, bitmap=bitmap)
     top100_artists_df = top100_artists_df.join(tracks_df, on="artist_uri", lsuffix="_left")
     sample100_artists_df = tracks_df.sample(100)
     sample100_artists_df = sample100_artists_df.join(tracks_df, on="artist_uri", lsuffix="_left")
     return top100_artists_df, sample100_artists_df
 
 
-def get_most_common_tracks(tracks_df, playlist_tracks_df, n=10, ascending=False):
+def get_inclusion_counts(tracks_df, playlist_tracks_df, columns):
+    """Count the playlists that include each artist or album.
+
+    Args:
+        track_df (DataFrame): A DataFrame of the unique tracks data.
+        playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
+            associations.
+        columns (list): The uri and name columns, e.g. ["artist_uri", "artist_name"].
+
+    Returns:
+        A DataFrame of the columns and the count of playlists, unsorted.
+    """
+    # compare the artists or albums of the relations by integer code
+    with stage("join"):
+        codes = tracks_df.groupby(columns, sort=False).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+        keys_df = tracks_df.loc[codes >= 0, columns].drop_duplicates().reset_index(drop=True)
+        code_of = np.full(int(tracks_df["track_id"].max()) + 1 if len(tracks_df) else 0, -1, dtype=np.int64)
+        code_of[tracks_df["track_id"].to_numpy()] = codes
+        relation_codes = code_of[playlist_tracks_df["track_id"].to_numpy()]
+    # each playlist counts once per artist or album
+    with stage("groupby"):
+        known = relation_codes >= 0
+        pairs = pd.unique(playlist_tracks_df["pid"].to_numpy()[known] * len(keys_df) + relation_codes[known])
+        keys_df["count"] = np.bincount(pairs % len(keys_df), minlength=len(keys_df)) if len(keys_df) else 0
+        return keys_df[keys_df["count"] > 0].reset_index(drop=True)
+
+
+def top_counts(counts_df, columns, n, ascending=False):
+    """Sort counts and keep the first n, with ties sorted by the columns so
+    that counts merged from partial counts (see sharded.py) give the same rows.
+
+    Args:
+        counts_df (DataFrame): A DataFrame from get_inclusion_counts.
+        columns (list): The uri and name columns.
+        n (int): The number of rows to keep.
+        ascending (bool): Keep the smallest counts instead of the largest.
+
+    Returns:
+        The first n rows indexed by name with the uri and count columns.
+    """
+    uri, name = columns
+    counts_df = counts_df.sort_values(["count", uri, name], ascending=[ascending, True, True], kind="stable")[:n]
+    return counts_df[[name, uri, "count"]].set_index(name)
+
+
+def get_most_common_tracks(tracks_df, playlist_tracks_df, n=10, ascending=False, bitmap=None, distinct=False):
     """Get the most included tracks across all playlists.
 
     Args:
@@ -84,6 +164,10 @@ def get_most_common_tracks(tracks_df, playlist_tracks_df, n=10, ascending=False)
         n (int): The number of tracks to include in the returning DataFrame.
         ascending (bool): Return the top N most common tracks or bottom N most common
             (rareset) tracks.
+        bitmap (array): A pid bitmap from playlist_filters.pid_bitmap, only
+            the selected playlists are used if given.
+        distinct (bool): Count the playlists that include each track instead
+            of its inclusions, a track repeated in a playlist counts once.
 
     Returns:
         A DataFrame of the most common tracks.
@@ -92,11 +176,20 @@ def get_most_common_tracks(tracks_df, playlist_tracks_df, n=10, ascending=False)
     assert isinstance(playlist_tracks_df, pd.DataFrame)
     assert isinstance(n, int)
     assert n > 0
+    playlist_tracks_df = select_playlists(playlist_tracks_df, bitmap)
+    if distinct:
+        # deduplicated relations already have one row per playlist and track
+        if MULTIPLICITY_COLUMN in playlist_tracks_df:
+            playlist_tracks_df = playlist_tracks_df[["track_id", "pid"]]
+        else:
+            with stage("dedup"):
+                playlist_tracks_df = playlist_tracks_df.drop_duplicates(["pid", "track_id"])
     df = get_unique_track_features(tracks_df, playlist_tracks_df)
-    return df[["track_name", "track_uri", "count"]].sort_values("count", ascending=ascending)[:n]
+    with stage("sort"):
+        return df[["track_name", "track_uri", "count"]].sort_values("count", ascending=ascending)[:n]
 
 
-def get_most_common_artists(tracks_df, playlist_tracks_df, n=10, ascending=False):
+def get_most_common_artists(tracks_df, playlist_tracks_df, n=10, ascending=False, bitmap=None):
     """Get the artists that have the most unique inclusions across all playlists.
 
     A unique inclusion deduplicates an artist that has been added multiple
@@ -109,6 +202,8 @@ def get_most_common_artists(tracks_df, playlist_tracks_df, n=10, ascending=False
         n (int): The number of artists to include in the returning DataFrame.
         ascending (bool): Return the top N most common artists or bottom N most common
             (rareset) artists.
+        bitmap (array): A pid bitmap from playlist_filters.pid_bitmap, only
+            the selected playlists are used if given.
 
     Returns:
         A DataFrame of the most common artists.
@@ -117,13 +212,12 @@ def get_most_common_artists(tracks_df, playlist_tracks_df, n=10, ascending=False
     assert isinstance(playlist_tracks_df, pd.DataFrame)
     assert isinstance(n, int)
     assert n > 0
-    df = playlist_tracks_df.join(tracks_df.set_index("track_id")[["artist_uri", "artist_name"]], on="track_id")
-    artists_df = df[["pid", "artist_uri", "artist_name"]].drop_duplicates()
-    artists_df = artists_df.value_counts(["artist_uri", "artist_name"]).to_frame().reset_index()
-    return artists_df[["artist_name", "artist_uri", "count"]].set_index("artist_name").sort_values("count", ascending=ascending)[:n]
+    playlist_tracks_df = select_playlists(playlist_tracks_df, bitmap)
+    columns = ["artist_uri", "artist_name"]
+    return top_counts(get_inclusion_counts(tracks_df, playlist_tracks_df, columns), columns, n, ascending)
 
 
-def get_most_common_albums(tracks_df, playlist_tracks_df, n=10, ascending=False):
+def get_most_common_albums(tracks_df, playlist_tracks_df, n=10, ascending=False, bitmap=None):
     """Get the albums that have the most unique inclusions across all playlists.
 
     A unique inclusion deduplicates an album that has been added multiple
@@ -136,6 +230,8 @@ def get_most_common_albums(tracks_df, playlist_tracks_df, n=10, ascending=False)
         n (int): The number of albums to include in the returning DataFrame.
         ascending (bool): Return the top N most common albums or bottom N most common
             (rareset) albums.
+        bitmap (array): A pid bitmap from playlist_filters.pid_bitmap, only
+            the selected playlists are used if given.
 
     Returns:
         A DataFrame of the most common albums.
@@ -144,13 +240,12 @@ def get_most_common_albums(tracks_df, playlist_tracks_df, n=10, ascending=False)
     assert isinstance(playlist_tracks_df, pd.DataFrame)
     assert isinstance(n, int)
     assert n > 0
-    df = playlist_tracks_df.join(tracks_df.set_index("track_id")[["album_uri", "album_name"]], on="track_id")
-    artists_df = df[["pid", "album_uri", "album_name"]].drop_duplicates()
-    artists_df = artists_df.value_counts(["album_uri", "album_name"]).to_frame().reset_index()
-    return artists_df[["album_name", "album_uri", "count"]].set_index("album_name").sort_values("count", ascending=ascending)[:n]
+    playlist_tracks_df = select_playlists(playlist_tracks_df, bitmap)
+    columns = ["album_uri", "album_name"]
+    return top_counts(get_inclusion_counts(tracks_df, playlist_tracks_df, columns), columns, n, ascending)
 
 
-def get_largest_albums(tracks_df, playlist_tracks_df, n=10):
+def get_largest_albums(tracks_df, playlist_tracks_df, n=10, bitmap=None):
     """Get the albums with the most amount of unique tracks.
 
     Args:
@@ -158,6 +253,8 @@ def get_largest_albums(tracks_df, playlist_tracks_df, n=10):
         playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
             associations.
         n (int): The number of albums to include in the returning DataFrame.
+        bitmap (array): A pid bitmap from playlist_filters.pid_bitmap, only
+            the selected playlists are used if given.
 
     Returns:
         A DataFrame of the largest albums.
@@ -166,12 +263,16 @@ def get_largest_albums(tracks_df, playlist_tracks_df, n=10):
     assert isinstance(playlist_tracks_df, pd.DataFrame)
     assert isinstance(n, int)
     assert n > 0
+    playlist_tracks_df = select_playlists(playlist_tracks_df, bitmap)
     df = get_unique_track_features(tracks_df, playlist_tracks_df)
+    if bitmap is not None:
+        # only the tracks of the selected playlists
+        df = df[df["count"].notna()]
     albums_df = df.value_counts(["album_uri", "album_name"]).to_frame().reset_index()
     return albums_df[["album_name", "count"]].set_index("album_name").sort_values("count", ascending=False)[:n]
 
 
-def get_most_prolific_artists(tracks_df, playlist_tracks_df, n=10):
+def get_most_prolific_artists(tracks_df, playlist_tracks_df, n=10, bitmap=None):
     """Get the artists that have generated the most number of unique tracks.
 
     Args:
@@ -179,6 +280,8 @@ def get_most_prolific_artists(tracks_df, playlist_tracks_df, n=10):
         playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
             associations.
         n (int): The number of artists to include in the returning DataFrame.
+        bitmap (array): A pid bitmap from playlist_filters.pid_bitmap, only
+            the selected playlists are used if given.
 
     Returns:
         A DataFrame of the most prolific artsits.
@@ -187,12 +290,16 @@ def get_most_prolific_artists(tracks_df, playlist_tracks_df, n=10):
     assert isinstance(playlist_tracks_df, pd.DataFrame)
     assert isinstance(n, int)
     assert n > 0
+    playlist_tracks_df = select_playlists(playlist_tracks_df, bitmap)
     df = get_unique_track_features(tracks_df, playlist_tracks_df)
+    if bitmap is not None:
+        # only the tracks of the selected playlists
+        df = df[df["count"].notna()]
     artists_df = df.value_counts(["artist_uri", "artist_name"]).to_frame().reset_index()
     return artists_df[["artist_name", "count"]].set_index("artist_name").sort_values("count", ascending=False)[:n]
 
 
-def get_unique_track_features(tracks_df, playlist_tracks_df):
+def get_unique_track_features(tracks_df, playlist_tracks_df, bitmap=None):
     """Get the common track features as a dataframe for further filtering that occur
     across all playlists.
 
@@ -202,54 +309,66 @@ def get_unique_track_features(tracks_df, playlist_tracks_df):
     artist features.
 
     Note that the count column in the resulting dataframe is the number of appearances
-    of a given track across all playlists.
+    of a given track across all playlists, including the repeats within a playlist
+    of deduplicated relations.
 
     Args:
         track_df (DataFrame): A DataFrame of the unique tracks data.
         playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
             associations.
+        bitmap (array): A pid bitmap from playlist_filters.pid_bitmap, only
+            the selected playlists are used if given.
 
     Returns:
         A DataFrame of the common playlist track features across all playlists.
     """
     assert isinstance(tracks_df, pd.DataFrame)
     assert isinstance(playlist_tracks_df, pd.DataFrame)
+    playlist_tracks_df = select_playlists(playlist_tracks_df, bitmap)
     cols = ["track_name", "artist_name", "album_name", "track_uri", "artist_uri", "album_uri"]
-    num_occurrences_df = playlist_tracks_df.value_counts("track_id").to_frame()
-    return tracks_df[cols + ["track_id"]].join(num_occurrences_df, on="track_id")
+    with stage("groupby"):
+        if MULTIPLICITY_COLUMN in playlist_tracks_df:
+            num_occurrences_df = playlist_tracks_df.groupby("track_id")[MULTIPLICITY_COLUMN].sum().rename("count").to_frame()
+        else:
+            num_occurrences_df = playlist_tracks_df.value_counts("track_id").to_frame()
+    with stage("join"):
+        return tracks_df[cols + ["track_id"]].join(num_occurrences_df, on="track_id")
 
 
-def get_track_durations_stdev_distribution(tracks_df, playlist_tracks_df):
+def get_track_durations_stdev_distribution(tracks_df, playlist_tracks_df, bitmap=None):
     """Get the distribution of the standard deviations of track durations in playlists.
 
     Args:
         track_df (DataFrame): A DataFrame of the unique tracks data.
         playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
             associations.
+        bitmap (array): A pid bitmap from playlist_filters.pid_bitmap, only
+            the selected playlists are used if given.
     Returns:
         list: A list of stdev of track durations where entry i corresponds to
             playlist with pid i.
     """
     assert isinstance(tracks_df, pd.DataFrame)
     assert isinstance(playlist_tracks_df, pd.DataFrame)
+    playlist_tracks_df = select_playlists(playlist_tracks_df, bitmap)
 
-    tqdm.pandas()
-    # cache the durations into a list for faster access
-    track_duration_map = list(tracks_df.duration_s)
-
-    # append track duration to playlist_tracks_df
-    playlist_tracks_df['duration_s'] = playlist_tracks_df['track_id'].progress_apply(lambda x: track_duration_map[x])
+    # the durations are in track_id order
+    with stage("join"):
+        durations = tracks_df['duration_s'].to_numpy()[playlist_tracks_df['track_id'].to_numpy()]
+        pids = playlist_tracks_df['pid'].to_numpy()
+        if MULTIPLICITY_COLUMN in playlist_tracks_df:
+            # a track repeated in a playlist counts every time
+            multiplicity = relation_multiplicity(playlist_tracks_df)
+            durations, pids = np.repeat(durations, multiplicity), np.repeat(pids, multiplicity)
 
-    # caculate the standard deviation of duration_s in each playlist
-    duration_s_stdevs = playlist_tracks_df.groupby('pid').progress_apply(lambda x: np.std(x.duration_s))
+    # caculate the population standard deviation of duration_s in each playlist
+    with stage("groupby"):
+        duration_s_stdevs = pd.Series(durations, dtype=np.float64).groupby(pids).std(ddof=0)
 
-    # remove track duration column
-    del playlist_tracks_df['duration_s']
+    return duration_s_stdevs.rename_axis('pid')
 
-    return duration_s_stdevs
 
-
-def get_artist_diversity_distribution(tracks_df, playlist_tracks_df):
+def get_artist_diversity_distribution(tracks_df, playlist_tracks_df, bitmap=None):
     """Get the distribution of the artist diversity in playlists.
     Artist diversity is defined as the number of unique artists divided by the number of tracks in a playlist.
     Artist diversity gives an insight of how diverse the artists are in a playlist,
@@ -259,30 +378,35 @@ def get_artist_diversity_distribution(tracks_df, playlist_tracks_df):
         track_df (DataFrame): A DataFrame of the unique tracks data.
         playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
             associations.
+        bitmap (array): A pid bitmap from playlist_filters.pid_bitmap, only
+            the selected playlists are used if given.
     Returns:
         list: A list of artist diversity where entry i corresponds to
             playlist with pid i.
     """
     assert isinstance(tracks_df, pd.DataFrame)
     assert isinstance(playlist_tracks_df, pd.DataFrame)
+    playlist_tracks_df = select_playlists(playlist_tracks_df, bitmap)
 
-    tqdm.pandas()
-    # cache the durations into a list for faster access
-    track_artist_map = list(tracks_df.artist_name)
-
-    # append artist name to playlist_tracks_df
-    playlist_tracks_df['artist_name'] = playlist_tracks_df['track_id'].progress_apply(lambda x: track_artist_map[x])
+    # the artists are in track_id order, compare them by integer code
+    with stage("join"):
+        artist_codes, _ = pd.factorize(tracks_df['artist_name'])
+        artists = artist_codes[playlist_tracks_df['track_id'].to_numpy()]
 
     # caculate the artist diversity of each playlist
-    artist_diversity = playlist_tracks_df.groupby('pid').progress_apply(lambda x: x['artist_name'].nunique() / len(x['track_id']))
+    with stage("groupby"):
+        pids = playlist_tracks_df['pid'].to_numpy()
+        playlists = pd.Series(artists).groupby(pids)
+        if MULTIPLICITY_COLUMN in playlist_tracks_df:
+            num_tracks = pd.Series(relation_multiplicity(playlist_tracks_df)).groupby(pids).sum()
+        else:
+            num_tracks = playlists.size()
+        artist_diversity = playlists.nunique() / num_tracks
 
-    # remove track artist name column
-    del playlist_tracks_df['artist_name']
+    return artist_diversity.rename_axis('pid')
 
-    return artist_diversity
 
-
-def get_most_popular_one_hit_wonder(tracks_df, playlist_tracks_df, n=10):
+def get_most_popular_one_hit_wonder(tracks_df, playlist_tracks_df, n=10, bitmap=None):
     """
     Find artists with a low number of tracks but high popularity based on the number of inclusions across all playlists.
 
@@ -291,6 +415,8 @@ def get_most_popular_one_hit_wonder(tracks_df, playlist_tracks_df, n=10):
         playlist_tracks_df (DataFrame): DataFrame of the playlist and track id associations.
         threshold_tracks (int): Threshold for the number of tracks below which an artist is considered to have a low track count.
         threshold_popularity (int): Threshold for the popularity based on the number of inclusions across all playlists.
+        bitmap (array): A pid bitmap from playlist_filters.pid_bitmap, only
+            the selected playlists are used if given.
 
     Returns:
         DataFrame: DataFrame of artists that meet the criteria.
@@ -299,11 +425,17 @@ def get_most_popular_one_hit_wonder(tracks_df, playlist_tracks_df, n=10):
     assert isinstance(playlist_tracks_df, pd.DataFrame)
     assert isinstance(n, int)
     assert n > 0
+    playlist_tracks_df = select_playlists(playlist_tracks_df, bitmap)
     
-    merged_df = pd.merge(playlist_tracks_df, tracks_df[['track_id', 'artist_name']], on='track_id')
-    artist_track_counts = merged_df.groupby('artist_name')['track_id'].nunique().reset_index()
+    with stage("join"):
+        merged_df = pd.merge(playlist_tracks_df, tracks_df[['track_id', 'artist_name']], on='track_id')
+    with stage("groupby"):
+        artist_track_counts = merged_df.groupby('artist_name')['track_id'].nunique().reset_index()
+        if MULTIPLICITY_COLUMN in merged_df:
+            artist_popularity = merged_df.groupby('artist_name')[MULTIPLICITY_COLUMN].sum().reset_index()
+        else:
+            artist_popularity = merged_df['artist_name'].value_counts().reset_index()
     artist_track_counts.columns = ['artist_name', 'track_count']
-    artist_popularity = merged_df['artist_name'].value_counts().reset_index()
     artist_popularity.columns = ['artist_name', 'popularity']
     artist_stats = pd.merge(artist_track_counts, artist_popularity, on='artist_name')
     popular_one_hit_wonders = artist_stats[
@@ -313,7 +445,7 @@ def get_most_popular_one_hit_wonder(tracks_df, playlist_tracks_df, n=10):
     return top_n_one_hit_wonders
 
 
-def get_popular_artist_cnt(tracks_df, playlist_tracks_df, n=100):
+def get_popular_artist_cnt(tracks_df, playlist_tracks_df, n=100, bitmap=None):
     """
     Find the number of top-n common artists in each playlist.
 
@@ -321,6 +453,8 @@ def get_popular_artist_cnt(tracks_df, playlist_tracks_df, n=100):
         tracks_df (DataFrame): DataFrame of the unique tracks data.
         playlist_tracks_df (DataFrame): DataFrame of the playlist and track id associations.
         n(int): Top N most common artists would be considered as popular.
+        bitmap (array): A pid bitmap from playlist_filters.pid_bitmap, only
+            the selected playlists are used if given.
 
     Returns:
         pd.Series: A series of count of top-n common artists where each entry corresponds to a playlist.
@@ -329,32 +463,31 @@ def get_popular_artist_cnt(tracks_df, playlist_tracks_df, n=100):
     assert isinstance(playlist_tracks_df, pd.DataFrame)
     assert isinstance(n, int)
     assert n > 0
+    playlist_tracks_df = select_playlists(playlist_tracks_df, bitmap)
 
     top_n_artists = get_most_common_artists(tracks_df, playlist_tracks_df, n)
+    return count_artists_in_playlists(tracks_df, playlist_tracks_df, top_n_artists.index)
 
-    df = playlist_tracks_df.join(tracks_df.set_index("track_id")[["artist_name"]], on="track_id")
-
-    def cnt(playlist):
-        """Given a playlist, count the number of top-n artists in this playlist.
 
-        Args:
-            playlist (DataFrame): DataFrame of a playlist with artist names
-
-        Returns:
-            int: The number of top-n artists in this playlist.
-        """
-        assert isinstance(playlist, pd.DataFrame)
+def count_artists_in_playlists(tracks_df, playlist_tracks_df, artist_names):
+    """
+    Count the given artists in each playlist.
 
-        ans = 0
-        for artist in playlist.artist_name.unique():
-            if artist in top_n_artists.index:
-                ans += 1
-        return ans
+    Args:
+        tracks_df (DataFrame): DataFrame of the unique tracks data.
+        playlist_tracks_df (DataFrame): DataFrame of the playlist and track id associations.
+        artist_names (list): The names of the artists to count.
 
-    # calculate the number of top 100 artists in a playlist
-    top_n_artists_cnt = df.groupby('pid').progress_apply(lambda playlist: cnt(playlist))
+    Returns:
+        pd.Series: The number of the artists in each playlist, 0 for playlists without any, sorted by pid.
+    """
+    with stage("join"):
+        df = playlist_tracks_df.join(tracks_df.set_index("track_id")[["artist_name"]], on="track_id")
 
-    return top_n_artists_cnt
+    with stage("groupby"):
+        popular = df[df['artist_name'].isin(artist_names)]
+        artists_cnt = popular.groupby('pid')['artist_name'].nunique()
+        return artists_cnt.reindex(df['pid'].unique(), fill_value=0).sort_index()
 
 
 if __name__ == "__main__":
@@ -370,51 +503,157 @@ if __name__ == "__main__":
         default=10,
         help="The top N ranked counts for each analysis feature to plot and save."
     )
+    parser.add_argument(
+        "--audio_features",
+        type=str,
+        default=None,
+        help="CSV of the audio features of the tracks, used to compare the top K tracks against K sampled tracks. "
+             "Without it the top1000/sample1000 snapshot CSVs are compared."
+    )
+    parser.add_argument(
+        "-K",
+        type=int,
+        default=1000,
+        help="The number of top and sampled tracks to compare audio features for."
+    )
+    parser.add_argument(
+        "--sampling",
+        choices=SAMPLING_METHODS,
+        default="uniform",
+        help="Sample tracks uniformly or stratified by popularity."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="The seed of the track sampling."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="The number of processes to render the plots with, defaults to the number of CPUs."
+    )
+    parser.add_argument(
+        "--start",
+        type=str,
+        default=None,
+        help="Only analyze the playlists modified from this date on, e.g. 2016-01. Requires partitioned data."
+    )
+    parser.add_argument(
+        "--end",
+        type=str,
+        default=None,
+        help="Only analyze the playlists modified before this date, e.g. 2017-01. Requires partitioned data."
+    )
+    parser.add_argument(
+        "--filter",
+        type=str,
+        action="append",
+        default=None,
+        help="Only analyze the playlists matching a filter, e.g. \"num_followers > 10\" or \"name contains workout\". "
+             "Repeat to combine filters."
+    )
+    parser.add_argument(
+        "--aggregates",
+        type=str,
+        default=None,
+        help="Directory of the aggregate state from aggregates.py, the top tracks, artists, albums and one-hit "
+             "wonders are read from it instead of recounted. Not used with --filter, --start or --end."
+    )
+    add_profile_arguments(parser)
     args = parser.parse_args(sys.argv[1:])
     N = args.N
-    print("Reading pre processed data...")
-    _, tracks_df, playlist_tracks_df = read_pre_processed_data(args.input_data)
-
-    # Plot top N tracks
-    print(f"Plotting top {N} most common tracks...")
-    top_N_tracks = get_most_common_tracks(tracks_df, playlist_tracks_df, n=N)
-    save_bar_plot(f"top{N}_tracks.png", top_N_tracks, x="track_name", y="count", title=f"Top {N} Most Common Tracks", orient="h")
-
-    # Plot top N artists
-    print(f"Plotting top {N} most common artists...")
-    top_N_artists = get_most_common_artists(tracks_df, playlist_tracks_df, n=N)
-    save_bar_plot(f"top{N}_artists.png", top_N_artists, x="artist_name", y="count", title=f"Top {N} Most Common Artists", orient="h")
-
-    # Plot top N albums
-    print(f"Plotting top {N} most common albums...")
-    top_N_albums = get_most_common_albums(tracks_df, playlist_tracks_df, n=N)
-    save_bar_plot(f"top{N}_albums.png", top_N_albums, x="album_name", y="count", title=f"Top {N} Most Common Albums", orient="h")
-
-    # Plot top N prolific artists
-    print(f"Plotting top {N} most prolific artists...")
-    top_N_prolific_artists = get_most_prolific_artists(tracks_df, playlist_tracks_df, n=N)
-    save_bar_plot(f"top{N}_prolific_artists.png", top_N_prolific_artists, x="artist_name", y="count", title=f"Top {N} Most Prolific Artists", orient="h")
-
-    # Plot top N largest albums
-    print(f"Plotting top {N} largest albums...")
-    top_N_largest_albums = get_largest_albums(tracks_df, playlist_tracks_df, n=N)
-    save_bar_plot(f"top{N}_largest_albums.png", top_N_largest_albums, x="album_name", y="count", title=f"Top {N} Largest Albums", orient="h")
+    with profile_from_args("analysis", args):
+        print("Reading pre processed data...")
+        playlists_df, tracks_df, playlist_tracks_df = read_pre_processed_data(args.input_data, args.start, args.end)
+        bitmap = None
+        if args.filter:
+            bitmap = pid_bitmap(playlists_df, " and ".join(args.filter))
+            print(f"Selected {bitmap.sum()} of {len(playlists_df)} playlists")
+        del playlists_df
+        plot_specs = []
+
+        # the aggregate state counts all the playlists
+        aggregate_state = None
+        if args.aggregates is not None and bitmap is None and args.start is None and args.end is None:
+            from aggregates import AggregateState
+            aggregate_state = AggregateState.load(args.aggregates)
+
+        # Plot the playlists per month from the precomputed aggregates
+        if is_partitioned(args.input_data):
+            periods = get_period_aggregates(args.input_data, args.start, args.end)
+            plot_specs.append(bar_plot_spec("playlists_by_month.png", periods, x="month", y="playlists", title="Playlists Modified per Month"))
+
+        # Plot top N tracks
+        print(f"Computing top {N} most common tracks...")
+        with stage("most_common_tracks"):
+            if aggregate_state is not None:
+                top_N_tracks = aggregate_state.most_common_tracks(N)
+            else:
+                top_N_tracks = get_most_common_tracks(tracks_df, playlist_tracks_df, n=N, bitmap=bitmap)
+        plot_specs.append(bar_plot_spec(f"top{N}_tracks.png", top_N_tracks, x="track_name", y="count", title=f"Top {N} Most Common Tracks", orient="h"))
+
+        # Plot top N artists
+        print(f"Computing top {N} most common artists...")
+        with stage("most_common_artists"):
+            if aggregate_state is not None:
+                top_N_artists = aggregate_state.most_common_artists(N)
+            else:
+                top_N_artists = get_most_common_artists(tracks_df, playlist_tracks_df, n=N, bitmap=bitmap)
+        plot_specs.append(bar_plot_spec(f"top{N}_artists.png", top_N_artists, x="artist_name", y="count", title=f"Top {N} Most Common Artists", orient="h"))
+
+        # Plot top N albums
+        print(f"Computing top {N} most common albums...")
+        with stage("most_common_albums"):
+            if aggregate_state is not None:
+                top_N_albums = aggregate_state.most_common_albums(N)
+            else:
+                top_N_albums = get_most_common_albums(tracks_df, playlist_tracks_df, n=N, bitmap=bitmap)
+        plot_specs.append(bar_plot_spec(f"top{N}_albums.png", top_N_albums, x="album_name", y="count", title=f"Top {N} Most Common Albums", orient="h"))
+
+        # Plot top N prolific artists
+        print(f"Computing top {N} most prolific artists...")
+        with stage("most_prolific_artists"):
+            top_N_prolific_artists = get_most_prolific_artists(tracks_df, playlist_tracks_df, n=N, bitmap=bitmap)
+        plot_specs.append(bar_plot_spec(f"top{N}_prolific_artists.png", top_N_prolific_artists, x="artist_name", y="count", title=f"Top {N} Most Prolific Artists", orient="h"))
+
+        # Plot top N largest albums
+        print(f"Computing top {N} largest albums...")
+        with stage("largest_albums"):
+            top_N_largest_albums = get_largest_albums(tracks_df, playlist_tracks_df, n=N, bitmap=bitmap)
+        plot_specs.append(bar_plot_spec(f"top{N}_largest_albums.png", top_N_largest_albums, x="album_name", y="count", title=f"Top {N} Largest Albums", orient="h"))
     
-    # Plot top N prolific artists with only one track
-    print(f"Plotting top {N} most prolific artists...")
-    top_N_prolific_one_hit = get_most_popular_one_hit_wonder(tracks_df, playlist_tracks_df, n=N)
-    save_bar_plot(f"top{N}_prolific_one_hit.png", top_N_prolific_one_hit, x="artist_name", y="popularity", title=f"Top {N} Most Prolific Artists With Only One Track", orient="h")
-
-    # Plot audio characteristic distributions
-    top1000_audio_df = pd.read_csv("top1000_audio_features.csv")
-    sample1000_audio_df = pd.read_csv("sample1000_audio_features.csv")
-    hist_df = get_top_tracks_audio_features_cmp(top1000_audio_df, sample1000_audio_df)
-    save_audio_features_hist("danceability_hist.png", hist_df, x="danceability", title="Danceability of Top 1000 vs. 1000 Random Tracks")
-    save_audio_features_hist("energy_hist.png", hist_df, x="energy", title="Energy of Top 1000 vs. 1000 Random Tracks")
-    save_audio_features_hist("loudness_hist.png", hist_df, x="loudness", title="Loudness of Top 1000 vs. 1000 Random Tracks")
-    save_audio_features_hist("speechiness_hist.png", hist_df, x="speechiness", title="Speechiness of Top 1000 vs. 1000 Random Tracks")
-    save_audio_features_hist("acousticness_hist.png", hist_df, x="acousticness", title="Acousticness of Top 1000 vs. 1000 Random Tracks")
-    save_audio_features_hist("liveness_hist.png", hist_df, x="liveness", title="Liveness of Top 1000 vs. 1000 Random Tracks")
-    save_audio_features_hist("valence_hist.png", hist_df, x="valence", title="Valence of Top 1000 vs. 1000 Random Tracks")
-    save_audio_features_hist("tempo_hist.png", hist_df, x="tempo", title="Tempo of Top 1000 vs. 1000 Random Tracks")
-    save_audio_features_hist("duration_ms.png", hist_df, x="duration_ms", title="Duration of Top 1000 vs. 1000 Random Tracks")
+        # Plot top N prolific artists with only one track
+        print(f"Computing top {N} most prolific artists...")
+        with stage("most_popular_one_hit_wonder"):
+            if aggregate_state is not None:
+                top_N_prolific_one_hit = aggregate_state.one_hit_wonders(N)
+            else:
+                top_N_prolific_one_hit = get_most_popular_one_hit_wonder(tracks_df, playlist_tracks_df, n=N, bitmap=bitmap)
+        plot_specs.append(bar_plot_spec(f"top{N}_prolific_one_hit.png", top_N_prolific_one_hit, x="artist_name", y="popularity", title=f"Top {N} Most Prolific Artists With Only One Track", orient="h"))
+
+        # Plot audio characteristic distributions
+        if args.audio_features is not None:
+            K = args.K
+            features, feature_matrix = load_audio_feature_store(args.audio_features, tracks_df)
+            counts = track_popularity(select_playlists(playlist_tracks_df, bitmap), len(feature_matrix))
+            hists = compare_top_vs_sample(feature_matrix, features, counts, K, method=args.sampling, seed=args.seed)
+        else:
+            K = 1000
+            with stage("load"):
+                top1000_audio_df = pd.read_csv("top1000_audio_features.csv")
+                sample1000_audio_df = pd.read_csv("sample1000_audio_features.csv")
+            hists = get_top_tracks_audio_features_hists(top1000_audio_df, sample1000_audio_df)
+        plot_specs.append(accumulated_hist_plot_spec("danceability_hist.png", hists, x="danceability", title=f"Danceability of Top {K} vs. {K} Random Tracks"))
+        plot_specs.append(accumulated_hist_plot_spec("energy_hist.png", hists, x="energy", title=f"Energy of Top {K} vs. {K} Random Tracks"))
+        plot_specs.append(accumulated_hist_plot_spec("loudness_hist.png", hists, x="loudness", title=f"Loudness of Top {K} vs. {K} Random Tracks"))
+        plot_specs.append(accumulated_hist_plot_spec("speechiness_hist.png", hists, x="speechiness", title=f"Speechiness of Top {K} vs. {K} Random Tracks"))
+        plot_specs.append(accumulated_hist_plot_spec("acousticness_hist.png", hists, x="acousticness", title=f"Acousticness of Top {K} vs. {K} Random Tracks"))
+        plot_specs.append(accumulated_hist_plot_spec("liveness_hist.png", hists, x="liveness", title=f"Liveness of Top {K} vs. {K} Random Tracks"))
+        plot_specs.append(accumulated_hist_plot_spec("valence_hist.png", hists, x="valence", title=f"Valence of Top {K} vs. {K} Random Tracks"))
+        plot_specs.append(accumulated_hist_plot_spec("tempo_hist.png", hists, x="tempo", title=f"Tempo of Top {K} vs. {K} Random Tracks"))
+        plot_specs.append(accumulated_hist_plot_spec("duration_ms.png", hists, x="duration_ms", title=f"Duration of Top {K} vs. {K} Random Tracks"))
+
+        print(f"Rendering {len(plot_specs)} plots...")
+        render_plots(plot_specs, workers=args.workers)
@@ -0,0 +1,217 @@
+'''
+Compare the audio features of the K most popular tracks against a random
+sample of tracks, for any K, over the full catalogue.
+
+The audio feature store (the CSV written by
+recommend_track.get_track_features_in_chunks) is joined to the tracks by
+their integer track_id, the popularity ranking is a bincount over the
+playlist/track relations and the random tracks are drawn by reservoir
+sampling, so nothing depends on hand-made CSV snapshots.
+'''
+import numpy as np
+import pandas as pd
+
+from histograms import AUDIO_FEATURE_RANGES, HistogramAccumulator
+from indexes import spotify_ids
+from pre_processing import relation_multiplicity, MULTIPLICITY_COLUMN
+from profiling import stage
+
+SAMPLING_METHODS = ("uniform", "stratified")
+
+
+def load_audio_feature_store(features_path, tracks_df, features=None,
+                             chunksize=500000):
+    """Load the audio feature store into an array indexed by track_id.
+
+    Args:
+        features_path (str): A CSV of audio features with an "id" column of
+            Spotify track ids.
+        tracks_df (DataFrame): A DataFrame of the unique tracks data.
+        features (list): The features to load, defaults to the features in
+            AUDIO_FEATURE_RANGES.
+        chunksize (int): The number of rows of the store read at a time.
+
+    Returns:
+        A tuple of the list of features and an array of shape
+        (number of track ids, number of features) where row track_id holds the
+        features of that track, NaN for tracks missing from the store.
+    """
+    assert isinstance(tracks_df, pd.DataFrame)
+    features = list(AUDIO_FEATURE_RANGES) if features is None else list(features)
+
+    ids = spotify_ids(tracks_df["track_uri"])
+    first = ~ids.duplicated().to_numpy()
+    id_index = pd.Index(ids[first])
+    track_ids = tracks_df["track_id"].to_numpy(dtype=np.int64)
+    feature_matrix = np.full((int(track_ids.max()) + 1, len(features)), np.nan)
+    track_ids = track_ids[first]
+
+    with stage("load"):
+        for chunk in pd.read_csv(features_path, usecols=["id"] + features,
+                                 chunksize=chunksize):
+            rows = id_index.get_indexer(chunk["id"])
+            known = rows >= 0
+            feature_matrix[track_ids[rows[known]]] = \
+                chunk.loc[known, features].to_numpy(dtype=np.float64)
+    return features, feature_matrix
+
+
+def track_popularity(playlist_tracks_df, n_tracks):
+    """Get the number of playlist inclusions of every track.
+
+    Args:
+        playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
+            associations.
+        n_tracks (int): The number of track ids.
+
+    Returns:
+        array: counts[track_id] is the number of inclusions of the track.
+    """
+    assert isinstance(playlist_tracks_df, pd.DataFrame)
+    with stage("groupby"):
+        track_ids = playlist_tracks_df["track_id"].to_numpy(dtype=np.int64)
+        if MULTIPLICITY_COLUMN not in playlist_tracks_df:
+            return np.bincount(track_ids, minlength=n_tracks)
+        # deduplicated relations count a repeated track every time
+        return np.bincount(track_ids, relation_multiplicity(playlist_tracks_df),
+                           minlength=n_tracks).astype(np.int64)
+
+
+def top_k_track_ids(counts, k, candidates=None):
+    """Get the ids of the k most popular tracks, most popular first.
+
+    Args:
+        counts (array): The popularity of every track id.
+        k (int): The number of tracks.
+        candidates (array): Restrict the ranking to these track ids.
+
+    Returns:
+        array: The track ids.
+    """
+    candidates = np.arange(len(counts)) if candidates is None else np.asarray(candidates)
+    k = min(k, len(candidates))
+    if k == 0:
+        return candidates[:0]
+    top = np.argpartition(-counts[candidates], k - 1)[:k]
+    # break ties by track id so that the ranking is reproducible
+    order = np.lexsort((candidates[top], -counts[candidates[top]]))
+    return candidates[top[order]]
+
+
+def reservoir_sample(chunks, k, rng):
+    """Draw a uniform sample of k items from a stream of array chunks.
+
+    This is Algorithm R applied a chunk at a time: item i of the stream
+    replaces a random slot of the reservoir with probability k / (i + 1).
+
+    Args:
+        chunks (iterable): Arrays of items.
+        k (int): The sample size.
+        rng (Generator): A NumPy random generator.
+
+    Returns:
+        array: The sampled items, fewer than k if the stream is shorter.
+    """
+    reservoir = None
+    seen = 0
+    for chunk in chunks:
+        chunk = np.asarray(chunk)
+        if reservoir is None:
+            reservoir = np.empty(k, dtype=chunk.dtype)
+        # fill the reservoir first
+        n_fill = max(0, min(k - seen, len(chunk)))
+        reservoir[seen:seen + n_fill] = chunk[:n_fill]
+        rest = chunk[n_fill:]
+        positions = seen + n_fill + np.arange(len(rest))
+        seen += len(chunk)
+        if len(rest) == 0:
+            continue
+        slots = rng.integers(0, positions + 1)
+        replace = slots < k
+        slots, items = slots[replace], rest[replace]
+        # a later item overwrites an earlier one in the same slot
+        _, last = np.unique(slots[::-1], return_index=True)
+        last = len(slots) - 1 - last
+        reservoir[slots[last]] = items[last]
+    if reservoir is None:
+        return np.empty(0, dtype=np.int64)
+    return reservoir[:min(k, seen)]
+
+
+def stratified_sample(track_ids, counts, k, rng, n_strata=10):
+    """Draw k tracks with the same popularity distribution as the catalogue.
+
+    The tracks are split into strata by log popularity quantiles and every
+    stratum contributes proportionally to its size.
+
+    Args:
+        track_ids (array): The track ids to sample from.
+        counts (array): The popularity of every track id.
+        k (int): The sample size.
+        rng (Generator): A NumPy random generator.
+        n_strata (int): The number of popularity strata.
+
+    Returns:
+        array: The sampled track ids.
+    """
+    track_ids = np.asarray(track_ids)
+    k = min(k, len(track_ids))
+    log_counts = np.log1p(counts[track_ids])
+    edges = np.unique(np.quantile(log_counts, np.linspace(0, 1, n_strata + 1)[1:-1]))
+    strata = np.searchsorted(edges, log_counts, side="right")
+    sizes = np.bincount(strata)
+    # largest remainder allocation so that the sizes add up to k
+    quotas = sizes * k / len(track_ids)
+    allocation = np.floor(quotas).astype(np.int64)
+    remainder = k - allocation.sum()
+    allocation[np.argsort(allocation - quotas)[:remainder]] += 1
+
+    order = np.argsort(strata, kind="stable")
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    sample = [rng.choice(track_ids[order[offsets[s]:offsets[s + 1]]], size=n, replace=False)
+              for s, n in enumerate(allocation) if n > 0]
+    return np.concatenate(sample) if sample else track_ids[:0]
+
+
+def compare_top_vs_sample(feature_matrix, features, counts, k, method="uniform",
+                          seed=0, bins=50, chunksize=100000):
+    """Get the audio feature histograms of the top k tracks and of k sampled
+    tracks.
+
+    Only tracks present in the feature store are ranked and sampled.
+
+    Args:
+        feature_matrix (array): Features indexed by track id, from
+            load_audio_feature_store.
+        features (list): The names of the feature_matrix columns.
+        counts (array): The popularity of every track id, from
+            track_popularity.
+        k (int): The number of top and sampled tracks.
+        method (str): One of SAMPLING_METHODS.
+        seed (int): The seed of the sampling, for reproducibility.
+        bins (int): The number of histogram bins.
+        chunksize (int): The number of track ids streamed at a time by the
+            uniform reservoir sampling.
+
+    Returns:
+        A dict mapping "top_{k}" and "sample_{k}" to HistogramAccumulators.
+    """
+    assert method in SAMPLING_METHODS
+    assert isinstance(k, int) and k > 0
+    assert len(counts) >= len(feature_matrix)
+    rng = np.random.default_rng(seed)
+    available = np.flatnonzero(~np.isnan(feature_matrix).any(axis=1))
+
+    top_ids = top_k_track_ids(counts, k, available)
+    if method == "uniform":
+        chunks = (available[i:i + chunksize] for i in range(0, len(available), chunksize))
+        sample_ids = reservoir_sample(chunks, k, rng)
+    else:
+        sample_ids = stratified_sample(available, counts, k, rng)
+
+    hists = {}
+    for label, ids in ((f"top_{k}", top_ids), (f"sample_{k}", sample_ids)):
+        hists[label] = HistogramAccumulator(features, bins)
+        for i in range(0, len(ids), chunksize):
+            hists[label].update(dict(zip(features, feature_matrix[ids[i:i + chunksize]].T)))
+    return hists
@@ -2,44 +2,124 @@
 Calculates statistics relevant to the collaborative playlist attribute
 '''
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import math
 import tqdm
 import wordcloud
 from PIL import Image
+from playlist_filters import pid_bitmap, selected_rows, collaborative as filter_collaborative
+from pre_processing import playlist_track_ids
 
-def word_frequencies(playlist_df, tracks_df, desc='Extracting word frequencies'):
-    freq = defaultdict(int)
-    for track_ids in tqdm.tqdm(playlist_df['tracks'], desc=desc):
-        track_ids = [int(x) for x in track_ids[1:-1].split(', ')]
-        for track_id in track_ids:
-            freq[track_id] += 1
-    # sort by value to list
-    freq = sorted(freq.items(), key=lambda x: x[1], reverse=True)
+WORDCLOUD_OPTIONS = {'width': 500, 'height': 250}
+
+def word_frequencies(playlist_df, tracks_df, desc='Extracting word frequencies', bitmap=None, parsed=None):
+    '''
+    Returns the track frequencies and the word frequencies of the names of the
+    1000 most frequent tracks, both sorted by decreasing frequency
+
+    Only the playlists selected by the pid bitmap (see playlist_filters) are
+    counted if given. parsed is the result of playlist_track_ids, to reuse it
+    across several bitmaps.
+    '''
+    track_ids, lengths = playlist_track_ids(playlist_df, desc) if parsed is None else parsed
+    if bitmap is not None:
+        track_ids = track_ids[np.repeat(selected_rows(playlist_df['pid'], bitmap), lengths)]
+    # ties keep the order of first appearance
+    unique_ids, first, counts = np.unique(track_ids, return_index=True, return_counts=True)
+    order = np.lexsort((first, -counts))
+    freq = list(zip(unique_ids[order].tolist(), counts[order].tolist()))
+
+    names = tracks_df.drop_duplicates('track_id').set_index('track_id')['track_name']
     wfreq = defaultdict(int)
-    for track, count in freq[:1000]:
+    for (track, count), name in zip(freq[:1000], names.reindex(unique_ids[order[:1000]])):
         # remove punctuation, lowercase
-        words = tracks_df[tracks_df['track_id'] == track]['track_name'].values[0].lower().replace('[^\\w]','').split()
+        words = name.lower().replace('[^\\w]','').split()
         for word in words:
             wfreq[word] += count
     wfreq = sorted(wfreq.items(), key=lambda x: x[1], reverse=True)
     return freq, wfreq
 
-def freq_by_collaborative(playlist_df, tracks_df, collaborative=True):
+def freq_by_collaborative(playlist_df, tracks_df, collaborative=True, bitmap=None, parsed=None):
     '''
-    Returns word frequencies based on collaborative attribute
+    Returns word frequencies based on collaborative attribute, within the
+    playlists of the pid bitmap if given
     '''
-    sub_df = playlist_df[playlist_df['collaborative'] == collaborative]
-    freq, wfreq = word_frequencies(sub_df , tracks_df)
+    collaborative_bitmap = pid_bitmap(playlist_df, filter_collaborative(collaborative))
+    if bitmap is not None:
+        collaborative_bitmap[:len(bitmap)] &= bitmap[:len(collaborative_bitmap)]
+        collaborative_bitmap[len(bitmap):] = False
+    freq, wfreq = word_frequencies(playlist_df, tracks_df, bitmap=collaborative_bitmap, parsed=parsed)
     return wfreq
 
+def freqs_by_bitmaps(playlist_df, tracks_df, bitmaps):
+    '''
+    Returns the word frequencies of the playlists of every pid bitmap, e.g.
+    one per subset of a comparison, parsing the playlist tracks once
+    '''
+    parsed = playlist_track_ids(playlist_df)
+    return [word_frequencies(playlist_df, tracks_df, bitmap=bitmap, parsed=parsed)[1] for bitmap in bitmaps]
+
+def _remove_words(wfreq, exclude_words):
+    remove_words = set(['.', '-', 'the'] + list(exclude_words))
+    return dict(x for x in wfreq if x[0] not in remove_words)
+
 def create_wordcloud(wfreq, exclude_words=[]):
     '''
     Creates a word cloud based on frequencies
     '''
-    remove_words = ['.', '-', 'the'] + exclude_words
-    wfreq = [x for x in wfreq if x[0] not in remove_words]
-    return wordcloud.WordCloud(width=500, height=250).generate_from_frequencies(dict(wfreq)).to_image()
+    return wordcloud.WordCloud(**WORDCLOUD_OPTIONS).generate_from_frequencies(_remove_words(wfreq, exclude_words)).to_image()
+
+# the WordCloud options of a worker process, set by _init_wordcloud_worker
+_worker_options = None
+
+def _init_wordcloud_worker(options, mask_path=None):
+    '''
+    Loads the mask and resolves the font of a process once, for every
+    frequency map of a batch
+    '''
+    global _worker_options
+    options = dict(options)
+    if mask_path is not None:
+        options['mask'] = np.array(Image.open(mask_path))
+    options['font_path'] = wordcloud.WordCloud(**options).font_path
+    _worker_options = options
+
+def _render_wordcloud(wfreq, exclude_words):
+    # a new WordCloud per map, it keeps the state of its random layout
+    cloud = wordcloud.WordCloud(**_worker_options)
+    return cloud.generate_from_frequencies(_remove_words(wfreq, exclude_words)).to_image()
+
+def create_wordclouds(wfreqs, exclude_words=[], workers=None, mask_path=None, **options):
+    '''
+    Creates the word clouds of many frequency maps in a process pool
+
+    exclude_words is a list of words to remove from every map, or a list of
+    one such list per map. mask_path is an image whose white pixels are left
+    empty, and the options are passed to WordCloud, e.g. font_path or
+    random_state for reproducible layouts. The font and mask are loaded once
+    per process. With one worker or map the clouds are rendered in this
+    process.
+    '''
+    if exclude_words and all(isinstance(words, (list, tuple, set)) for words in exclude_words):
+        assert len(exclude_words) == len(wfreqs)
+    else:
+        exclude_words = [exclude_words] * len(wfreqs)
+    options = {**WORDCLOUD_OPTIONS, **options}
+    if workers == 1 or len(wfreqs) <= 1:
+        _init_wordcloud_worker(options, mask_path)
+        return [_render_wordcloud(wfreq, words) for wfreq, words in zip(wfreqs, exclude_words)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_wordcloud_worker,
+                             initargs=(options, mask_path)) as executor:
+        return list(executor.map(_render_wordcloud, wfreqs, exclude_words))
+
+def wordcloud_grid(wfreqs, rows, cols, padding=10, exclude_words=[], workers=None, mask_path=None, **options):
+    '''
+    Renders the word clouds of many frequency maps in parallel and pastes
+    them in a rows x cols grid, in row order
+    '''
+    return image_grid(create_wordclouds(wfreqs, exclude_words, workers, mask_path, **options), rows, cols, padding)
 
 def image_grid(imgs, rows, cols, padding=10):
     assert len(imgs) == rows*cols
@@ -0,0 +1,211 @@
+'''
+Draw a small, self-contained development subset of the pre-processed data.
+
+A fraction of the playlists is drawn stratified by length, followers and
+collaborative, all of their tracks are kept, and the pids and track ids are
+renumbered densely so the subset has the same layout as the full output
+(tracks_df row i is track_id i) and loads with read_pre_processed_data.
+
+Every file is read once, in chunks. The strata use fixed bins so they are
+known before reading, and each stratum is sampled systematically: with a
+random start u in [0, 1), the k-th playlist of a stratum is drawn when
+floor((k + 1) * frac + u) > floor(k * frac + u). This draws
+round(frac * stratum size) playlists from every stratum, so the subset has
+the proportions of the full data.
+
+Run `python dev_subset.py [pre-processed data dir] [subset dir] --frac 0.01`
+to write a 1% subset.
+'''
+from argparse import ArgumentParser
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from indexes import spotify_ids
+from pre_processing import (playlist_track_ids, pre_processed_table_path, TRACKS_DF_FILENAME,
+                            PLAYLISTS_DF_FILENAME, PLAYLIST_TRACKS_DF_FILENAME)
+from profiling import stage, add_profile_arguments, profile_from_args
+
+SUBSET_REPORT_FILENAME = "subset.json"
+# the strata are the products of these bins and collaborative
+LENGTH_BINS = (0, 10, 20, 50, 100, 200, np.inf)
+FOLLOWER_BINS = (0, 2, 5, 20, 100, np.inf)
+N_STRATA = (len(LENGTH_BINS) - 1) * (len(FOLLOWER_BINS) - 1) * 2
+
+
+def playlist_strata(playlists_df):
+    """Get the stratum of every playlist.
+
+    Args:
+        playlists_df (DataFrame): A DataFrame of the playlists data.
+
+    Returns:
+        array: The stratum in [0, N_STRATA) of every row.
+    """
+    lengths = np.searchsorted(LENGTH_BINS, playlists_df["num_tracks"].to_numpy(), side="right") - 1
+    followers = np.searchsorted(FOLLOWER_BINS, playlists_df["num_followers"].to_numpy(), side="right") - 1
+    collaborative = playlists_df["collaborative"].astype(str).str.lower().to_numpy() == "true"
+    return (lengths * (len(FOLLOWER_BINS) - 1) + followers) * 2 + collaborative
+
+
+class StratifiedSampler:
+    '''Systematic sampling of a stream of rows within strata.'''
+
+    def __init__(self, frac, n_strata, seed=0):
+        '''
+        Args:
+            frac (float): The fraction of every stratum to draw.
+            n_strata (int): The number of strata.
+            seed (int): The seed of the random starts.
+        '''
+        assert 0 < frac <= 1
+        self.frac = frac
+        self.starts = np.random.default_rng(seed).random(n_strata)
+        self.seen = np.zeros(n_strata, dtype=np.int64)
+        self.drawn = np.zeros(n_strata, dtype=np.int64)
+
+    def draw(self, strata):
+        """Draw from the next rows of the stream.
+
+        Args:
+            strata (array): The stratum of every row.
+
+        Returns:
+            array: Which rows are drawn.
+        """
+        strata = np.asarray(strata, dtype=np.int64)
+        # the position of every row within its stratum over the whole stream
+        k = self.seen[strata] + pd.Series(strata).groupby(strata).cumcount().to_numpy()
+        u = self.starts[strata]
+        drawn = np.floor((k + 1) * self.frac + u) > np.floor(k * self.frac + u)
+        self.seen += np.bincount(strata, minlength=len(self.seen))
+        self.drawn += np.bincount(strata[drawn], minlength=len(self.drawn))
+        return drawn
+
+
+def _format_track_lists(track_ids, lengths):
+    """Format flat track ids as the "[1, 2]" strings of the tracks column."""
+    lists = np.split(track_ids, np.cumsum(lengths)[:-1]) if len(lengths) else []
+    return ["[" + ", ".join(map(str, ids.tolist())) + "]" for ids in lists]
+
+
+def sample_pre_processed_data(data_path, new_path, frac=0.01, seed=0, audio_features=None,
+                              chunksize=100000):
+    """Write a stratified subset of the pre-processed data.
+
+    Args:
+        data_path (str): The directory of the pre-processed data.
+        new_path (str): The directory of the subset.
+        frac (float): The fraction of the playlists to draw.
+        seed (int): The seed of the draw.
+        audio_features (str): A CSV of track audio features with an id
+            column, e.g. from recommend_track.py --create_tracks_feature, the
+            rows of the subset tracks are saved in the subset if given.
+        chunksize (int): The rows read at a time.
+
+    Returns:
+        dict: The report saved as subset.json, with the number of playlists
+            and tracks and the playlists per stratum in the full data and the
+            subset.
+    """
+    assert isinstance(data_path, str) and isinstance(new_path, str)
+    assert 0 < frac <= 1
+    os.makedirs(new_path, exist_ok=True)
+    sampler = StratifiedSampler(frac, N_STRATA, seed)
+
+    # playlists: draw, and mark the pids and tracks to keep
+    drawn_chunks, pid_chunks = [], []
+    kept_tracks = np.zeros(0, dtype=bool)
+    with stage("playlists"):
+        for chunk in tqdm(pd.read_csv(pre_processed_table_path(data_path, PLAYLISTS_DF_FILENAME), chunksize=chunksize),
+                          desc="Sampling playlists"):
+            chunk = chunk[sampler.draw(playlist_strata(chunk))]
+            track_ids, lengths = playlist_track_ids(chunk, desc="Parsing tracks", chunksize=len(chunk) or 1)
+            if len(track_ids) and track_ids.max() >= len(kept_tracks):
+                kept_tracks = np.concatenate((kept_tracks, np.zeros(track_ids.max() + 1 - len(kept_tracks), dtype=bool)))
+            kept_tracks[track_ids] = True
+            drawn_chunks.append((chunk, track_ids, lengths))
+            pid_chunks.append(chunk["pid"].to_numpy(dtype=np.int64))
+
+    # dense ids, in the order of the old ones
+    old_pids = np.concatenate(pid_chunks) if pid_chunks else np.zeros(0, dtype=np.int64)
+    new_pid = np.full(old_pids.max() + 1 if len(old_pids) else 0, -1, dtype=np.int64)
+    new_pid[old_pids] = np.arange(len(old_pids))
+    new_track_id = np.cumsum(kept_tracks) - 1
+
+    with stage("write"):
+        playlists = []
+        for chunk, track_ids, lengths in drawn_chunks:
+            chunk = chunk.copy()
+            chunk["pid"] = new_pid[chunk["pid"].to_numpy()]
+            chunk["tracks"] = _format_track_lists(new_track_id[track_ids], lengths)
+            playlists.append(chunk)
+        if playlists:
+            pd.concat(playlists, ignore_index=True).to_csv(os.path.join(new_path, PLAYLISTS_DF_FILENAME), index=False)
+    del drawn_chunks, playlists
+
+    def stream(source, filename, select, desc=None):
+        # filter a CSV chunk by chunk into the subset
+        output = os.path.join(new_path, filename)
+        header = True
+        for chunk in tqdm(pd.read_csv(source, chunksize=chunksize), desc=desc, disable=desc is None):
+            select(chunk).to_csv(output, mode="w" if header else "a", header=header, index=False)
+            header = False
+
+    def select_relations(chunk):
+        pids = chunk["pid"].to_numpy()
+        known = pids < len(new_pid)
+        keep = np.zeros(len(chunk), dtype=bool)
+        keep[known] = new_pid[pids[known]] >= 0
+        chunk = chunk[keep]
+        return chunk.assign(track_id=new_track_id[chunk["track_id"].to_numpy()],
+                            pid=new_pid[chunk["pid"].to_numpy()])
+
+    def select_tracks(chunk):
+        ids = chunk["track_id"].to_numpy()
+        keep = np.zeros(len(chunk), dtype=bool)
+        known = ids < len(kept_tracks)
+        keep[known] = kept_tracks[ids[known]]
+        chunk = chunk[keep]
+        return chunk.assign(track_id=new_track_id[chunk["track_id"].to_numpy()])
+
+    with stage("relations"):
+        stream(pre_processed_table_path(data_path, PLAYLIST_TRACKS_DF_FILENAME), PLAYLIST_TRACKS_DF_FILENAME,
+               select_relations, "Filtering relations")
+    with stage("tracks"):
+        stream(pre_processed_table_path(data_path, TRACKS_DF_FILENAME), TRACKS_DF_FILENAME, select_tracks,
+               "Filtering tracks")
+
+    if audio_features is not None:
+        with stage("audio_features"):
+            # the features are keyed by the Spotify id of the tracks
+            ids = set(spotify_ids(pd.read_csv(os.path.join(new_path, TRACKS_DF_FILENAME),
+                                              usecols=["track_uri"])["track_uri"]).tolist())
+            stream(audio_features, os.path.basename(audio_features),
+                   lambda chunk: chunk[chunk["id"].isin(ids)])
+
+    report = {"source": os.path.abspath(data_path), "frac": frac, "seed": seed,
+              "playlists": int(sampler.drawn.sum()), "source_playlists": int(sampler.seen.sum()),
+              "tracks": int(kept_tracks.sum()),
+              "strata": {"source": sampler.seen.tolist(), "subset": sampler.drawn.tolist()}}
+    with open(os.path.join(new_path, SUBSET_REPORT_FILENAME), "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Write a stratified development subset of the pre-processed data.")
+    parser.add_argument("input_data", type=str, help="Path to the directory of the pre-processed data.")
+    parser.add_argument("output", type=str, help="Path to the directory of the subset.")
+    parser.add_argument("--frac", type=float, default=0.01, help="The fraction of the playlists to draw.")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the draw.")
+    parser.add_argument("--audio_features", type=str, default=None, help="A CSV of track audio features to subset too.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profile_from_args("dev_subset", args):
+        report = sample_pre_processed_data(args.input_data, args.output, args.frac, args.seed, args.audio_features)
+    print(f"Drew {report['playlists']} of {report['source_playlists']} playlists with {report['tracks']} tracks")
@@ -0,0 +1,160 @@
+'''
+Diversity re-ranking of recommendations with maximal marginal relevance
+(MMR) and caps on the songs per artist and per album.
+
+The N most similar tracks are often near duplicates from one artist or
+album. MMR picks the recommendations one at a time, each maximizing
+lambda_ * similarity to the seed - (1 - lambda_) * the largest similarity to
+the picks so far, and skips the candidates whose artist or album already has
+its cap of picks. The picks are made for a batch of seeds at once, on a pool
+of the most similar candidates of every seed, with array operations on
+(seeds, candidates) matrices instead of loops over the candidates.
+'''
+import numpy as np
+import pandas as pd
+
+from compact_features import CompactFeatures, normalize
+
+
+def mmr_rerank(relevance, vectors, N=10, lambda_=0.7, groups=(), caps=(), valid=None):
+    """Pick N diverse candidates for every seed of a batch with MMR.
+
+    Args:
+        relevance (array): The similarity of every seed to its candidates, of
+            shape (seeds, candidates).
+        vectors (array): The unit length vectors of the candidates, of shape
+            (seeds, candidates, dimensions).
+        N (int): The number of candidates to pick per seed.
+        lambda_ (float): The weight of relevance against diversity, 1 keeps
+            the order of relevance.
+        groups (list): Arrays of shape (seeds, candidates) with the group of
+            every candidate, e.g. its artist code, -1 for no group.
+        caps (list): The most picks per group, for each array of groups.
+        valid (array): Which candidates can be picked, of shape (seeds,
+            candidates), all if None.
+
+    Returns:
+        array: The picked candidate positions in order, of shape (seeds, N),
+            padded with -1 when a seed runs out of candidates.
+    """
+    assert 0 <= lambda_ <= 1
+    assert len(groups) == len(caps)
+    relevance = np.asarray(relevance, dtype=np.float32)
+    n_seeds, n_candidates = relevance.shape
+    # the similarity of every pair of candidates of a seed
+    pairwise = np.einsum("bcd,bkd->bck", vectors, vectors) if lambda_ < 1 else None
+
+    available = np.ones_like(relevance, dtype=bool) if valid is None else np.array(valid, dtype=bool)
+    groups = [np.asarray(group) for group in groups]
+    picked_in_group = [np.zeros(relevance.shape, dtype=np.int64) for _ in groups]
+    redundancy = np.zeros_like(relevance)
+    picks = np.full((n_seeds, N), -1, dtype=np.int64)
+    seeds = np.arange(n_seeds)
+    for step in range(min(N, n_candidates)):
+        score = lambda_ * relevance - (1 - lambda_) * redundancy
+        allowed = available.copy()
+        for group, picked, cap in zip(groups, picked_in_group, caps):
+            if cap is not None:
+                allowed &= (picked < cap) | (group < 0)
+        score = np.where(allowed, score, -np.inf)
+        best = score.argmax(axis=1)
+        found = allowed[seeds, best]
+        if not found.any():
+            break
+        picks[found, step] = best[found]
+        rows, best = seeds[found], best[found]
+        available[rows, best] = False
+        for group, picked in zip(groups, picked_in_group):
+            # count the pick for every candidate of the same group
+            picked[rows] += (group[rows] == group[rows, best][:, None]) & (group[rows] >= 0)
+        if pairwise is not None:
+            similar = pairwise[rows, best]
+            redundancy[rows] = similar if step == 0 else np.maximum(redundancy[rows], similar)
+    return picks
+
+
+def _codes(labels):
+    """Factorize labels into integer codes, with -1 for missing labels."""
+    return pd.factorize(labels)[0]
+
+
+def diversify(relevance, features, N=10, artists=None, albums=None, lambda_=0.7,
+              max_per_artist=None, max_per_album=None, pool=None):
+    """Re-rank the candidates of one seed for diversity.
+
+    Args:
+        relevance (array): The similarity of the seed to every candidate.
+        features (array): The feature vectors of the candidates.
+        N (int): The number of candidates to pick.
+        artists (array): The artist of every candidate, no artist cap if None.
+        albums (array): The album of every candidate, no album cap if None.
+        lambda_ (float): The weight of relevance against diversity.
+        max_per_artist (int): The most picks per artist.
+        max_per_album (int): The most picks per album.
+        pool (int): Only the pool most similar candidates are re-ranked,
+            max(4 * N, 50) if None.
+
+    Returns:
+        array: The positions of the picked candidates, most relevant first.
+    """
+    relevance = np.asarray(relevance, dtype=np.float32)
+    pool = min(len(relevance), pool or max(4 * N, 50))
+    if pool == 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-relevance, pool - 1)[:pool]
+    top = top[np.argsort(-relevance[top], kind="stable")]
+
+    groups, caps = [], []
+    for labels, cap in ((artists, max_per_artist), (albums, max_per_album)):
+        if labels is not None and cap is not None:
+            groups.append(_codes(np.asarray(labels)[top])[None])
+            caps.append(cap)
+    picks = mmr_rerank(relevance[top][None], normalize(np.asarray(features)[top])[None], N,
+                       lambda_, groups, caps)[0]
+    return top[picks[picks >= 0]]
+
+
+def diverse_top_n(features, query_rows, N=10, artist_codes=None, album_codes=None, lambda_=0.7,
+                  max_per_artist=None, max_per_album=None, pool=None, candidate_rows=None,
+                  standardized=True):
+    """Get N diverse similar rows for a batch of query rows.
+
+    Args:
+        features (CompactFeatures): The track features or embeddings.
+        query_rows (array): The rows of the seeds.
+        N (int): The number of rows per seed.
+        artist_codes (array): The artist code of every row of features.
+        album_codes (array): The album code of every row of features.
+        lambda_ (float): The weight of relevance against diversity.
+        max_per_artist (int): The most picks per artist.
+        max_per_album (int): The most picks per album.
+        pool (int): The number of most similar rows re-ranked per seed,
+            max(4 * N, 50) if None.
+        candidate_rows (array): The candidate rows, all rows if None.
+        standardized (bool): Whether to compare standardized values.
+
+    Returns:
+        array: The picked rows of shape (seeds, N), padded with -1.
+    """
+    assert isinstance(features, CompactFeatures)
+    query_rows = np.atleast_1d(np.asarray(query_rows, dtype=np.int64))
+    candidate_rows = np.arange(len(features)) if candidate_rows is None else np.asarray(candidate_rows)
+    similarity = features.cosine_similarity(query_rows, candidate_rows, standardized)
+    # a seed is not its own recommendation
+    similarity[candidate_rows[None, :] == query_rows[:, None]] = -np.inf
+    pool = min(len(candidate_rows), pool or max(4 * N, 50))
+    if pool == 0:
+        return np.full((len(query_rows), N), -1, dtype=np.int64)
+
+    top = np.argpartition(-similarity, pool - 1, axis=1)[:, :pool]
+    relevance = np.take_along_axis(similarity, top, axis=1)
+    pool_rows = candidate_rows[top]
+    vectors = normalize(features.dequantize(pool_rows.ravel(), standardized)).reshape(*pool_rows.shape, -1)
+
+    groups, caps = [], []
+    for codes, cap in ((artist_codes, max_per_artist), (album_codes, max_per_album)):
+        if codes is not None and cap is not None:
+            groups.append(np.asarray(codes)[pool_rows])
+            caps.append(cap)
+    picks = mmr_rerank(relevance, vectors, N, lambda_, groups, caps, valid=np.isfinite(relevance))
+    return np.where(picks >= 0, np.take_along_axis(pool_rows, np.maximum(picks, 0), axis=1), -1)
@@ -0,0 +1,286 @@
+'''
+Dense track and playlist embeddings learned from the playlist/track relations
+with implicit alternating least squares (Hu, Koren and Volinsky), where the
+least squares problems are solved approximately with a few conjugate gradient
+steps (Takacs, Pilaszy and Tikk).
+
+Every track in a playlist is an observation with confidence
+1 + alpha * count. The conjugate gradient steps of all the playlists (or
+tracks) in a block are computed together with sparse CSR products and dense
+BLAS products, and the blocks run in a thread pool. The factors are
+checkpointed after every iteration so that an interrupted training resumes.
+
+The track embeddings are served as CompactFeatures, the same similarity
+index as the quantized audio features, and recommend_for_playlists scores
+all the tracks for batches of playlists. Run
+`python embeddings.py [pre-processed data dir]` to train them.
+'''
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from pre_processing import (read_pre_processed_table, relation_multiplicity, TRACKS_DF_FILENAME,
+                            PLAYLIST_TRACKS_DF_FILENAME)
+from compact_features import CompactFeatures
+from indexes import spotify_ids
+from profiling import stage, add_profile_arguments, profile_from_args
+
+EMBEDDINGS_PATH = "../data/track_embeddings.npz"
+
+
+def interaction_matrix(playlist_tracks_df, n_playlists=None, n_tracks=None):
+    """Get the playlist x track matrix of the number of times a track is in a
+    playlist.
+
+    Args:
+        playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
+            associations.
+        n_playlists (int): The number of pids, defaults to the largest pid + 1.
+        n_tracks (int): The number of track ids, defaults to the largest
+            track_id + 1.
+
+    Returns:
+        csr_matrix: The (n_playlists, n_tracks) counts.
+    """
+    assert isinstance(playlist_tracks_df, pd.DataFrame)
+    pids = playlist_tracks_df["pid"].to_numpy(dtype=np.int64)
+    track_ids = playlist_tracks_df["track_id"].to_numpy(dtype=np.int64)
+    n_playlists = int(pids.max()) + 1 if n_playlists is None else n_playlists
+    n_tracks = int(track_ids.max()) + 1 if n_tracks is None else n_tracks
+    # duplicate entries are summed, a deduplicated relation counts its multiplicity
+    return sparse.csr_matrix((relation_multiplicity(playlist_tracks_df).astype(np.float32), (pids, track_ids)),
+                             shape=(n_playlists, n_tracks))
+
+
+def _row_blocks(matrix, max_nnz):
+    """Split the rows of a CSR matrix into blocks of at most about max_nnz
+    entries."""
+    n = matrix.shape[0]
+    bounds = np.searchsorted(matrix.indptr, np.arange(max_nnz, matrix.nnz, max_nnz))
+    bounds = np.unique(np.concatenate(([0], bounds, [n])))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _conjugate_gradient_step(confidence, factors, other, gram, alpha, cg_steps):
+    """Improve the factors of a block of rows with conjugate gradient steps.
+
+    Row u solves (G + Y^T (C_u - I) Y) x_u = Y^T C_u p_u where Y are the other
+    factors, G = Y^T Y + regularization * I, C_u the confidences of row u and
+    p_u its binary preferences.
+
+    Args:
+        confidence (csr_matrix): The counts of the block rows.
+        factors (array): The current factors of the block rows, updated in
+            place.
+        other (array): The factors of the other side.
+        gram (array): Y^T Y + regularization * I.
+        alpha (float): The confidence scaling of the counts.
+        cg_steps (int): The number of conjugate gradient steps.
+    """
+    rows = np.repeat(np.arange(confidence.shape[0]), np.diff(confidence.indptr))
+    weights = alpha * confidence.data
+
+    def multiply(vectors):
+        # (G + Y^T (C_u - I) Y) x for every row at once
+        dots = np.einsum("ij,ij->i", vectors[rows], other[confidence.indices])
+        extra = sparse.csr_matrix((weights * dots, confidence.indices, confidence.indptr),
+                                  shape=confidence.shape)
+        return vectors @ gram + extra @ other
+
+    target = sparse.csr_matrix((1 + weights, confidence.indices, confidence.indptr),
+                               shape=confidence.shape) @ other
+    residual = target - multiply(factors)
+    direction = residual.copy()
+    residual_norm = np.einsum("ij,ij->i", residual, residual)
+    for _ in range(cg_steps):
+        product = multiply(direction)
+        curvature = np.einsum("ij,ij->i", direction, product)
+        step = np.divide(residual_norm, curvature, out=np.zeros_like(residual_norm),
+                         where=curvature > 0)
+        factors += step[:, None] * direction
+        residual -= step[:, None] * product
+        new_norm = np.einsum("ij,ij->i", residual, residual)
+        ratio = np.divide(new_norm, residual_norm, out=np.zeros_like(new_norm),
+                          where=residual_norm > 0)
+        direction = residual + ratio[:, None] * direction
+        residual_norm = new_norm
+
+
+def _least_squares(matrix, factors, other, regularization, alpha, cg_steps,
+                   max_nnz, workers):
+    """Update all the factors of one side by blocks of rows."""
+    gram = other.T @ other + regularization * np.eye(other.shape[1], dtype=other.dtype)
+
+    def solve(start, stop):
+        _conjugate_gradient_step(matrix[start:stop], factors[start:stop], other,
+                                 gram, alpha, cg_steps)
+
+    blocks = _row_blocks(matrix, max_nnz)
+    if workers is not None and workers <= 1:
+        for block in blocks:
+            solve(*block)
+    else:
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(lambda block: solve(*block), blocks))
+
+
+def train_als(matrix, factors=64, regularization=0.01, alpha=40.0, iterations=15,
+              cg_steps=3, seed=0, checkpoint_path=None, max_nnz=2000000,
+              workers=None):
+    """Learn playlist and track embeddings with implicit ALS.
+
+    Args:
+        matrix (csr_matrix): The playlist x track counts from
+            interaction_matrix.
+        factors (int): The embedding dimension.
+        regularization (float): The L2 regularization of the factors.
+        alpha (float): The confidence scaling of the counts.
+        iterations (int): The number of alternating iterations.
+        cg_steps (int): The conjugate gradient steps per least squares update.
+        seed (int): The seed of the initial factors.
+        checkpoint_path (str): A .npz file the factors are saved to after
+            every iteration, and resumed from if it exists.
+        max_nnz (int): The approximate number of relations per block, which
+            bounds the memory of a block to a few times max_nnz * factors.
+        workers (int): The number of threads, 1 to run serially.
+
+    Returns:
+        A tuple of the playlist factors of shape (n_playlists, factors) and the
+        track factors of shape (n_tracks, factors).
+    """
+    matrix = sparse.csr_matrix(matrix, dtype=np.float32)
+    transposed = matrix.T.tocsr()
+    n_playlists, n_tracks = matrix.shape
+
+    start = 0
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        with np.load(checkpoint_path) as checkpoint:
+            playlist_factors = checkpoint["playlist_factors"]
+            track_factors = checkpoint["track_factors"]
+            start = int(checkpoint["iteration"])
+        assert playlist_factors.shape == (n_playlists, factors), "checkpoint of another matrix"
+        assert track_factors.shape == (n_tracks, factors), "checkpoint of another matrix"
+    else:
+        rng = np.random.default_rng(seed)
+        playlist_factors = (rng.standard_normal((n_playlists, factors)) * 0.01).astype(np.float32)
+        track_factors = (rng.standard_normal((n_tracks, factors)) * 0.01).astype(np.float32)
+
+    for iteration in range(start, iterations):
+        with stage("als"):
+            _least_squares(matrix, playlist_factors, track_factors, regularization,
+                           alpha, cg_steps, max_nnz, workers)
+            _least_squares(transposed, track_factors, playlist_factors, regularization,
+                           alpha, cg_steps, max_nnz, workers)
+        if checkpoint_path is not None:
+            with stage("write"):
+                # write then rename so an interruption never leaves a broken file
+                partial = checkpoint_path + ".partial.npz"
+                np.savez(partial, playlist_factors=playlist_factors,
+                         track_factors=track_factors, iteration=iteration + 1)
+                os.replace(partial, checkpoint_path)
+    return playlist_factors, track_factors
+
+
+def recommend_for_playlists(playlist_factors, track_factors, pids, N=10,
+                            matrix=None, chunksize=1000):
+    """Get the N highest scoring tracks of several playlists.
+
+    Args:
+        playlist_factors (array): The playlist embeddings.
+        track_factors (array): The track embeddings.
+        pids (array): The playlists to recommend for.
+        N (int): The number of tracks per playlist.
+        matrix (csr_matrix): The playlist x track counts, to exclude the
+            tracks already in the playlists.
+        chunksize (int): The number of playlists scored at a time.
+
+    Returns:
+        array: The track ids of shape (len(pids), N), best first.
+    """
+    pids = np.asarray(pids, dtype=np.int64)
+    N = min(N, track_factors.shape[0])
+    recommended = np.empty((len(pids), N), dtype=np.int64)
+    for start in range(0, len(pids), chunksize):
+        chunk = pids[start:start + chunksize]
+        scores = playlist_factors[chunk] @ track_factors.T
+        if matrix is not None:
+            seen = matrix[chunk]
+            rows = np.repeat(np.arange(len(chunk)), np.diff(seen.indptr))
+            scores[rows, seen.indices] = -np.inf
+        top = np.argpartition(-scores, N - 1, axis=1)[:, :N]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+        recommended[start:start + len(chunk)] = np.take_along_axis(top, order, axis=1)
+    return recommended
+
+
+def save_embeddings(path, tracks_df, playlist_factors, track_factors):
+    """Save the embeddings with the Spotify ids of the tracks.
+
+    Args:
+        path (str): The .npz file.
+        tracks_df (DataFrame): A DataFrame of the unique tracks data.
+        playlist_factors (array): The playlist embeddings, row pid.
+        track_factors (array): The track embeddings, row track_id.
+    """
+    assert isinstance(tracks_df, pd.DataFrame)
+    ids = np.full(len(track_factors), "", dtype=object)
+    ids[tracks_df["track_id"].to_numpy()] = spotify_ids(tracks_df["track_uri"]).to_numpy()
+    ids = ids.astype(np.bytes_)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with stage("write"):
+        np.savez(path, ids=ids, playlist_factors=playlist_factors, track_factors=track_factors)
+
+
+def load_track_embeddings(path=EMBEDDINGS_PATH, dtype="float16"):
+    """Load the track embeddings as a similarity index.
+
+    Compare them with standardized=False, which is the cosine similarity of
+    the embeddings themselves.
+
+    Args:
+        path (str): The .npz file written by save_embeddings.
+        dtype (str): One of compact_features.QUANTIZED_DTYPES.
+
+    Returns:
+        CompactFeatures: The embeddings of the tracks, rows in track_id order
+            without the ids no track has.
+    """
+    with stage("load"):
+        with np.load(path) as saved:
+            ids, track_factors = saved["ids"], saved["track_factors"]
+    known = ids != b""
+    columns = [f"e{i}" for i in range(track_factors.shape[1])]
+    frame = pd.DataFrame(track_factors[known], columns=columns)
+    frame.insert(0, "id", ids[known])
+    return CompactFeatures.from_frame(frame, columns, dtype)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Train implicit ALS track and playlist embeddings.")
+    parser.add_argument("input_data", type=str, help="Path to the directory of the pre-processed data.")
+    parser.add_argument("--output", type=str, default=EMBEDDINGS_PATH, help="The .npz file to save the embeddings to.")
+    parser.add_argument("--checkpoint", type=str, default=None, help="A .npz file to checkpoint to and resume from.")
+    parser.add_argument("--factors", type=int, default=64, help="The embedding dimension.")
+    parser.add_argument("--iterations", type=int, default=15, help="The number of ALS iterations.")
+    parser.add_argument("--regularization", type=float, default=0.01, help="The L2 regularization.")
+    parser.add_argument("--alpha", type=float, default=40.0, help="The confidence scaling of the counts.")
+    parser.add_argument("--cg_steps", type=int, default=3, help="The conjugate gradient steps per update.")
+    parser.add_argument("--workers", type=int, default=None, help="The number of threads, 1 to run serially.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profile_from_args("embeddings", args):
+        tracks_df = read_pre_processed_table(args.input_data, TRACKS_DF_FILENAME)
+        playlist_tracks_df = read_pre_processed_table(args.input_data, PLAYLIST_TRACKS_DF_FILENAME)
+        matrix = interaction_matrix(playlist_tracks_df, n_tracks=int(tracks_df["track_id"].max()) + 1)
+        playlist_factors, track_factors = train_als(
+            matrix, factors=args.factors, regularization=args.regularization,
+            alpha=args.alpha, iterations=args.iterations, cg_steps=args.cg_steps,
+            checkpoint_path=args.checkpoint, workers=args.workers)
+        save_embeddings(args.output, tracks_df, playlist_factors, track_factors)
@@ -0,0 +1,216 @@
+'''
+Bulk enrichment of the artists and albums of the tracks with their Spotify
+metadata (popularity, followers, genres, release date, label, ...).
+
+The unique artist and album URIs of tracks_df are packed into the largest
+batches the API accepts (50 artists or 20 albums per request) and the
+batches are fetched concurrently over one shared spotipy client. Every
+fetched batch is appended to a JSON lines file per URI type in a local
+metadata directory, so an interrupted job resumes with the URIs that are
+not stored yet. Failed batches are not stored and are retried by the next
+run.
+
+Run `python enrichment.py [pre-processed data dir]` to enrich all the
+artists and albums. Pass `--prefix http://localhost:8000/v1/ --token test`
+to run the job against a local mock of the API.
+'''
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+
+import pandas as pd
+import requests
+import spotipy
+from tqdm import tqdm
+
+from pre_processing import read_pre_processed_table, TRACKS_DF_FILENAME
+from profiling import stage, add_profile_arguments, profile_from_args
+from utils import get_spotipy_client
+
+METADATA_PATH = "../data/metadata"
+
+# the most URIs of a type the Spotify API accepts in one request
+BATCH_SIZES = {"artist": 50, "album": 20}
+
+# the fields kept from the API objects, followers is the total count
+METADATA_FIELDS = {
+    "artist": ("name", "popularity", "followers", "genres"),
+    "album": ("name", "album_type", "release_date", "release_date_precision", "label",
+              "popularity", "total_tracks"),
+}
+
+
+class MetadataStore:
+    '''The fetched metadata of one URI type, appended to a JSON lines file.'''
+
+    def __init__(self, path, uri_type):
+        '''
+        Args:
+            path (str): The directory of the metadata files.
+            uri_type (str): "artist" or "album".
+        '''
+        assert uri_type in BATCH_SIZES
+        os.makedirs(path, exist_ok=True)
+        self.filename = os.path.join(path, f"{uri_type}s.jsonl")
+        self.uri_type = uri_type
+        self.uris = set()
+        if os.path.isfile(self.filename):
+            for record in self._records():
+                self.uris.add(record["uri"])
+
+    def _records(self):
+        """Read the stored records, skipping a line cut off by an interrupted
+        write."""
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def __contains__(self, uri):
+        return uri in self.uris
+
+    def __len__(self):
+        return len(self.uris)
+
+    def add(self, records):
+        """Append records and flush them to disk.
+
+        Args:
+            records (list): Dictionaries with a "uri" key.
+        """
+        with open(self.filename, "a") as f:
+            # start on a new line if the last write was cut off
+            if f.tell() > 0:
+                with open(self.filename, "rb") as last:
+                    last.seek(-1, os.SEEK_END)
+                    if last.read(1) != b"\n":
+                        f.write("\n")
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        self.uris.update(record["uri"] for record in records)
+
+    def to_frame(self):
+        """Get the stored metadata.
+
+        Returns:
+            A DataFrame with one row per URI, the last record of a URI wins.
+        """
+        df = pd.DataFrame(list(self._records()), columns=["uri", "found", *METADATA_FIELDS[self.uri_type]])
+        return df.drop_duplicates("uri", keep="last").reset_index(drop=True)
+
+
+def unique_uris(tracks_df, uri_type):
+    """Get the unique artist or album URIs of the tracks.
+
+    Args:
+        tracks_df (DataFrame): A DataFrame of the unique tracks data.
+        uri_type (str): "artist" or "album".
+
+    Returns:
+        list: The URIs in order of first appearance.
+    """
+    assert isinstance(tracks_df, pd.DataFrame)
+    assert uri_type in BATCH_SIZES
+    return tracks_df[f"{uri_type}_uri"].dropna().drop_duplicates().tolist()
+
+
+def metadata_record(uri, info, uri_type):
+    """Keep the metadata fields of an API object.
+
+    Args:
+        uri (str): The requested URI.
+        info (dict): The API object, None if the URI is unknown.
+        uri_type (str): "artist" or "album".
+
+    Returns:
+        dict: The record to store.
+    """
+    if info is None:
+        return {"uri": uri, "found": False}
+    record = {"uri": uri, "found": True}
+    for field in METADATA_FIELDS[uri_type]:
+        value = info.get(field)
+        record[field] = value["total"] if field == "followers" and value else value
+    return record
+
+
+def fetch_batch(sp, uris, uri_type):
+    """Fetch the metadata of one batch of URIs.
+
+    Args:
+        sp: The spotipy client.
+        uris (list): At most BATCH_SIZES[uri_type] URIs.
+        uri_type (str): "artist" or "album".
+
+    Returns:
+        list: The records of the URIs, in order.
+    """
+    assert len(uris) <= BATCH_SIZES[uri_type]
+    fetch = sp.artists if uri_type == "artist" else sp.albums
+    infos = fetch(uris)[uri_type + "s"]
+    return [metadata_record(uri, info, uri_type) for uri, info in zip(uris, infos)]
+
+
+def enrich(tracks_df, uri_type, store, sp=None, workers=8):
+    """Fetch and store the metadata of the artists or albums of the tracks
+    that are not in the store yet.
+
+    Args:
+        tracks_df (DataFrame): A DataFrame of the unique tracks data.
+        uri_type (str): "artist" or "album".
+        store (MetadataStore): The store of uri_type.
+        sp: The spotipy client, get_spotipy_client() if None. It is shared
+            by the workers.
+        workers (int): The number of concurrent requests. Keep it at most 10,
+            the connection pool size of the client session.
+
+    Returns:
+        dict: The number of URIs fetched, skipped because they were stored
+            and failed.
+    """
+    assert isinstance(store, MetadataStore) and store.uri_type == uri_type
+    assert isinstance(workers, int) and workers > 0
+    if sp is None:
+        sp = get_spotipy_client()
+
+    uris = unique_uris(tracks_df, uri_type)
+    pending = [uri for uri in uris if uri not in store]
+    size = BATCH_SIZES[uri_type]
+    batches = [pending[i:i + size] for i in range(0, len(pending), size)]
+
+    fetched = failed = 0
+    with stage("api_fetch"), ThreadPoolExecutor(workers) as pool:
+        futures = {pool.submit(fetch_batch, sp, batch, uri_type): batch for batch in batches}
+        for future in tqdm(as_completed(futures), total=len(futures), desc=f"{uri_type}s"):
+            try:
+                records = future.result()
+            except (spotipy.exceptions.SpotifyException, requests.exceptions.RequestException) as e:
+                print(f"Error fetching {uri_type} batch: {e}")
+                failed += len(futures[future])
+                continue
+            # only the main thread writes to the store
+            store.add(records)
+            fetched += len(records)
+    return {"fetched": fetched, "skipped": len(uris) - len(pending), "failed": failed}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Fetch the Spotify metadata of the artists and albums of the tracks.")
+    parser.add_argument("input_data", type=str, help="Path to the directory of the pre-processed data.")
+    parser.add_argument("--output", type=str, default=METADATA_PATH, help="The directory of the metadata store.")
+    parser.add_argument("--types", nargs="+", choices=tuple(BATCH_SIZES), default=list(BATCH_SIZES), help="The URI types to enrich.")
+    parser.add_argument("--workers", type=int, default=8, help="The number of concurrent requests.")
+    parser.add_argument("--prefix", type=str, default=None, help="The base URL of the API, e.g. of a local mock server.")
+    parser.add_argument("--token", type=str, default=None, help="An access token to use instead of the .env credentials.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profile_from_args("enrichment", args):
+        tracks_df = read_pre_processed_table(args.input_data, TRACKS_DF_FILENAME)
+        sp = get_spotipy_client(prefix=args.prefix, token=args.token)
+        for uri_type in args.types:
+            store = MetadataStore(args.output, uri_type)
+            print(uri_type, enrich(tracks_df, uri_type, store, sp, args.workers))
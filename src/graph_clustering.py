@@ -0,0 +1,249 @@
+'''
+Cluster the tracks (or the artists) by how they co-occur in playlists, as an
+alternative to the K-means clusters of the audio features.
+
+The co-occurrence graph is the sparse matrix B.T @ B of the binary
+playlist x track matrix B, summed over chunks of playlists, and the
+communities are found by label propagation: every node repeatedly takes the
+label with the largest total edge weight among its neighbours. Both steps
+are sparse matrix operations over blocks of rows that run in a thread pool,
+as NumPy and SciPy release the GIL for most of the array work.
+
+The assignment is saved with the same id and cluster columns as
+tracks_cluster.csv, so recommend_track.get_recommendation_from_cluster can
+use it directly. Run
+`python graph_clustering.py [pre-processed data dir]` to create it.
+'''
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from pre_processing import (read_pre_processed_table, TRACKS_DF_FILENAME,
+                            PLAYLIST_TRACKS_DF_FILENAME)
+from indexes import spotify_ids
+from profiling import stage, add_profile_arguments, profile_from_args
+
+GRAPH_LEVELS = ("track", "artist")
+GRAPH_CLUSTER_PATH = "../data/tracks_graph_cluster.csv"
+
+
+def _blocks(n, chunksize):
+    """Get the (start, stop) bounds of consecutive blocks of n items."""
+    return [(start, min(start + chunksize, n)) for start in range(0, n, chunksize)]
+
+
+def _map_blocks(function, blocks, workers):
+    """Apply a function to every block, in a thread pool if workers > 1."""
+    if workers is not None and workers <= 1:
+        return [function(*block) for block in blocks]
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(lambda block: function(*block), blocks))
+
+
+def cooccurrence_matrix(pids, nodes, n_nodes, min_count=2, chunksize=10000,
+                        workers=None, merge_blocks=None):
+    """Get the weighted co-occurrence graph of nodes in playlists.
+
+    The block products are summed in groups of merge_blocks, and every group
+    sum is added to the running total, so the memory holds the distinct
+    pairs of the total and the pairs of one group of blocks at a time.
+
+    Args:
+        pids (array): The pid of each playlist/node relation.
+        nodes (array): The node (track or artist code) of each relation.
+        n_nodes (int): The number of nodes.
+        min_count (int): The minimum number of playlists two nodes share for
+            them to be connected.
+        chunksize (int): The number of playlists multiplied at a time.
+        workers (int): The number of threads, 1 to run serially.
+        merge_blocks (int): The number of block products summed before they
+            are added to the total, 4 per thread if None.
+
+    Returns:
+        csr_matrix: The symmetric (n_nodes, n_nodes) matrix of the number of
+            playlists every pair of nodes shares, without self loops.
+    """
+    pids = np.asarray(pids, dtype=np.int64)
+    nodes = np.asarray(nodes, dtype=np.int64)
+    assert pids.shape == nodes.shape
+    n_playlists = int(pids.max()) + 1 if len(pids) else 0
+    merge_blocks = merge_blocks or 4 * (workers or os.cpu_count() or 1)
+    assert merge_blocks > 0
+    # a node counts once per playlist
+    incidence = sparse.csr_matrix((np.ones(len(pids), dtype=np.float32), (pids, nodes)),
+                                  shape=(n_playlists, n_nodes))
+    incidence.data[:] = 1
+
+    def multiply(start, stop):
+        block = incidence[start:stop]
+        # the matrix is symmetric, keep the pairs above the diagonal
+        return sparse.triu(block.T @ block, k=1, format="coo")
+
+    with stage("cooccurrence"):
+        upper = sparse.csr_matrix((n_nodes, n_nodes), dtype=np.float32)
+        blocks = _blocks(n_playlists, chunksize)
+        for first in range(0, len(blocks), merge_blocks):
+            products = _map_blocks(multiply, blocks[first:first + merge_blocks], workers)
+            # the conversion to CSR sums the duplicate pairs of the group
+            group = sparse.coo_matrix((np.concatenate([product.data for product in products]),
+                                       (np.concatenate([product.row for product in products]),
+                                        np.concatenate([product.col for product in products]))),
+                                      shape=(n_nodes, n_nodes)).tocsr()
+            del products
+            upper = upper + group
+        upper.data[upper.data < min_count] = 0
+        upper.eliminate_zeros()
+        adjacency = (upper + upper.T).tocsr()
+    return adjacency
+
+
+def label_propagation(adjacency, max_iter=30, tol=1e-3, update_frac=0.5,
+                      seed=0, chunksize=100000, workers=None):
+    """Find communities of a weighted graph by label propagation.
+
+    Every iteration computes the heaviest neighbouring label of every node
+    and a random update_frac of the nodes adopt it. Updating only part of the
+    nodes keeps the synchronous updates from oscillating between two
+    labelings. A node keeps its label on ties.
+
+    Args:
+        adjacency (csr_matrix): The symmetric weighted adjacency matrix.
+        max_iter (int): The maximum number of iterations.
+        tol (float): Stop when less than this fraction of the nodes would
+            change label.
+        update_frac (float): The fraction of the nodes updated per iteration.
+        seed (int): The seed of the random updates.
+        chunksize (int): The number of nodes processed per block.
+        workers (int): The number of threads, 1 to run serially.
+
+    Returns:
+        array: The community of every node, numbered from 0 by decreasing
+            size.
+    """
+    adjacency = sparse.csr_matrix(adjacency)
+    n = adjacency.shape[0]
+    labels = np.arange(n)
+    rng = np.random.default_rng(seed)
+
+    def propagate(start, stop):
+        block = adjacency[start:stop]
+        rows = np.repeat(np.arange(stop - start), np.diff(block.indptr))
+        # the own label gets a tiny vote so that ties keep it
+        votes = sparse.csr_matrix(
+            (np.concatenate((block.data, np.full(stop - start, 1e-6, dtype=block.dtype))),
+             (np.concatenate((rows, np.arange(stop - start))),
+              np.concatenate((labels[block.indices], labels[start:stop])))),
+            shape=(stop - start, n))
+        votes.sum_duplicates()
+        # every row has at least the own vote, take its first heaviest label
+        counts = np.diff(votes.indptr)
+        heaviest = np.maximum.reduceat(votes.data, votes.indptr[:-1])
+        positions = np.flatnonzero(votes.data == np.repeat(heaviest, counts))
+        position_rows = np.repeat(np.arange(stop - start), counts)[positions]
+        first = np.ones(len(positions), dtype=bool)
+        first[1:] = position_rows[1:] != position_rows[:-1]
+        return votes.indices[positions[first]]
+
+    with stage("label_propagation"):
+        for _ in range(max_iter):
+            proposed = np.concatenate(_map_blocks(propagate, _blocks(n, chunksize), workers)) \
+                if n else labels
+            changed = proposed != labels
+            if changed.sum() < tol * n:
+                labels = proposed
+                break
+            update = changed & (rng.random(n) < update_frac)
+            labels = np.where(update, proposed, labels)
+
+    # renumber by decreasing community size
+    _, labels, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+    order = np.argsort(-sizes, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return rank[labels]
+
+
+def cluster_tracks_by_cooccurrence(tracks_df, playlist_tracks_df, level="track",
+                                   min_count=2, max_iter=30, seed=0, workers=None):
+    """Cluster the tracks with label propagation on the playlist co-occurrence
+    graph.
+
+    Args:
+        tracks_df (DataFrame): A DataFrame of the unique tracks data.
+        playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
+            associations.
+        level (str): One of GRAPH_LEVELS, "artist" clusters the artists and
+            gives every track the cluster of its artist.
+        min_count (int): The minimum number of shared playlists of an edge.
+        max_iter (int): The maximum number of label propagation iterations.
+        seed (int): The seed of the label propagation.
+        workers (int): The number of threads, 1 to run serially.
+
+    Returns:
+        A DataFrame of the tracks and their clusters, with the id and cluster
+        columns of tracks_cluster.csv.
+    """
+    assert isinstance(tracks_df, pd.DataFrame)
+    assert isinstance(playlist_tracks_df, pd.DataFrame)
+    assert level in GRAPH_LEVELS
+    track_ids = tracks_df["track_id"].to_numpy(dtype=np.int64)
+    n_tracks = int(track_ids.max()) + 1 if len(track_ids) else 0
+    # node of every track id
+    if level == "track":
+        node_of = np.arange(n_tracks)
+        n_nodes = n_tracks
+    else:
+        codes, artists = pd.factorize(tracks_df["artist_uri"])
+        node_of = np.zeros(n_tracks, dtype=np.int64)
+        node_of[track_ids] = codes
+        n_nodes = len(artists)
+
+    nodes = node_of[playlist_tracks_df["track_id"].to_numpy(dtype=np.int64)]
+    adjacency = cooccurrence_matrix(playlist_tracks_df["pid"].to_numpy(), nodes, n_nodes,
+                                    min_count=min_count, workers=workers)
+    communities = label_propagation(adjacency, max_iter=max_iter, seed=seed, workers=workers)
+    ids = tracks_df["id"] if "id" in tracks_df.columns else spotify_ids(tracks_df["track_uri"])
+    return pd.DataFrame({"id": ids.to_numpy(), "cluster": communities[node_of[track_ids]]})
+
+
+def save_graph_clusters(cluster_tracks_df, path=GRAPH_CLUSTER_PATH):
+    """Save a cluster assignment like tracks_cluster.csv.
+
+    Args:
+        cluster_tracks_df (DataFrame): A DataFrame of the tracks and their
+            clusters.
+        path (str): The CSV file.
+    """
+    assert isinstance(cluster_tracks_df, pd.DataFrame)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with stage("write"):
+        cluster_tracks_df[["id", "cluster"]].to_csv(path, index=False)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Cluster the tracks on the playlist co-occurrence graph.")
+    parser.add_argument("input_data", type=str, help="Path to the directory of the pre-processed data.")
+    parser.add_argument("--output", type=str, default=GRAPH_CLUSTER_PATH, help="The CSV to save the clusters to.")
+    parser.add_argument("--level", choices=GRAPH_LEVELS, default="track", help="Cluster the tracks or their artists.")
+    parser.add_argument("--min_count", type=int, default=2, help="The minimum number of shared playlists of an edge.")
+    parser.add_argument("--max_iter", type=int, default=30, help="The maximum number of label propagation iterations.")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the label propagation.")
+    parser.add_argument("--workers", type=int, default=None, help="The number of threads, 1 to run serially.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profile_from_args("graph_clustering", args):
+        tracks_df = read_pre_processed_table(args.input_data, TRACKS_DF_FILENAME)
+        playlist_tracks_df = read_pre_processed_table(args.input_data, PLAYLIST_TRACKS_DF_FILENAME)
+        cluster_tracks_df = cluster_tracks_by_cooccurrence(
+            tracks_df, playlist_tracks_df, level=args.level, min_count=args.min_count,
+            max_iter=args.max_iter, seed=args.seed, workers=args.workers)
+        save_graph_clusters(cluster_tracks_df, args.output)
+    sizes = cluster_tracks_df["cluster"].value_counts()
+    print(f"{len(sizes)} clusters, largest: {sizes.head(10).tolist()}")
@@ -0,0 +1,141 @@
+'''
+Streaming histograms of the audio features.
+
+Every feature has fixed bin edges, so histograms computed over different
+chunks of the tracks, or by different worker processes, can simply be added
+together. This lets the distributions of the whole catalogue be computed in
+one pass without holding the raw values in memory.
+'''
+import numpy as np
+import pandas as pd
+
+# value ranges of the Spotify audio features, values outside are counted in
+# the first or last bin
+AUDIO_FEATURE_RANGES = {
+    "danceability": (0.0, 1.0),
+    "energy": (0.0, 1.0),
+    "loudness": (-60.0, 5.0),
+    "speechiness": (0.0, 1.0),
+    "acousticness": (0.0, 1.0),
+    "instrumentalness": (0.0, 1.0),
+    "liveness": (0.0, 1.0),
+    "valence": (0.0, 1.0),
+    "tempo": (0.0, 250.0),
+    "duration_ms": (0.0, 1200000.0),
+}
+
+
+class HistogramAccumulator:
+    '''Fixed bin histograms of several features that can be updated chunk by
+    chunk and merged with each other.
+    '''
+
+    def __init__(self, features=None, bins=50, ranges=None):
+        '''
+        Args:
+            features (list): The features to accumulate, defaults to all the
+                features in ranges.
+            bins (int): The number of bins of every feature.
+            ranges (dict): Maps a feature to its (low, high) value range,
+                defaults to AUDIO_FEATURE_RANGES.
+        '''
+        ranges = AUDIO_FEATURE_RANGES if ranges is None else ranges
+        features = list(ranges) if features is None else list(features)
+        assert isinstance(bins, int) and bins > 0
+        assert all(feature in ranges for feature in features)
+        self.bins = bins
+        self.ranges = {feature: ranges[feature] for feature in features}
+        self.counts = {feature: np.zeros(bins, dtype=np.int64)
+                       for feature in features}
+
+    @property
+    def features(self):
+        return list(self.counts)
+
+    def edges(self, feature):
+        """Get the bin edges of a feature.
+
+        Args:
+            feature (str): The feature.
+
+        Returns:
+            array: The bins + 1 bin edges.
+        """
+        low, high = self.ranges[feature]
+        return np.linspace(low, high, self.bins + 1)
+
+    def update(self, chunk):
+        """Add a chunk of tracks to the histograms.
+
+        Args:
+            chunk (DataFrame/dict): The feature values of the tracks, missing
+                values are ignored.
+
+        Returns:
+            HistogramAccumulator: self, to allow chaining.
+        """
+        for feature, counts in self.counts.items():
+            values = np.asarray(chunk[feature], dtype=np.float64)
+            values = values[~np.isnan(values)]
+            # same bin assignment as np.histogram, the last bin is closed
+            bin_index = np.searchsorted(self.edges(feature), values,
+                                        side="right") - 1
+            np.clip(bin_index, 0, self.bins - 1, out=bin_index)
+            counts += np.bincount(bin_index, minlength=self.bins)
+        return self
+
+    def merge(self, other):
+        """Add the counts of another accumulator with the same bins.
+
+        Args:
+            other (HistogramAccumulator): The accumulator to merge in.
+
+        Returns:
+            HistogramAccumulator: self, to allow chaining.
+        """
+        assert isinstance(other, HistogramAccumulator)
+        assert self.bins == other.bins and self.ranges == other.ranges
+        for feature, counts in self.counts.items():
+            counts += other.counts[feature]
+        return self
+
+    def total(self, feature):
+        """Get the number of values accumulated for a feature."""
+        return int(self.counts[feature].sum())
+
+    def density(self, feature):
+        """Get the probability density of a feature, which integrates to 1
+        over its bins like np.histogram(..., density=True).
+
+        Args:
+            feature (str): The feature.
+
+        Returns:
+            array: The density of each bin.
+        """
+        counts = self.counts[feature]
+        total = counts.sum()
+        if total == 0:
+            return np.zeros(self.bins)
+        return counts / (total * np.diff(self.edges(feature)))
+
+
+def accumulate_csv(filename, features=None, bins=50, chunksize=100000,
+                   ranges=None):
+    """Accumulate the histograms of the features in a CSV file chunk by chunk.
+
+    Args:
+        filename (str): A CSV file with a column per feature.
+        features (list): The features to accumulate.
+        bins (int): The number of bins of every feature.
+        chunksize (int): The number of rows read at a time.
+        ranges (dict): Maps a feature to its (low, high) value range.
+
+    Returns:
+        HistogramAccumulator: The histograms of the whole file.
+    """
+    accumulator = HistogramAccumulator(features, bins, ranges)
+    for chunk in pd.read_csv(filename, usecols=accumulator.features,
+                             chunksize=chunksize):
+        accumulator.update(chunk)
+    return accumulator
@@ -0,0 +1,240 @@
+'''
+Lookup indexes over the pre-processed dataframes.
+
+Filtering a dataframe with a boolean mask such as
+`tracks_df[tracks_df['id'] == song_id]` scans the whole column for every
+lookup. The indexes here are built once when the data is loaded and answer
+the same lookups in constant time per key.
+'''
+import numpy as np
+import pandas as pd
+
+
+def spotify_ids(uris):
+    """Get the Spotify ids (the last part of the URIs) of Spotify URIs.
+
+    Args:
+        uris (Series): Spotify URIs like "spotify:track:<id>".
+
+    Returns:
+        Series: The Spotify ids.
+    """
+    assert isinstance(uris, pd.Series)
+    return uris.str.rpartition(":")[2]
+
+
+class SpotifyIdIndex:
+    '''Hash index from Spotify ids to the row positions of a dataframe.
+
+    If an id occurs several times the first row is indexed, as the boolean
+    mask lookups it replaces used `.values[0]`.
+    '''
+
+    def __init__(self, ids):
+        '''
+        Args:
+            ids (Series/array): The Spotify id of each row.
+        '''
+        ids = list(ids)
+        n = len(ids)
+        # insert in reverse so the first occurrence of an id wins
+        self._rows = dict(zip(reversed(ids), range(n - 1, -1, -1)))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, spotify_id):
+        return spotify_id in self._rows
+
+    def row(self, spotify_id):
+        """Get the row position of a Spotify id.
+
+        Args:
+            spotify_id (str): The Spotify id.
+
+        Returns:
+            int: The row position.
+
+        Raises:
+            KeyError if the id is not indexed.
+        """
+        return self._rows[spotify_id]
+
+    def rows(self, ids):
+        """Get the row positions of several Spotify ids.
+
+        Args:
+            ids (iterable): The Spotify ids.
+
+        Returns:
+            array: The row position of each id, -1 for ids not indexed.
+        """
+        get = self._rows.get
+        return np.fromiter((get(spotify_id, -1) for spotify_id in ids),
+                           dtype=np.int64)
+
+
+class GroupOffsetIndex:
+    '''Index from small non-negative integer keys to the values grouped under
+    them, e.g. from a pid to the track ids of the playlist.
+
+    The values are stored sorted by key in one array and offsets[key] is
+    where the group of key starts, so a group is a single slice.
+    '''
+
+    def __init__(self, keys, values):
+        '''
+        Args:
+            keys (array): The non-negative integer key of each value.
+            values (array): The values to group.
+        '''
+        keys = np.asarray(keys, dtype=np.int64)
+        values = np.asarray(values)
+        assert keys.shape == values.shape
+        if len(keys) and np.any(keys[1:] < keys[:-1]):
+            order = np.argsort(keys, kind="stable")
+            keys, values = keys[order], values[order]
+        self.values = values
+        counts = np.bincount(keys) if len(keys) else np.zeros(0, np.int64)
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+    @classmethod
+    def from_offsets(cls, offsets, values):
+        """Rebuild an index from its offsets and grouped values, e.g. after
+        saving them.
+
+        Args:
+            offsets (array): The offsets of the groups.
+            values (array): The values sorted by key.
+
+        Returns:
+            GroupOffsetIndex: The index.
+        """
+        index = cls.__new__(cls)
+        index.offsets = np.asarray(offsets, dtype=np.int64)
+        index.values = np.asarray(values)
+        assert index.offsets[-1] == len(index.values)
+        return index
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def group(self, key):
+        """Get the values grouped under a key.
+
+        Args:
+            key (int): The key.
+
+        Returns:
+            array: A view of the values, empty if the key has none.
+        """
+        if key < 0 or key >= len(self):
+            return self.values[:0]
+        return self.values[self.offsets[key]:self.offsets[key + 1]]
+
+
+def track_id_rows(tracks_df):
+    """Get the array mapping a track_id to its row in tracks_df.
+
+    pre_processing assigns the ids in row order so this is normally the
+    identity, but it still holds after tracks_df was filtered or reordered.
+
+    Args:
+        tracks_df (DataFrame): A DataFrame of the unique tracks data.
+
+    Returns:
+        array: rows[track_id] is the row position, -1 for unknown ids.
+    """
+    assert isinstance(tracks_df, pd.DataFrame)
+    track_ids = tracks_df["track_id"].to_numpy(dtype=np.int64)
+    size = int(track_ids.max()) + 1 if len(track_ids) else 0
+    rows = np.full(size, -1, dtype=np.int64)
+    rows[track_ids[::-1]] = np.arange(len(track_ids) - 1, -1, -1)
+    return rows
+
+
+class DatasetIndex:
+    '''The lookup indexes of the loaded dataset.
+
+    Attributes:
+        track_rows (array): track_id -> row of tracks_df.
+        spotify_rows (SpotifyIdIndex): Spotify id -> row of tracks_df.
+        playlist_tracks (GroupOffsetIndex): pid -> track_ids of the playlist,
+            None if playlist_tracks_df was not given.
+        cluster_rows (SpotifyIdIndex): Spotify id -> row of cluster_tracks_df,
+            None if cluster_tracks_df was not given.
+        cluster_members (GroupOffsetIndex): cluster -> rows of
+            cluster_tracks_df, None if cluster_tracks_df was not given.
+    '''
+
+    def __init__(self, tracks_df, playlist_tracks_df=None,
+                 cluster_tracks_df=None):
+        '''
+        Args:
+            tracks_df (DataFrame): A DataFrame of the unique tracks data.
+            playlist_tracks_df (DataFrame): A DataFrame of the playlist and
+                track id associations.
+            cluster_tracks_df (DataFrame): A DataFrame of the tracks and their
+                clusters.
+        '''
+        assert isinstance(tracks_df, pd.DataFrame)
+        self.track_rows = track_id_rows(tracks_df)
+        ids = tracks_df["id"] if "id" in tracks_df.columns \
+            else spotify_ids(tracks_df["track_uri"])
+        self.spotify_rows = SpotifyIdIndex(ids)
+
+        self.playlist_tracks = None
+        if playlist_tracks_df is not None:
+            assert isinstance(playlist_tracks_df, pd.DataFrame)
+            self.playlist_tracks = GroupOffsetIndex(
+                playlist_tracks_df["pid"].to_numpy(),
+                playlist_tracks_df["track_id"].to_numpy())
+
+        self.cluster_rows = self.cluster_members = None
+        if cluster_tracks_df is not None:
+            self.set_clusters(cluster_tracks_df)
+
+    def set_clusters(self, cluster_tracks_df):
+        """Index a (new) cluster assignment.
+
+        Args:
+            cluster_tracks_df (DataFrame): A DataFrame of the tracks and their
+                clusters.
+        """
+        assert isinstance(cluster_tracks_df, pd.DataFrame)
+        self.cluster_rows = SpotifyIdIndex(cluster_tracks_df["id"])
+        self.cluster_members = GroupOffsetIndex(
+            cluster_tracks_df["cluster"].to_numpy(),
+            np.arange(len(cluster_tracks_df)))
+
+    def tracks_rows(self, track_ids):
+        """Get the rows of tracks_df of several track_ids.
+
+        Args:
+            track_ids (array): The track ids.
+
+        Returns:
+            array: The row of each track id, -1 for unknown ids.
+        """
+        track_ids = np.asarray(track_ids, dtype=np.int64)
+        known = (track_ids >= 0) & (track_ids < len(self.track_rows))
+        rows = np.full(len(track_ids), -1, dtype=np.int64)
+        rows[known] = self.track_rows[track_ids[known]]
+        return rows
+
+
+def build_index(tracks_df, playlist_tracks_df=None, cluster_tracks_df=None):
+    """Build the lookup indexes of the loaded dataset.
+
+    Args:
+        tracks_df (DataFrame): A DataFrame of the unique tracks data.
+        playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
+            associations.
+        cluster_tracks_df (DataFrame): A DataFrame of the tracks and their
+            clusters.
+
+    Returns:
+        DatasetIndex: The indexes.
+    """
+    return DatasetIndex(tracks_df, playlist_tracks_df, cluster_tracks_df)
@@ -0,0 +1,261 @@
+'''
+Month partitions of the pre-processed data by the modified_at time of the
+playlists.
+
+The playlists and playlist/track relations of every month are saved in a
+partitions/<YYYY-MM>/ directory next to the flat CSVs, together with the
+precomputed track counts of the month, and partitions/periods.csv holds one
+row of aggregates per month. A loader given a time range only reads the
+partitions of the months it overlaps, and trend queries only read the
+aggregates.
+
+Run `python partitions.py [pre-processed data dir]` to partition existing
+pre-processed data, or pass --partition to pre_processing.py.
+'''
+from argparse import ArgumentParser
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from pre_processing import (read_pre_processed_table, pre_processed_table_path, write_pre_processed_table,
+                            check_compression, TRACKS_DF_FILENAME, PLAYLISTS_DF_FILENAME,
+                            PLAYLIST_TRACKS_DF_FILENAME, MULTIPLICITY_COLUMN, relation_multiplicity)
+from profiling import stage
+
+PARTITIONS_DIRNAME = "partitions"
+PERIODS_FILENAME = "periods.csv"
+TRACK_COUNTS_FILENAME = "track_counts.csv"
+MONTH_FORMAT = "%Y-%m"
+
+
+def to_timestamp(time):
+    """Get the unix time in seconds of a date.
+
+    Args:
+        time (str/int): A date like "2016" or "2016-05-01", or a unix time in
+            seconds.
+
+    Returns:
+        int: The unix time, None if time is None.
+    """
+    if time is None or isinstance(time, (int, np.integer)):
+        return time
+    return int(pd.Timestamp(time, tz="UTC").timestamp())
+
+
+def playlist_months(modified_at):
+    """Get the month partition of playlists.
+
+    Args:
+        modified_at (Series): The modified_at unix times of the playlists.
+
+    Returns:
+        Series: The months as "YYYY-MM".
+    """
+    return pd.to_datetime(modified_at, unit="s").dt.strftime(MONTH_FORMAT)
+
+
+def write_partitions(playlists_df, playlist_tracks_df, data_path, compression=None):
+    """Save the playlists and their relations partitioned by month, with the
+    aggregates of every month, replacing any earlier partitions.
+
+    Args:
+        playlists_df (DataFrame): A DataFrame of the playlists data.
+        playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
+            associations.
+        data_path (str): The directory of the pre-processed data.
+        compression (str): None, "gzip" or "zstd", like
+            pre_processing.write_pre_processed_table.
+    """
+    assert isinstance(playlists_df, pd.DataFrame)
+    assert isinstance(playlist_tracks_df, pd.DataFrame)
+    check_compression(compression)
+    month_codes, month_names = pd.factorize(playlist_months(playlists_df["modified_at"]), sort=True)
+    # group the relations by month once, with the month code of their pid
+    playlist_pids = playlists_df["pid"].to_numpy(dtype=np.int64)
+    month_of_pid = np.full(int(playlist_pids.max()) + 1 if len(playlist_pids) else 0, -1, dtype=np.int64)
+    month_of_pid[playlist_pids] = month_codes
+    relation_pids = playlist_tracks_df["pid"].to_numpy(dtype=np.int64)
+    relation_codes = np.full(len(relation_pids), -1, dtype=np.int64)
+    known = relation_pids < len(month_of_pid)
+    relation_codes[known] = month_of_pid[relation_pids[known]]
+    order = np.argsort(relation_codes, kind="stable")
+    offsets = np.searchsorted(relation_codes[order], np.arange(len(month_names) + 1))
+
+    periods = []
+    partitions_path = os.path.join(data_path, PARTITIONS_DIRNAME)
+    # the months of an earlier run would be read with the new ones
+    if os.path.isdir(partitions_path):
+        shutil.rmtree(partitions_path)
+    for code, playlists in playlists_df.groupby(month_codes, sort=True):
+        month = month_names[code]
+        month_path = os.path.join(partitions_path, month)
+        os.makedirs(month_path, exist_ok=True)
+        relations = playlist_tracks_df.iloc[order[offsets[code]:offsets[code + 1]]]
+        write_pre_processed_table(playlists, month_path, PLAYLISTS_DF_FILENAME, compression)
+        write_pre_processed_table(relations, month_path, PLAYLIST_TRACKS_DF_FILENAME, compression)
+        if MULTIPLICITY_COLUMN in relations:
+            track_counts = relations.groupby("track_id")[MULTIPLICITY_COLUMN].sum().rename("count")
+            track_counts = track_counts.sort_values(ascending=False).reset_index()
+        else:
+            track_counts = relations["track_id"].value_counts().rename_axis("track_id").reset_index()
+        write_pre_processed_table(track_counts, month_path, TRACK_COUNTS_FILENAME, compression)
+        periods.append({
+            "month": month,
+            "playlists": len(playlists),
+            "relations": int(relation_multiplicity(relations).sum()),
+            "unique_tracks": len(track_counts),
+            "collaborative": int((playlists["collaborative"].astype(str).str.lower() == "true").sum()),
+            "mean_num_tracks": playlists["num_tracks"].mean(),
+            "mean_num_followers": playlists["num_followers"].mean(),
+            "mean_duration_s": playlists["duration_s"].mean(),
+        })
+    pd.DataFrame(periods).to_csv(os.path.join(partitions_path, PERIODS_FILENAME), index=False)
+
+
+def partition_pre_processed_data(data_path, compression=None):
+    """Partition the flat pre-processed CSVs of a directory by month.
+
+    Args:
+        data_path (str): The directory of the pre-processed data.
+        compression (str): None, "gzip" or "zstd".
+    """
+    check_compression(compression)
+    playlists_df = read_pre_processed_table(data_path, PLAYLISTS_DF_FILENAME)
+    playlist_tracks_df = read_pre_processed_table(data_path, PLAYLIST_TRACKS_DF_FILENAME)
+    with stage("write"):
+        write_partitions(playlists_df, playlist_tracks_df, data_path, compression)
+
+
+def is_partitioned(data_path):
+    """Whether the pre-processed data of a directory is partitioned."""
+    return os.path.isfile(os.path.join(data_path, PARTITIONS_DIRNAME, PERIODS_FILENAME))
+
+
+def months_in_range(data_path, start=None, end=None):
+    """Get the partitions that overlap a time range.
+
+    Args:
+        data_path (str): The directory of the pre-processed data.
+        start (str/int): The start of the range, inclusive, unbounded if None.
+        end (str/int): The end of the range, exclusive, unbounded if None.
+
+    Returns:
+        list: The months as "YYYY-MM", in order.
+    """
+    start, end = to_timestamp(start), to_timestamp(end)
+    months = []
+    for month in sorted(os.listdir(os.path.join(data_path, PARTITIONS_DIRNAME))):
+        if not os.path.isdir(os.path.join(data_path, PARTITIONS_DIRNAME, month)):
+            continue
+        month_start = pd.Timestamp(month, tz="UTC")
+        month_end = month_start + pd.offsets.MonthBegin(1)
+        if (end is None or month_start.timestamp() < end) and \
+                (start is None or month_end.timestamp() > start):
+            months.append(month)
+    return months
+
+
+def _read_partitions(data_path, months, filename):
+    """Read and concatenate a file of several partitions."""
+    frames = [pd.read_csv(pre_processed_table_path(os.path.join(data_path, PARTITIONS_DIRNAME, month), filename))
+              for month in months]
+    if not frames:
+        return read_pre_processed_table(data_path, filename).iloc[:0]
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_time_range(data_path, start=None, end=None):
+    """Read the pre-processed MPD data of the playlists modified in a time
+    range, reading only the partitions of the range.
+
+    Args:
+        data_path (str): The directory of the pre-processed data.
+        start (str/int): The start of the range, inclusive, unbounded if None.
+        end (str/int): The end of the range, exclusive, unbounded if None.
+
+    Returns:
+        A tuple of three dataframes of the respective playlists data, tracks
+        data, and playlists/tracks relations data.
+
+    Raises:
+        ValueError if the data is not partitioned.
+    """
+    if not is_partitioned(data_path):
+        raise ValueError(f"Data path {data_path} is not partitioned, run partitions.py.")
+    months = months_in_range(data_path, start, end)
+    start, end = to_timestamp(start), to_timestamp(end)
+    with stage("load"):
+        playlists_df = _read_partitions(data_path, months, PLAYLISTS_DF_FILENAME)
+        playlist_tracks_df = _read_partitions(data_path, months, PLAYLIST_TRACKS_DF_FILENAME)
+    tracks_df = read_pre_processed_table(data_path, TRACKS_DF_FILENAME)
+
+    # the partitions at the ends of the range can hold playlists outside it
+    modified_at = playlists_df["modified_at"]
+    selected = np.ones(len(playlists_df), dtype=bool)
+    if start is not None:
+        selected &= (modified_at >= start).to_numpy()
+    if end is not None:
+        selected &= (modified_at < end).to_numpy()
+    if not selected.all():
+        playlists_df = playlists_df[selected].reset_index(drop=True)
+        playlist_tracks_df = playlist_tracks_df[
+            playlist_tracks_df["pid"].isin(playlists_df["pid"])].reset_index(drop=True)
+    return playlists_df, tracks_df, playlist_tracks_df
+
+
+def get_period_aggregates(data_path, start=None, end=None):
+    """Get the precomputed aggregates of the months overlapping a time range.
+
+    Args:
+        data_path (str): The directory of the pre-processed data.
+        start (str/int): The start of the range, inclusive, unbounded if None.
+        end (str/int): The end of the range, exclusive, unbounded if None.
+
+    Returns:
+        A DataFrame of the playlist counts and means of every month.
+    """
+    months = months_in_range(data_path, start, end)
+    periods = pd.read_csv(os.path.join(data_path, PARTITIONS_DIRNAME, PERIODS_FILENAME))
+    return periods[periods["month"].isin(months)].set_index("month")
+
+
+def get_most_common_tracks_by_period(tracks_df, data_path, start=None, end=None, n=10):
+    """Get the most included tracks of the playlists of the months overlapping
+    a time range, from the precomputed track counts.
+
+    Args:
+        tracks_df (DataFrame): A DataFrame of the unique tracks data.
+        data_path (str): The directory of the pre-processed data.
+        start (str/int): The start of the range, inclusive, unbounded if None.
+        end (str/int): The end of the range, exclusive, unbounded if None.
+        n (int): The number of tracks.
+
+    Returns:
+        A DataFrame of the most common tracks.
+    """
+    assert isinstance(tracks_df, pd.DataFrame)
+    assert isinstance(n, int) and n > 0
+    months = months_in_range(data_path, start, end)
+    with stage("load"):
+        counts = _read_partitions(data_path, months, TRACK_COUNTS_FILENAME)
+    with stage("groupby"):
+        counts = counts.groupby("track_id")["count"].sum().nlargest(n)
+    with stage("join"):
+        df = counts.to_frame().join(tracks_df.set_index("track_id")[["track_name", "track_uri"]])
+    return df[["track_name", "track_uri", "count"]].reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Partition the pre-processed data by month of modified_at.")
+    parser.add_argument("input_data", type=str, help="Path to the directory of the pre-processed data.")
+    parser.add_argument("--compression", choices=("gzip", "zstd"), default=None, help="Compress the partitions.")
+    args = parser.parse_args()
+    try:
+        check_compression(args.compression)
+    except ImportError as e:
+        parser.error(str(e))
+    partition_pre_processed_data(args.input_data, args.compression)
+    print(get_period_aggregates(args.input_data).to_string())
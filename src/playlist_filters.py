@@ -0,0 +1,232 @@
+'''
+Select subsets of the playlists with predicates on their attributes.
+
+A predicate like `Column("num_followers") > 10` or `name_contains("workout")`
+is evaluated on playlists_df in one vectorized pass into a pid bitmap, a
+boolean array where bitmap[pid] is whether the playlist is selected.
+Predicates combine with &, | and ~, and parse_filter reads them from strings
+like "num_followers > 10" for the command line. The analysis functions and
+the word counts accept a bitmap and only process the selected playlists.
+'''
+import operator
+import re
+
+import numpy as np
+import pandas as pd
+
+FILTER_OPERATORS = {
+    ">=": operator.ge,
+    "<=": operator.le,
+    "!=": operator.ne,
+    "==": operator.eq,
+    ">": operator.gt,
+    "<": operator.lt,
+}
+_COMPARISON = r"(\w+)(?:\s*(>=|<=|!=|==|>|<)\s*|\s+(contains)\s+)"
+# a comparison, whose value is quoted or runs until " and " starts the next
+# complete comparison, so "name contains rock and roll" is one clause
+_CLAUSE = re.compile(_COMPARISON + r"""("[^"]*"|'[^']*'|.+?)(?=\s+and\s+""" + _COMPARISON + r"|\s*$)")
+_AND = re.compile(r"\s+and\s+")
+
+
+class Predicate:
+    '''A condition on the rows of playlists_df.'''
+
+    def __init__(self, function, description):
+        '''
+        Args:
+            function (callable): Maps playlists_df to a boolean array of its
+                rows.
+            description (str): A readable form of the condition.
+        '''
+        self.function = function
+        self.description = description
+
+    def evaluate(self, playlists_df):
+        """Get which rows of playlists_df satisfy the predicate.
+
+        Args:
+            playlists_df (DataFrame): A DataFrame of the playlists data.
+
+        Returns:
+            array: A boolean array of the rows.
+        """
+        assert isinstance(playlists_df, pd.DataFrame)
+        return np.asarray(self.function(playlists_df), dtype=bool)
+
+    def __and__(self, other):
+        return Predicate(lambda df: self.evaluate(df) & other.evaluate(df),
+                         f"({self.description} and {other.description})")
+
+    def __or__(self, other):
+        return Predicate(lambda df: self.evaluate(df) | other.evaluate(df),
+                         f"({self.description} or {other.description})")
+
+    def __invert__(self):
+        return Predicate(lambda df: ~self.evaluate(df), f"not {self.description}")
+
+    def __repr__(self):
+        return f"Predicate({self.description})"
+
+
+class Column:
+    '''A column of playlists_df to build comparison predicates from, e.g.
+    `Column("num_followers") > 10`.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def _compare(self, compare, symbol, value):
+        return Predicate(lambda df: compare(df[self.name].to_numpy(), value),
+                         f"{self.name} {symbol} {value!r}")
+
+    def __gt__(self, value):
+        return self._compare(operator.gt, ">", value)
+
+    def __ge__(self, value):
+        return self._compare(operator.ge, ">=", value)
+
+    def __lt__(self, value):
+        return self._compare(operator.lt, "<", value)
+
+    def __le__(self, value):
+        return self._compare(operator.le, "<=", value)
+
+    def __eq__(self, value):
+        return self._compare(operator.eq, "==", value)
+
+    def __ne__(self, value):
+        return self._compare(operator.ne, "!=", value)
+
+    def between(self, low, high):
+        """Select values in [low, high]."""
+        return (self >= low) & (self <= high)
+
+    def contains(self, text):
+        """Select string values that contain text, ignoring case."""
+        return Predicate(
+            lambda df: df[self.name].astype(str).str.contains(text, case=False, regex=False).to_numpy(),
+            f"{self.name} contains {text!r}")
+
+
+def name_contains(text):
+    """Select the playlists whose name contains text, ignoring case."""
+    return Column("name").contains(text)
+
+
+def collaborative(value=True):
+    """Select the collaborative playlists, or the other ones if value is
+    False."""
+    return Predicate(lambda df: df["collaborative"].astype(str).str.lower().to_numpy() == str(value).lower(),
+                     f"collaborative == {value}")
+
+
+def length_between(low, high):
+    """Select the playlists with low to high tracks, inclusive."""
+    return Column("num_tracks").between(low, high)
+
+
+def parse_filter(text):
+    """Parse a predicate like "num_followers > 10", "name contains workout",
+    or several joined by " and ". Values can be quoted, e.g.
+    "name contains 'rock and roll'".
+
+    Args:
+        text (str): The filter.
+
+    Returns:
+        Predicate: The predicate.
+
+    Raises:
+        ValueError if the filter cannot be parsed.
+    """
+    assert isinstance(text, str)
+    text = text.strip()
+    predicate = None
+    position = 0
+    while True:
+        match = _CLAUSE.match(text, position)
+        if not match:
+            raise ValueError(f"Cannot parse filter {text[position:]!r}.")
+        name, symbol, value = match[1], match[2] or match[3], match[4]
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+            value = value[1:-1]
+            quoted = True
+        else:
+            value = value.strip()
+            quoted = False
+        if symbol == "contains":
+            condition = Column(name).contains(value)
+        else:
+            if not quoted:
+                try:
+                    value = float(value) if "." in value else int(value)
+                except ValueError:
+                    if value.lower() in ("true", "false"):
+                        value = value.lower() == "true"
+            if name == "collaborative" and isinstance(value, bool):
+                condition = collaborative(value) if symbol == "==" else ~collaborative(value)
+            else:
+                condition = Column(name)._compare(FILTER_OPERATORS[symbol], symbol, value)
+        predicate = condition if predicate is None else predicate & condition
+        position = match.end()
+        if position == len(text):
+            return predicate
+        position = _AND.match(text, position).end()
+
+
+def pid_bitmap(playlists_df, predicate=None):
+    """Get the pid bitmap of the playlists that satisfy a predicate.
+
+    Args:
+        playlists_df (DataFrame): A DataFrame of the playlists data.
+        predicate (Predicate/str): The predicate or a filter for parse_filter,
+            all playlists if None.
+
+    Returns:
+        array: A boolean array where bitmap[pid] is whether the playlist is
+            selected.
+    """
+    assert isinstance(playlists_df, pd.DataFrame)
+    if isinstance(predicate, str):
+        predicate = parse_filter(predicate)
+    pids = playlists_df["pid"].to_numpy(dtype=np.int64)
+    bitmap = np.zeros(int(pids.max()) + 1 if len(pids) else 0, dtype=bool)
+    bitmap[pids] = True if predicate is None else predicate.evaluate(playlists_df)
+    return bitmap
+
+
+def selected_rows(pids, bitmap):
+    """Get which rows of a pid column are selected by a bitmap.
+
+    Args:
+        pids (Series/array): The pids of the rows.
+        bitmap (array): A pid bitmap.
+
+    Returns:
+        array: A boolean array of the rows, pids beyond the bitmap are not
+            selected.
+    """
+    pids = np.asarray(pids, dtype=np.int64)
+    selected = np.zeros(len(pids), dtype=bool)
+    known = pids < len(bitmap)
+    selected[known] = bitmap[pids[known]]
+    return selected
+
+
+def select_playlists(df, bitmap=None):
+    """Keep the rows of a DataFrame with a pid column whose playlist is
+    selected by a bitmap.
+
+    Args:
+        df (DataFrame): E.g. playlist_tracks_df or playlists_df.
+        bitmap (array): A pid bitmap, keep all the rows if None.
+
+    Returns:
+        DataFrame: The selected rows, df itself if bitmap is None.
+    """
+    assert isinstance(df, pd.DataFrame)
+    if bitmap is None:
+        return df
+    return df[selected_rows(df["pid"], bitmap)]
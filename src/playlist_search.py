@@ -0,0 +1,303 @@
+'''
+A persistent search index over the playlist names, to find playlists by
+title instead of by pid.
+
+The names are normalized (accents removed, lowercased, split on anything
+that is not a letter or digit) into tokens. The sorted token vocabulary
+works as a compact prefix trie: the tokens that start with a prefix are a
+contiguous range of codes, found by binary search. The playlists are
+numbered by decreasing num_followers and the postings of every token are in
+that order, so a search walks the postings of its rarest token from the
+start, keeps the playlists whose tokens (from a forward index) match the
+rest of the query, and stops as soon as it has enough results.
+
+Run `python playlist_search.py [pre-processed data dir] [query]` to build
+the index and search it.
+'''
+from argparse import ArgumentParser
+import os
+import re
+import time
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+from indexes import GroupOffsetIndex
+from pre_processing import pre_processed_table_path, read_pre_processed_table, PLAYLISTS_DF_FILENAME
+from profiling import stage
+
+PLAYLIST_SEARCH_INDEX_FILENAME = "playlist_search_index.npz"
+
+_NON_ALPHANUMERIC = re.compile(r"[^0-9a-z]+")
+
+
+def normalize_name(name):
+    """Get the search tokens of a playlist name.
+
+    Args:
+        name (str): The name.
+
+    Returns:
+        list: The lowercased tokens without accents or punctuation.
+    """
+    name = unicodedata.normalize("NFKD", str(name))
+    name = "".join(c for c in name if not unicodedata.combining(c)).lower()
+    return _NON_ALPHANUMERIC.sub(" ", name).split()
+
+
+class PlaylistSearchIndex:
+    '''Prefix search over the playlist names ranked by num_followers.'''
+
+    def __init__(self, vocabulary, postings, tokens, pids, names, followers, source=None):
+        '''Use PlaylistSearchIndex.build or PlaylistSearchIndex.load instead.
+
+        Args:
+            vocabulary (array): The sorted unique tokens.
+            postings (GroupOffsetIndex): Token code -> rows of the playlists
+                that have the token, most followed first.
+            tokens (GroupOffsetIndex): Row -> token codes of its name.
+            pids (array): The pid of each row.
+            names (array): The name of each row.
+            followers (array): The num_followers of each row.
+            source (tuple): The (size, mtime_ns) of the playlists table the
+                index was built from, None if unknown.
+        '''
+        self.vocabulary = vocabulary
+        self.postings = postings
+        self.tokens = tokens
+        self.pids = pids
+        self.names = names
+        self.followers = followers
+        self.source = source
+
+    @classmethod
+    def build(cls, playlists_df):
+        """Index the names of the playlists.
+
+        Args:
+            playlists_df (DataFrame): A DataFrame of the playlists data.
+
+        Returns:
+            PlaylistSearchIndex: The index.
+        """
+        assert isinstance(playlists_df, pd.DataFrame)
+        names = playlists_df["name"].fillna("").astype(str).to_numpy()
+        followers = playlists_df["num_followers"].to_numpy(dtype=np.int64)
+        pids = playlists_df["pid"].to_numpy(dtype=np.int64)
+
+        # most followed first, ties by pid
+        order = np.lexsort((pids, -followers))
+        names, followers, pids = names[order], followers[order], pids[order]
+        with stage("index"):
+            tokens, rows = [], []
+            for row, name in enumerate(names):
+                name_tokens = set(normalize_name(name))
+                tokens.extend(name_tokens)
+                rows.extend([row] * len(name_tokens))
+            vocabulary, codes = np.unique(np.array(tokens, dtype=str), return_inverse=True)
+            rows = np.array(rows, dtype=np.int64)
+            # the stable grouping keeps the rows of a token in follower order
+            postings = GroupOffsetIndex(codes, rows)
+            tokens = GroupOffsetIndex.from_offsets(
+                np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=len(names))))), codes)
+        return cls(vocabulary, postings, tokens, pids, names.astype(str), followers)
+
+    def save(self, filename):
+        """Save the index to a .npz file."""
+        source = {} if self.source is None else {"source": np.array(self.source, dtype=np.int64)}
+        with stage("write"):
+            np.savez(filename, vocabulary=self.vocabulary, offsets=self.postings.offsets,
+                     postings=self.postings.values, token_offsets=self.tokens.offsets,
+                     tokens=self.tokens.values, pids=self.pids, names=self.names,
+                     followers=self.followers, **source)
+
+    @classmethod
+    def load(cls, filename):
+        """Load an index saved with save.
+
+        Args:
+            filename (str): The .npz file.
+
+        Returns:
+            PlaylistSearchIndex: The index.
+        """
+        with stage("load"):
+            with np.load(filename) as saved:
+                postings = GroupOffsetIndex.from_offsets(saved["offsets"], saved["postings"])
+                tokens = GroupOffsetIndex.from_offsets(saved["token_offsets"], saved["tokens"])
+                source = tuple(int(v) for v in saved["source"]) if "source" in saved.files else None
+                return cls(saved["vocabulary"], postings, tokens, saved["pids"], saved["names"],
+                           saved["followers"], source)
+
+    def __len__(self):
+        return len(self.pids)
+
+    def _code_range(self, token, prefix=False):
+        """Get the range of token codes that match a query token."""
+        start = np.searchsorted(self.vocabulary, token, side="left")
+        if prefix:
+            stop = np.searchsorted(self.vocabulary, token + "\U0010ffff", side="left")
+        else:
+            stop = start + int(start < len(self.vocabulary) and self.vocabulary[start] == token)
+        return int(start), int(stop)
+
+    def _matching(self, rows, code_ranges):
+        """Get which rows have a token in every code range."""
+        starts = self.tokens.offsets[rows]
+        counts = self.tokens.offsets[rows + 1] - starts
+        owners = np.repeat(np.arange(len(rows)), counts)
+        codes = self.tokens.values[np.repeat(starts - np.cumsum(counts) + counts, counts)
+                                   + np.arange(counts.sum())]
+        matching = np.ones(len(rows), dtype=bool)
+        for start, stop in code_ranges:
+            hits = (codes >= start) & (codes < stop)
+            matching &= np.bincount(owners[hits], minlength=len(rows)) > 0
+        return matching
+
+    def search_rows(self, query, limit=10, prefix=True):
+        """Get the rows of the playlists whose name has all the query tokens.
+
+        Args:
+            query (str): The query, normalized like the names.
+            limit (int): The maximum number of rows.
+            prefix (bool): Whether the last query token matches any token it
+                is a prefix of, for search as you type.
+
+        Returns:
+            array: The rows, most followed first.
+        """
+        tokens = normalize_name(query)
+        code_ranges = [self._code_range(token, prefix and i == len(tokens) - 1)
+                       for i, token in enumerate(tokens)]
+        if not tokens or any(start == stop for start, stop in code_ranges):
+            return self.pids[:0]
+
+        offsets = self.postings.offsets
+        single = [(offsets[stop] - offsets[start], start) for start, stop in code_ranges
+                  if stop - start == 1]
+        if not single:
+            # a lone prefix, the best rows are among the first of every token
+            start, stop = code_ranges[0]
+            heads = [self.postings.values[offsets[code]:min(offsets[code] + limit, offsets[code + 1])]
+                     for code in range(start, stop)]
+            return np.unique(np.concatenate(heads))[:limit]
+
+        # walk the postings of the rarest token in follower order
+        _, code = min(single)
+        driver = self.postings.group(code)
+        found = []
+        n_found, chunksize = 0, max(4 * limit, 256)
+        for i in range(0, len(driver), chunksize):
+            rows = driver[i:i + chunksize]
+            rows = rows[self._matching(rows, code_ranges)]
+            found.append(rows)
+            n_found += len(rows)
+            if n_found >= limit:
+                break
+        return np.concatenate(found)[:limit] if found else self.pids[:0]
+
+    def search(self, query, limit=10, prefix=True):
+        """Find playlists by name.
+
+        Args:
+            query (str): The query, normalized like the names.
+            limit (int): The maximum number of playlists.
+            prefix (bool): Whether the last query token matches as a prefix.
+
+        Returns:
+            A DataFrame of the pid, name and num_followers of the matching
+            playlists, most followed first.
+        """
+        rows = self.search_rows(query, limit, prefix)
+        return pd.DataFrame({"pid": self.pids[rows], "name": self.names[rows],
+                             "num_followers": self.followers[rows]})
+
+    def resolve(self, name):
+        """Get the pid of the most followed playlist called name, or else of
+        the most followed one whose name has all the tokens of name.
+
+        Args:
+            name (str): The playlist name.
+
+        Returns:
+            int: The pid.
+
+        Raises:
+            KeyError if no playlist name matches.
+        """
+        rows = self.search_rows(name, limit=1000, prefix=False)
+        if len(rows) == 0:
+            raise KeyError(f"No playlist named {name!r}")
+        target = normalize_name(name)
+        for row in rows[:1000]:
+            if normalize_name(self.names[row]) == target:
+                return int(self.pids[row])
+        return int(self.pids[rows[0]])
+
+
+def playlists_source(data_path):
+    """Get the (size, mtime_ns) of the playlists table of a pre-processed data
+    directory, which changes whenever the table is rewritten.
+    """
+    stat = os.stat(pre_processed_table_path(data_path, PLAYLISTS_DF_FILENAME))
+    return stat.st_size, stat.st_mtime_ns
+
+
+def build_playlist_search_index(data_path, playlists_df=None):
+    """Build the search index of a pre-processed data directory and save it.
+
+    Args:
+        data_path (str): The directory of the pre-processed data.
+        playlists_df (DataFrame): The playlists, read from data_path if None.
+
+    Returns:
+        PlaylistSearchIndex: The index.
+    """
+    source = playlists_source(data_path)
+    if playlists_df is None:
+        playlists_df = read_pre_processed_table(data_path, PLAYLISTS_DF_FILENAME)
+    index = PlaylistSearchIndex.build(playlists_df)
+    index.source = source
+    index.save(os.path.join(data_path, PLAYLIST_SEARCH_INDEX_FILENAME))
+    return index
+
+
+def load_playlist_search_index(data_path, playlists_df=None):
+    """Load the search index of a pre-processed data directory, building and
+    saving it first if it does not exist or the playlists table changed since
+    it was built.
+
+    Args:
+        data_path (str): The directory of the pre-processed data.
+        playlists_df (DataFrame): The playlists, read from data_path if None
+            and the index has to be built.
+
+    Returns:
+        PlaylistSearchIndex: The index.
+    """
+    filename = os.path.join(data_path, PLAYLIST_SEARCH_INDEX_FILENAME)
+    if os.path.isfile(filename):
+        index = PlaylistSearchIndex.load(filename)
+        if index.source == playlists_source(data_path):
+            return index
+    return build_playlist_search_index(data_path, playlists_df)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Search the playlists by name.")
+    parser.add_argument("input_data", type=str, help="Path to the directory of the pre-processed data.")
+    parser.add_argument("query", type=str, nargs="?", default=None, help="The name to search for.")
+    parser.add_argument("-N", type=int, default=10, help="The number of results.")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the index even if it exists.")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        index = build_playlist_search_index(args.input_data)
+    else:
+        index = load_playlist_search_index(args.input_data)
+    if args.query is not None:
+        start = time.perf_counter()
+        results = index.search(args.query, args.N)
+        print(results.to_string(index=False))
+        print(f"{(time.perf_counter() - start) * 1000:.3f} ms")
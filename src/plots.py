@@ -1,6 +1,18 @@
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import numpy as np
 import pandas as pd
-import seaborn as sns
+
+from profiling import stage
+
+# pyplot keeps global state which makes it unsafe to render from several
+# workers, so the batch rendering below only uses the object oriented Agg API
+# and pyplot/seaborn are imported by the interactive plotting functions only
+BAR_COLOR = "#7BB594"
+HIST_COLORS = ("#1F77B4", "#FF7F0E", "#2CA02C", "#D62728")
+
+_figure = None
 
 
 def save_audio_features_hist(filename, audio_df, x, title):
@@ -18,7 +30,10 @@ def save_audio_features_hist(filename, audio_df, x, title):
     Returns:
         None
     """
-    with sns.axes_style("whitegrid"):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    with stage("plotting"), sns.axes_style("whitegrid"):
         ax = sns.histplot(audio_df, x=x, hue="label", stat="density", common_norm=False)
         ax.set_title(title)
         sns.move_legend(ax, "upper left", bbox_to_anchor=(1, 1))  
@@ -42,6 +57,9 @@ def save_bar_plot(filename, df, x, y, title, orient="v", save = "y"):
     Returns:
         None
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     assert isinstance(filename, str)
     assert isinstance(df, pd.DataFrame)
     assert isinstance(x, str)
@@ -67,7 +85,7 @@ def save_bar_plot(filename, df, x, y, title, orient="v", save = "y"):
         x, y = y, df.index
         xmargin, ymargin = 0.15, 0.05
     col_labels = [f"({i}) - {label}" for i, label in enumerate(df[label_col])]
-    with sns.axes_style("whitegrid"):
+    with stage("plotting"), sns.axes_style("whitegrid"):
         ax = sns.barplot(df, x=x, y=y, errorbar=None, hue=col_labels, palette=["#7BB594"], orient=orient)
         ax.set_xmargin(xmargin)
         ax.set_ymargin(ymargin)
@@ -82,3 +100,215 @@ def save_bar_plot(filename, df, x, y, title, orient="v", save = "y"):
             plt.close()
         else:
             plt.show()
+
+
+def bar_plot_spec(filename, df, x, y, title, orient="v"):
+    """Describe the bar plot save_bar_plot would draw, for render_plots.
+
+    Only the labels and values are kept so the spec is cheap to send to a
+    worker process.
+
+    Args:
+        filename (str): The filename of the plot image to save.
+        df (DataFrame): A DataFrame of the data to plot as a bar graph.
+        x (str): The column name or index of the DataFrame to label the bars
+            by.
+        y (str): The column name of the DataFrame to plot the bar values by.
+        title (str): The title of the overall plot.
+        orient (str): The orientation of the bar plot.
+
+    Returns:
+        dict: The plot spec.
+    """
+    assert isinstance(filename, str)
+    assert isinstance(df, pd.DataFrame)
+    assert isinstance(x, str)
+    assert isinstance(y, str)
+    assert isinstance(title, str)
+    assert orient in ("h", "v")
+
+    df = df.reset_index()
+
+    assert x in df.columns
+    assert y in df.columns
+
+    return {
+        "kind": "bar",
+        "filename": filename,
+        "title": title,
+        "orient": orient,
+        "label_name": x,
+        "value_name": y,
+        "labels": [str(label) for label in df[x]],
+        "values": df[y].to_numpy(),
+    }
+
+
+def hist_plot_spec(filename, audio_df, x, title, bins=30):
+    """Describe the histogram save_audio_features_hist would draw, for
+    render_plots.
+
+    The densities of every label are computed here with NumPy over common
+    bin edges, so drawing the plot does not touch the raw values.
+
+    Args:
+        filename (str): The filename of the plot image to save.
+        audio_df (DataFrame): A DataFrame of the audio characteristics data
+            with a "label" column to group the histograms by.
+        x (str): The column name of the DataFrame to plot.
+        title (str): The title of the overall plot.
+        bins (int): The number of bins.
+
+    Returns:
+        dict: The plot spec.
+    """
+    assert isinstance(filename, str)
+    assert isinstance(audio_df, pd.DataFrame)
+    assert x in audio_df.columns and "label" in audio_df.columns
+    assert isinstance(title, str)
+
+    values = audio_df[x].to_numpy(dtype=np.float64)
+    edges = np.histogram_bin_edges(values[np.isfinite(values)], bins=bins)
+    densities = {}
+    for label, group in audio_df.groupby("label", sort=False)[x]:
+        densities[label], _ = np.histogram(group.to_numpy(dtype=np.float64),
+                                           bins=edges, density=True)
+    return {
+        "kind": "hist",
+        "filename": filename,
+        "title": title,
+        "x": x,
+        "edges": edges,
+        "densities": densities,
+    }
+
+
+def accumulated_hist_plot_spec(filename, accumulators, x, title):
+    """Describe a histogram drawn from streaming histograms, for render_plots.
+
+    Args:
+        filename (str): The filename of the plot image to save.
+        accumulators (dict): Maps a label to the HistogramAccumulator of the
+            tracks with that label.
+        x (str): The feature to plot.
+        title (str): The title of the overall plot.
+
+    Returns:
+        dict: The plot spec.
+    """
+    assert isinstance(filename, str)
+    assert isinstance(accumulators, dict) and len(accumulators) > 0
+    assert isinstance(title, str)
+
+    edges = next(iter(accumulators.values())).edges(x)
+    return {
+        "kind": "hist",
+        "filename": filename,
+        "title": title,
+        "x": x,
+        "edges": edges,
+        "densities": {label: accumulator.density(x)
+                      for label, accumulator in accumulators.items()},
+    }
+
+
+def _get_figure():
+    """Get the figure of this process, which is reused by every plot.
+
+    Returns:
+        Figure: A cleared figure with an Agg canvas.
+    """
+    global _figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    if _figure is None:
+        _figure = Figure()
+        FigureCanvasAgg(_figure)
+    _figure.clear()
+    return _figure
+
+
+def _draw_bar(ax, spec):
+    """Draw a bar plot spec on an axes."""
+    positions = np.arange(len(spec["labels"]))
+    values = spec["values"]
+    if spec["orient"] == "h":
+        bars = ax.barh(positions, values, color=BAR_COLOR)
+        ax.set_yticks(positions)
+        ax.invert_yaxis()
+        ax.set_xlabel(spec["value_name"])
+        ax.set_ylabel(spec["label_name"])
+        ax.set_xmargin(0.15)
+        ax.set_ymargin(0.05)
+    else:
+        bars = ax.bar(positions, values, color=BAR_COLOR)
+        ax.set_xticks(positions)
+        ax.set_xlabel(spec["label_name"])
+        ax.set_ylabel(spec["value_name"])
+        ax.set_xmargin(0.05)
+        ax.set_ymargin(0.15)
+    ax.bar_label(bars)
+    for i, (bar, label) in enumerate(zip(bars, spec["labels"])):
+        bar.set_label(f"({i}) - {label}")
+    ax.legend(handles=list(bars), loc="upper left", bbox_to_anchor=(1, 1))
+
+
+def _draw_hist(ax, spec):
+    """Draw a pre-binned histogram spec on an axes."""
+    for i, (label, density) in enumerate(spec["densities"].items()):
+        color = HIST_COLORS[i % len(HIST_COLORS)]
+        ax.stairs(density, spec["edges"], fill=True, alpha=0.4, color=color,
+                  label=label)
+        ax.stairs(density, spec["edges"], color=color)
+    ax.set_xlabel(spec["x"])
+    ax.set_ylabel("Density")
+    ax.legend(title="label", loc="upper left", bbox_to_anchor=(1, 1))
+
+
+def render_plot(spec):
+    """Render a plot spec to its png file with the Agg backend.
+
+    Args:
+        spec (dict): A spec from bar_plot_spec or hist_plot_spec.
+
+    Returns:
+        str: The filename of the saved image.
+    """
+    assert spec["kind"] in ("bar", "hist")
+    figure = _get_figure()
+    figure.set_size_inches(6.4, 4.8)
+    ax = figure.add_subplot()
+    ax.grid(True, color="#EAEAEA")
+    ax.set_axisbelow(True)
+    for side in ("top", "right"):
+        ax.spines[side].set_visible(False)
+    if spec["kind"] == "bar":
+        _draw_bar(ax, spec)
+    else:
+        _draw_hist(ax, spec)
+    ax.set_title(spec["title"])
+    figure.savefig(spec["filename"], bbox_inches="tight")
+    return spec["filename"]
+
+
+def render_plots(specs, workers=None):
+    """Render a batch of plot specs, in parallel worker processes.
+
+    Args:
+        specs (list): Specs from bar_plot_spec or hist_plot_spec.
+        workers (int): The number of worker processes, defaults to the
+            number of CPUs. With 1 the plots are rendered in this process.
+
+    Returns:
+        list: The filenames of the saved images.
+    """
+    assert isinstance(specs, list)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(specs)))
+    with stage("plotting"):
+        if workers == 1:
+            return [render_plot(spec) for spec in specs]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(render_plot, specs))
@@ -1,16 +1,63 @@
 import json
+import math
+import operator
+import random
+import numpy as np
 import pandas as pd
 import os
 from tqdm import tqdm
 import argparse
 
+from profiling import stage, add_profile_arguments, profile_from_args
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 TRACKS_DF_FILENAME = "tracks_df.csv"
 PLAYLISTS_DF_FILENAME = "playlists_df.csv"
 PLAYLIST_TRACKS_DF_FILENAME = "playlist_tracks_df.csv"
+TRACK_ALIASES_FILENAME = "track_aliases.csv"
+VALIDATION_REPORT_FILENAME = "validation_report.json"
+
+# the compressions of the written tables and the suffixes of their files,
+# pandas infers the compression from the suffix when reading
+COMPRESSION_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+# gzip defaults to level 9, which is several times slower for little gain
+COMPRESSION_OPTIONS = {None: None,
+                       "gzip": {"method": "gzip", "compresslevel": 6},
+                       "zstd": {"method": "zstd", "level": 3}}
+
+
+PLAYLIST_INT_COLUMNS = ("pid", "modified_at", "num_tracks", "num_albums",
+                        "num_followers", "num_edits", "num_artists")
+TRACK_STR_COLUMNS = ("artist_name", "track_uri", "artist_uri", "track_name",
+                     "album_uri", "album_name")
+PLAYLISTS_DF_COLUMNS = ("name", "collaborative") + PLAYLIST_INT_COLUMNS + \
+    ("duration_s",)
+TRACKS_DF_COLUMNS = TRACK_STR_COLUMNS + ("duration_s", "track_id")
+# the times a track is in a playlist, in deduplicated relations
+MULTIPLICITY_COLUMN = "multiplicity"
+# tracks with the same values are aliases of one track
+ALIAS_KEY_COLUMNS = ("track_name", "artist_uri", "duration_s")
+
+# per slice column arrays, concatenated once all slices are processed
+playlists_chunks, tracks_chunks, playlist_tracks_chunks = [], [], []
+track_uri_to_id = {}
 
 
-playlists_df_list, tracks_df_list = [], []
-track_uri_to_id = {}
+SLICE_SCHEMA = (("info", dict), ("playlists", list))
+PLAYLIST_SCHEMA = (("name", str), ("collaborative", str), ("pid", int),
+                   ("modified_at", int), ("num_tracks", int),
+                   ("num_albums", int), ("num_followers", int),
+                   ("num_edits", int), ("duration_ms", int),
+                   ("num_artists", int), ("tracks", list))
+TRACK_SCHEMA = (("pos", int), ("artist_name", str), ("track_uri", str),
+                ("artist_uri", str), ("track_name", str), ("album_uri", str),
+                ("duration_ms", int), ("album_name", str))
+
+VALIDATION_MODES = ("full", "sampled", "off")
 
 
 def validate_dict(dictionary, expected_keys, expected_types):
@@ -25,7 +72,8 @@ def validate_dict(dictionary, expected_keys, expected_types):
     Returns:
         tuple(bool, str): whether the test passed, the reason if failed
     '''
-    assert isinstance(dictionary, dict)
+    if not isinstance(dictionary, dict):
+        return False, "value is not a dict"
 
     for expected_key, expected_type in zip(expected_keys, expected_types):
         if expected_key not in dictionary:
@@ -36,115 +84,344 @@ def validate_dict(dictionary, expected_keys, expected_types):
     return True, None
 
 
-def validate_slice(slice):
+def compile_validator(schema):
+    '''
+    Given a schema of (key, type) pairs, build a validator specialised for it.
+
+    The returned validator fetches all keys with a single itemgetter call and
+    checks the types with one map over isinstance, so the common case of a
+    valid dictionary never runs a Python level loop. The slow per-key
+    validate_dict is only used to explain a failure.
+
+    Args:
+        schema(tuple): The (key, type) pairs the dictionary must satisfy
+    Returns:
+        function: dict -> tuple(bool, str), same contract as validate_dict
+    '''
+    assert isinstance(schema, tuple) and len(schema) > 1
+    expected_keys = tuple(key for key, _ in schema)
+    expected_types = tuple(value_type for _, value_type in schema)
+    getter = operator.itemgetter(*expected_keys)
+
+    def validator(dictionary):
+        try:
+            values = getter(dictionary)
+        except (KeyError, TypeError):
+            return validate_dict(dictionary, expected_keys, expected_types)
+        if all(map(isinstance, values, expected_types)):
+            return True, None
+        return validate_dict(dictionary, expected_keys, expected_types)
+
+    return validator
+
+
+validate_slice_dict = compile_validator(SLICE_SCHEMA)
+validate_playlist = compile_validator(PLAYLIST_SCHEMA)
+validate_track = compile_validator(TRACK_SCHEMA)
+
+
+def new_validation_report(mode="full", sample_frac=0.1):
+    '''
+    Create an empty validation report which collects the errors found
+    across slices instead of failing on the first one.
+
+    Args:
+        mode(str): One of VALIDATION_MODES
+        sample_frac(float): Fraction of playlists validated in "sampled" mode
+    Returns:
+        dict: The report with counters and an (initially empty) error list
+    '''
+    assert mode in VALIDATION_MODES
+    assert 0 < sample_frac <= 1
+    return {"mode": mode, "sample_frac": sample_frac, "slices": 0,
+            "playlists_checked": 0, "playlists_invalid": 0, "errors": []}
+
+
+def validate_slice(slice, mode="full", sample_frac=0.1, report=None,
+                   rng=None):
     '''
     Given a slice, test if it has data structure desribed in
     "Raw Data Structure.png"
 
+    In "full" mode every playlist and track is checked, in "sampled" mode
+    only a random sample_frac of the playlists (and their tracks) is checked,
+    and in "off" mode only the top level of the slice is checked.
+
     Args:
         slice(dict): a slice to be tested
+        mode(str): One of VALIDATION_MODES
+        sample_frac(float): Fraction of playlists validated in "sampled" mode
+        report(dict): A report from new_validation_report to collect errors
+            into, a new one is created if None
+        rng(random.Random): Random generator used for sampling
     Returns:
-        tuple(bool, str): whether the test passed, the reason if failed
+        tuple(bool, set): whether the slice itself is usable, and the
+            indices of the invalid playlists which should be skipped
     '''
+    if report is None:
+        report = new_validation_report(mode, sample_frac)
+    assert mode in VALIDATION_MODES
+    report["slices"] += 1
 
-    if not isinstance(slice, dict):
-        return False, "slice is not a dict"
-
-    expected_keys = ("info", "playlists")
-    expected_types = (dict, list)
-    res = validate_dict(slice, expected_keys, expected_types)
+    res = validate_slice_dict(slice)
     if res[0] is False:
-        return res
-
-    for playlist in slice["playlists"]:
-        expected_keys = ("name", "collaborative", "pid", "modified_at",
-                         "num_tracks", "num_albums", "num_followers",
-                         "num_edits", "duration_ms", "num_artists",
-                         "tracks")
-        expected_types = (str, str, int, int,
-                          int, int, int,
-                          int, int, int,
-                          list)
-        res = validate_dict(playlist, expected_keys, expected_types)
+        report["errors"].append({"slice": None, "pid": None,
+                                 "reason": res[1]})
+        return False, set()
+    slice_name = slice["info"].get("slice")
+
+    playlists = slice["playlists"]
+    if mode == "off":
+        indices = range(0)
+    elif mode == "sampled":
+        rng = rng if rng is not None else random
+        k = min(len(playlists), math.ceil(len(playlists) * sample_frac))
+        indices = sorted(rng.sample(range(len(playlists)), k))
+    else:
+        indices = range(len(playlists))
+
+    invalid = set()
+    for i in indices:
+        playlist = playlists[i]
+        res = validate_playlist(playlist)
+        if res[0]:
+            for track in playlist["tracks"]:
+                res = validate_track(track)
+                if res[0] is False:
+                    break
+        report["playlists_checked"] += 1
         if res[0] is False:
-            return res
-
-        for track in playlist["tracks"]:
-            expected_keys = ("pos", "artist_name", "track_uri", "artist_uri",
-                             "track_name", "album_uri", "duration_ms",
-                             "album_name")
-            expected_types = (int, str, str, str,
-                              str, str, int,
-                              str)
-            res = validate_dict(track, expected_keys, expected_types)
-            if res[0] is False:
-                return res
+            invalid.add(i)
+            pid = playlist.get("pid") if isinstance(playlist, dict) else None
+            report["errors"].append({"slice": slice_name, "pid": pid,
+                                     "reason": res[1]})
 
-    return True, None
+    report["playlists_invalid"] += len(invalid)
+    return True, invalid
+
+
+def load_slice(filename):
+    '''
+    Load a slice from disk, using orjson when it is installed and the
+    standard library json module otherwise.
+
+    Args:
+        filename(str): Path of the slice json file
+    Returns:
+        dict: The parsed slice
+    '''
+    if orjson is not None:
+        with open(filename, "rb") as f:
+            return orjson.loads(f.read())
+    with open(filename) as f:
+        return json.load(f)
 
 
-def process_slice(slice):
+def process_slice(slice, validation="full", sample_frac=0.1, report=None):
     '''
     Given a slice with data structure described in "Raw Data Structure.png",
-    modify this slice by
-    1. Removing the "info" field
-    2. Adding the attribute "slice"(originally in "info") to the slice
-    3. In an entry of "playlists",
+    extract its fields into typed column arrays without modifying the slice:
+    1. In an entry of "playlists",
        convert "collaborative" from str to bool, and
        convert "duration_ms" from ms to secs(int)
-    4. In an entry of "tracks" in an entry of "playlists",
-       convert "duration_ms" from ms to secs(int)
+    2. In an entry of "tracks" in an entry of "playlists",
+       convert "duration_ms" from ms to secs(int), and
+       encode the track by its track_id
     *Check "New Data Structure.png" for more details*
-    Then, add all of the playlists and tracks into the dataframes
+    Then, add the columns of the playlists, of the tracks not seen in an
+    earlier slice, and of the playlist/track relations to the chunk lists
+    the dataframes are built from.
+
+    Playlists that fail validation are skipped and recorded in the report.
 
     Args:
         slice(dict): a slice to be processed
+        validation(str): One of VALIDATION_MODES
+        sample_frac(float): Fraction of playlists validated in "sampled" mode
+        report(dict): A report from new_validation_report to collect errors
+    Returns:
+        bool: whether the slice was processed
+    '''
+    valid, invalid = validate_slice(slice, validation, sample_frac, report)
+    if not valid:
+        return False
+
+    playlists = [playlist for i, playlist in enumerate(slice["playlists"])
+                 if i not in invalid]
+    n_playlists = len(playlists)
+
+    # playlist columns
+    playlist_columns = {"name": np.array([p["name"] for p in playlists],
+                                         dtype=object)}
+    playlist_columns["collaborative"] = np.fromiter(
+        (p["collaborative"] == "true" for p in playlists),
+        dtype=bool, count=n_playlists)
+    for column in PLAYLIST_INT_COLUMNS:
+        playlist_columns[column] = np.fromiter(
+            map(operator.itemgetter(column), playlists),
+            dtype=np.int64, count=n_playlists)
+    playlist_columns["duration_s"] = np.fromiter(
+        map(operator.itemgetter("duration_ms"), playlists),
+        dtype=np.int64, count=n_playlists) // 1000
+
+    # flatten the tracks of all playlists, offsets[i] is where playlist i
+    # starts in the flat arrays
+    lengths = np.fromiter((len(p["tracks"]) for p in playlists),
+                          dtype=np.int64, count=n_playlists)
+    offsets = np.zeros(n_playlists + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tracks = [track for playlist in playlists for track in playlist["tracks"]]
+
+    # encode tracks to their ids, unseen uris get the next free id
+    n_seen = len(track_uri_to_id)
+    track_ids = np.fromiter(
+        (track_uri_to_id.setdefault(track["track_uri"], len(track_uri_to_id))
+         for track in tracks),
+        dtype=np.int64, count=len(tracks))
+
+    # the first occurrence of each new id describes the new track
+    new_ids, first_index = np.unique(track_ids[track_ids >= n_seen],
+                                     return_index=True)
+    first_index = np.flatnonzero(track_ids >= n_seen)[first_index]
+    new_tracks = [tracks[i] for i in first_index]
+    track_columns = {}
+    for column in TRACK_STR_COLUMNS:
+        track_columns[column] = np.array(
+            [track[column] for track in new_tracks], dtype=object)
+    track_columns["duration_s"] = np.fromiter(
+        map(operator.itemgetter("duration_ms"), new_tracks),
+        dtype=np.int64, count=len(new_tracks)) // 1000
+    track_columns["track_id"] = new_ids
+
+    playlists_chunks.append(playlist_columns)
+    tracks_chunks.append(track_columns)
+    playlist_tracks_chunks.append((track_ids, offsets))
+    return True
+
+
+def reset_ingestion_state():
+    '''
+    Forget all the slices processed so far.
+
     Returns:
         None
     '''
-    assert isinstance(slice, dict)
-    res = validate_slice(slice)
-    assert res[0], res[1]
-
-    # removing the info field and bringing "slice" toe the top level
-    slice["slice"] = slice["info"]["slice"]
-    slice.pop("info")
-
-    for playlist in slice["playlists"]:
-        # convert "collaborative" from str to bool for each playlist
-        collab = playlist["collaborative"]
-        playlist["collaborative"] = (collab == "true")
-
-        # convert "duration_ms" to "duration_s" for each playlist
-        playlist["duration_s"] = playlist["duration_ms"] // 1000
-        playlist.pop("duration_ms")
-
-        for track in playlist["tracks"]:
-            # convert "duration_ms" to "duration_s" for each track
-            track["duration_s"] = track["duration_ms"] // 1000
-            track.pop("duration_ms")
-
-            # new track, append it to tracks_df
-            if (len(track_uri_to_id) == 0 or
-               track["track_uri"] not in track_uri_to_id):
-                track["track_id"] = len(track_uri_to_id)
-                track_uri_to_id[track["track_uri"]] = track["track_id"]
-                del track["pos"]
-                tracks_df_list.append(track)
-
-        # encode tracks to their ids
-        ids = [track_uri_to_id[track["track_uri"]]
-               for track in playlist["tracks"]]
-        playlist["tracks"] = ids
-
-        # most playlist doesn't have a description
-        if "description" in playlist:
-            del playlist["description"]
-        # add the playlist to playlists_df
-        playlists_df_list.append(playlist)
-
-
-def pre_process_dataset(path, new_path):
+    playlists_chunks.clear()
+    tracks_chunks.clear()
+    playlist_tracks_chunks.clear()
+    track_uri_to_id.clear()
+
+
+def concat_chunks(chunks, columns):
+    '''
+    Concatenate per slice column arrays into a single dataframe.
+
+    Args:
+        chunks(list): A list of dicts mapping column names to arrays
+        columns(tuple): The column names in output order
+    Returns:
+        DataFrame: The concatenated columns
+    '''
+    return pd.DataFrame({column: np.concatenate([c[column] for c in chunks])
+                         if chunks else np.empty(0) for column in columns})
+
+
+def check_compression(compression):
+    '''
+    Check that the codec of a compression is installed, before anything is
+    written with it.
+
+    Args:
+        compression(str): None, "gzip" or "zstd"
+
+    Raises:
+        ImportError if zstd is asked for without the zstandard package.
+    '''
+    assert compression in COMPRESSION_SUFFIXES
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd compression needs the zstandard package, "
+                              "install it with `pip install zstandard`") from None
+
+
+def write_pre_processed_table(df, data_path, filename, compression=None):
+    '''
+    Write a pre-processed table, removing the files of the table with the
+    other compressions so that the new one is the one read.
+
+    Args:
+        df(DataFrame): The table
+        data_path(str): Directory of the pre-processed data
+        filename(str): The name of the table file, e.g. TRACKS_DF_FILENAME
+        compression(str): None, "gzip" or "zstd"
+    '''
+    check_compression(compression)
+    for suffix in COMPRESSION_SUFFIXES.values():
+        stale = os.path.join(data_path, filename + suffix)
+        if os.path.isfile(stale):
+            os.remove(stale)
+    df.to_csv(os.path.join(data_path,
+                           filename + COMPRESSION_SUFFIXES[compression]),
+              index=False, compression=COMPRESSION_OPTIONS[compression])
+
+
+def canonical_track_ids(tracks_df):
+    '''
+    Map every track to the smallest track_id of its aliases, the tracks with
+    the same name, artist and duration under different URIs.
+
+    Args:
+        tracks_df(DataFrame): The tracks, row i is track_id i
+    Returns:
+        array: canonical[track_id] is the canonical track_id
+    '''
+    with stage("aliases"):
+        return tracks_df.groupby(list(ALIAS_KEY_COLUMNS), sort=False,
+                                 dropna=False)["track_id"].transform(
+                                     "min").to_numpy(dtype=np.int64)
+
+
+def dedup_relations(track_ids, pids):
+    '''
+    Keep one relation per (pid, track_id) pair, in order of first
+    appearance, with the number of times the track is in the playlist.
+
+    Args:
+        track_ids(array): The track id of every relation
+        pids(array): The pid of every relation
+    Returns:
+        tuple(array, array, array): The track ids, pids and multiplicities
+    '''
+    with stage("dedup"):
+        keys = pids * (int(track_ids.max(initial=0)) + 1) + track_ids
+        _, first, multiplicity = np.unique(keys, return_index=True,
+                                           return_counts=True)
+        order = np.argsort(first)
+        first = first[order]
+        return track_ids[first], pids[first], multiplicity[order]
+
+
+def relation_multiplicity(playlist_tracks_df):
+    '''
+    Get the number of times the track of every relation is in its playlist.
+
+    Args:
+        playlist_tracks_df(DataFrame): The playlist/track relations
+    Returns:
+        array: The multiplicities, all 1 if the relations were not
+            deduplicated
+    '''
+    if MULTIPLICITY_COLUMN in playlist_tracks_df:
+        return playlist_tracks_df[MULTIPLICITY_COLUMN].to_numpy(
+            dtype=np.int64)
+    return np.ones(len(playlist_tracks_df), dtype=np.int64)
+
+
+def pre_process_dataset(path, new_path, validation="full", sample_frac=0.1,
+                        partition=False, aggregates=None, compression=None,
+                        dedup=False, canonicalize=False):
     '''
     Given the directory of the dataset, for each slice first modified it by
     the rules described in generate_new_slice.
@@ -158,21 +435,47 @@ def pre_process_dataset(path, new_path):
     tracks_df has the fields: track_id, name, artist, and other metadata.
 
     playlist_tracks_df has the field: track_id and pid which could be used to
-    tell which playlists contain a certain track.
+    tell which playlists contain a certain track. With dedup it has one row
+    per playlist and track with the number of times the track is in the
+    playlist in a multiplicity column.
+
+    With canonicalize the alias tracks, with the same name, artist and
+    duration as a track with a smaller track_id, are replaced by that track
+    in the playlists and relations. They keep their rows in tracks_df, and
+    "track_aliases.csv" maps their track_id to the canonical_id.
 
 
     The generated dataframe will be saved in to the new_path directory with
-    names "playlists_df.csv", "tracks_df.csv", and "playlist_track.csv".
+    names "playlists_df.csv", "tracks_df.csv", and "playlist_track.csv",
+    with a ".gz" or ".zst" suffix if compressed.
+    The errors found while validating the slices are saved in
+    "validation_report.json". With partition the playlists and relations are
+    also saved partitioned by month of modified_at, see partitions.py. With
+    aggregates the slices that are not in the aggregate state saved there
+    are folded into it, see aggregates.py.
 
     Args:
         path(str): Directory of the MPD dataset
         new_path(str): Directory of where to store the dataframes
+        validation(str): One of VALIDATION_MODES
+        sample_frac(float): Fraction of playlists validated in "sampled" mode
+        partition(bool): Whether to also save month partitions
+        aggregates(str): Directory of the aggregate state to update
+        compression(str): Compress the dataframes with "gzip" or "zstd",
+            zstd needs the zstandard package
+        dedup(bool): Whether to deduplicate the relations
+        canonicalize(bool): Whether to replace alias tracks by one track
     Returns:
-        None
+        dict: The validation report
     '''
-    global playlists_df_list, tracks_df_list, track_uri_to_id
     assert isinstance(path, str)
     assert isinstance(new_path, str)
+    check_compression(compression)
+    report = new_validation_report(validation, sample_frac)
+    reset_ingestion_state()
+    if aggregates is not None:
+        from aggregates import AggregateState
+        aggregate_state = AggregateState.load(aggregates)
 
     filenames = os.listdir(path)
     # go through each file in the directory
@@ -180,71 +483,211 @@ def pre_process_dataset(path, new_path):
         # check if the file is a slice of the dataset
         if filename.startswith("mpd.slice.") and filename.endswith(".json"):
             # load the slice
-            with open(os.sep.join((path, filename))) as f:
-                mpd_slice = json.load(f)
+            with stage("load"):
+                mpd_slice = load_slice(os.sep.join((path, filename)))
 
             # process this slice
-            process_slice(mpd_slice)
+            with stage("extract"):
+                processed = process_slice(mpd_slice, validation, sample_frac,
+                                          report)
+            if not processed:
+                print(f"Skipping invalid slice {filename}")
+            elif aggregates is not None:
+                # fold the playlists that passed validation
+                with stage("aggregate"):
+                    aggregate_state.fold_slice(filename, mpd_slice,
+                                               playlists_chunks[-1]["pid"])
 
-    del track_uri_to_id
     # generate tracks_df and playlists_df
     if not os.path.isdir(new_path):
         os.makedirs(new_path)
-    tracks_df = pd.DataFrame.from_dict(tracks_df_list)
-    del tracks_df_list
-    playlists_df = pd.DataFrame.from_dict(playlists_df_list)
-    del playlists_df_list
-    tracks_df.to_csv(os.sep.join((new_path, TRACKS_DF_FILENAME)), index=False)
-    playlists_df.to_csv(os.sep.join((new_path, PLAYLISTS_DF_FILENAME)),
-                        index=False)
-
-    # generate playlist_tracks_df
-    playlist_tracks_df = pd.DataFrame({
-        "track_id": playlists_df["tracks"].explode(),
-        "pid": playlists_df["pid"].repeat(
-            playlists_df["tracks"].apply(len))
-    })
-    playlist_tracks_df.to_csv(os.sep.join((new_path,
-                                           PLAYLIST_TRACKS_DF_FILENAME)),
-                              index=False)
-
-
-def read_pre_processed_data(data_path):
-    """Read the pre-processed MPD data into dataframes.
+    with stage("write"):
+        tracks_df = concat_chunks(tracks_chunks, TRACKS_DF_COLUMNS)
+        write_pre_processed_table(tracks_df, new_path, TRACKS_DF_FILENAME,
+                                  compression)
+        relation_chunks = playlist_tracks_chunks
+        for suffix in COMPRESSION_SUFFIXES.values():
+            stale = os.path.join(new_path, TRACK_ALIASES_FILENAME + suffix)
+            if os.path.isfile(stale):
+                os.remove(stale)
+        if canonicalize:
+            canonical = canonical_track_ids(tracks_df)
+            aliases = np.flatnonzero(canonical != np.arange(len(canonical)))
+            write_pre_processed_table(
+                pd.DataFrame({"track_id": aliases,
+                              "canonical_id": canonical[aliases]}),
+                new_path, TRACK_ALIASES_FILENAME, compression)
+            relation_chunks = [(canonical[ids], offsets)
+                               for ids, offsets in playlist_tracks_chunks]
+        del tracks_df
+
+        # playlists store the ids of their tracks as a list, a slice
+        # without playlists has no lists
+        playlist_track_ids = [ids.tolist()
+                              for track_ids, offsets in relation_chunks
+                              if len(offsets) > 1
+                              for ids in np.split(track_ids, offsets[1:-1])]
+        playlists_df = concat_chunks(playlists_chunks, PLAYLISTS_DF_COLUMNS)
+        playlists_df.insert(playlists_df.columns.get_loc("num_followers") + 1,
+                            "tracks",
+                            pd.Series(playlist_track_ids, dtype=object))
+        write_pre_processed_table(playlists_df, new_path,
+                                  PLAYLISTS_DF_FILENAME, compression)
+        del playlist_track_ids
+
+        # generate playlist_tracks_df
+        track_ids = [np.zeros(0, dtype=np.int64)]
+        lengths = [np.zeros(0, dtype=np.int64)]
+        for ids, offsets in relation_chunks:
+            track_ids.append(ids)
+            lengths.append(np.diff(offsets))
+        playlist_tracks_df = pd.DataFrame({
+            "track_id": np.concatenate(track_ids),
+            "pid": np.repeat(playlists_df["pid"].to_numpy(dtype=np.int64),
+                             np.concatenate(lengths))
+        })
+        del relation_chunks
+        if dedup:
+            track_ids, pids, multiplicity = dedup_relations(
+                playlist_tracks_df["track_id"].to_numpy(),
+                playlist_tracks_df["pid"].to_numpy())
+            playlist_tracks_df = pd.DataFrame({
+                "track_id": track_ids, "pid": pids,
+                MULTIPLICITY_COLUMN: multiplicity})
+        write_pre_processed_table(playlist_tracks_df, new_path,
+                                  PLAYLIST_TRACKS_DF_FILENAME, compression)
+        if partition:
+            from partitions import write_partitions
+            write_partitions(playlists_df, playlist_tracks_df, new_path, compression)
+    reset_ingestion_state()
+    if aggregates is not None:
+        aggregate_state.save(aggregates)
+
+    with open(os.path.join(new_path, VALIDATION_REPORT_FILENAME), "w") as f:
+        json.dump(report, f, indent=2)
+    if report["errors"]:
+        print(f"{len(report['errors'])} validation errors, see "
+              f"{VALIDATION_REPORT_FILENAME}")
+    return report
+
+
+def playlist_track_ids(playlist_df, desc='Parsing playlist tracks', chunksize=100000):
+    '''
+    Parse the "[1, 2]" tracks column of a playlists dataframe once into a flat
+    array of track ids and the number of tracks of each playlist.
+
+    Args:
+        playlist_df(DataFrame): playlists_df or a subset of its rows
+        desc(str): The description of the progress bar
+        chunksize(int): The number of playlists parsed at a time
+    Returns:
+        tuple(array, array): The track ids and the length of each playlist
+    '''
+    track_ids, lengths = [], []
+    for start in tqdm(range(0, len(playlist_df), chunksize), desc=desc):
+        lists = playlist_df['tracks'].iloc[start:start + chunksize].str[1:-1]
+        lengths.append(np.where(lists.str.len() > 0, lists.str.count(',') + 1, 0))
+        text = ','.join(lists[lists.str.len() > 0])
+        track_ids.append(np.array(text.split(','), dtype=np.int64) if text else np.zeros(0, dtype=np.int64))
+    if not track_ids:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(track_ids), np.concatenate(lengths)
+
+
+def pre_processed_table_path(data_path, filename):
+    """Find the file of a pre-processed MPD dataframe, plain or compressed.
 
     Args:
         data_path (str): A path to the directory that contains the pre-processed
             MPD data CSVs.
-    
+        filename (str): The name of the dataframe file, e.g. TRACKS_DF_FILENAME.
+
     Returns:
-        A tuple of three dataframes of the respective playlists data, tracks data,
-        and playlists/tracks relations data.
-    
+        The path of the file.
+
     Raises:
-        ValueError if data_path or any contained files does not exist or is invalid.
+        ValueError if data_path or the file does not exist or is invalid.
     """
     if not os.path.exists(data_path):
         raise ValueError(f"Data path {data_path} does not exist.")
-    
+
     if not os.path.isdir(data_path):
         raise ValueError(f"Data path {data_path} must be a directory.")
+
+    for suffix in COMPRESSION_SUFFIXES.values():
+        table_filename = os.path.join(data_path, filename + suffix)
+        if os.path.isfile(table_filename):
+            return table_filename
+    raise ValueError(f"Filename {os.path.join(data_path, filename)} must exist.")
+
+
+def read_pre_processed_table(data_path, filename, chunksize=None):
+    """Read a single pre-processed MPD dataframe.
+
+    Args:
+        data_path (str): A path to the directory that contains the pre-processed
+            MPD data CSVs.
+        filename (str): The name of the dataframe file, e.g. TRACKS_DF_FILENAME.
+        chunksize (int): Stream the dataframe in chunks of this many rows
+            instead, a compressed file is decompressed as it is read.
+
+    Returns:
+        The dataframe, or an iterator of its chunks with chunksize.
+
+    Raises:
+        ValueError if data_path or the file does not exist or is invalid.
+    """
+    table_filename = pre_processed_table_path(data_path, filename)
+    if chunksize is not None:
+        return pd.read_csv(table_filename, chunksize=chunksize)
+
+    with stage("load"):
+        return pd.read_csv(table_filename)
+
+
+def read_pre_processed_data(data_path, start=None, end=None, chunksize=None,
+                            shared=None):
+    """Read the pre-processed MPD data into dataframes.
+
+    Args:
+        data_path (str): A path to the directory that contains the pre-processed
+            MPD data CSVs.
+        start (str/int): Only read the playlists modified from this date or
+            unix time on. Requires partitioned data, and only the partitions of
+            the time range are read.
+        end (str/int): Only read the playlists modified before this date or
+            unix time.
+        chunksize (int): Stream the playlists and relations data in chunks of
+            this many rows instead of reading them whole. The tracks data is
+            always read whole, its rows are looked up by track_id.
+        shared (SharedDataset): Build the tracks and relations data from the
+            arrays of a shared_dataset handle instead of reading any file,
+            e.g. get_worker_dataset() in a pool worker. See
+            shared_dataset.shared_frames for their columns.
     
-    playlists_filename = os.path.join(data_path, PLAYLISTS_DF_FILENAME)
-    tracks_filename = os.path.join(data_path, TRACKS_DF_FILENAME)
-    playlists_tracks_filename = os.path.join(data_path, PLAYLIST_TRACKS_DF_FILENAME)
-    
-    if not os.path.isfile(playlists_filename):
-        raise ValueError(f"Playlists filename {playlists_filename} must exist.")
-    
-    if not os.path.isfile(tracks_filename):
-        raise ValueError(f"Playlists filename {tracks_filename} must exist.")
+    Returns:
+        A tuple of three dataframes of the respective playlists data, tracks data,
+        and playlists/tracks relations data, with chunksize the first and last
+        are iterators of dataframes. With shared the playlists data is None.
     
-    if not os.path.isfile(playlists_tracks_filename):
-        raise ValueError(f"Playlists filename {playlists_tracks_filename} must exist.")
-
-    playlists_df = pd.read_csv(playlists_filename)
-    tracks_df = pd.read_csv(tracks_filename)
-    playlists_tracks_df = pd.read_csv(playlists_tracks_filename)
+    Raises:
+        ValueError if data_path or any contained files does not exist or is invalid.
+    """
+    if start is not None or end is not None:
+        from partitions import read_time_range
+        assert chunksize is None, "chunksize is not supported with a time range"
+        return read_time_range(data_path, start, end)
+
+    if shared is not None:
+        from shared_dataset import shared_frames
+        assert chunksize is None, "chunksize is not supported with shared data"
+        # every worker reading the tables would cost a copy of them each
+        tracks_df, playlists_tracks_df = shared_frames(shared)
+        return None, tracks_df, playlists_tracks_df
+
+    playlists_df = read_pre_processed_table(data_path, PLAYLISTS_DF_FILENAME, chunksize)
+    tracks_df = read_pre_processed_table(data_path, TRACKS_DF_FILENAME)
+    playlists_tracks_df = read_pre_processed_table(data_path, PLAYLIST_TRACKS_DF_FILENAME, chunksize)
 
     return playlists_df, tracks_df, playlists_tracks_df
 
@@ -254,5 +697,35 @@ if __name__ == "__main__":
     parser.add_argument("path", help="directory of the MPD dataset")
     parser.add_argument("new_path",
                         help="directory of where to store the new dataset")
+    parser.add_argument("--validation", choices=VALIDATION_MODES,
+                        default="full",
+                        help="validate every playlist, a sample, or none")
+    parser.add_argument("--sample_frac", type=float, default=0.1,
+                        help="fraction of playlists per slice to validate "
+                             "in sampled mode")
+    parser.add_argument("--partition", action="store_true",
+                        help="also save the data partitioned by month of "
+                             "modified_at")
+    parser.add_argument("--aggregates", default=None,
+                        help="directory of the aggregate state to fold the "
+                             "new slices into")
+    parser.add_argument("--dedup", action="store_true",
+                        help="keep one relation per playlist and track with "
+                             "a multiplicity column")
+    parser.add_argument("--canonicalize", action="store_true",
+                        help="replace the alias tracks with the same name, "
+                             "artist and duration by one track")
+    parser.add_argument("--compression", choices=("gzip", "zstd"),
+                        default=None,
+                        help="compress the dataframes, zstd needs the "
+                             "zstandard package")
+    add_profile_arguments(parser)
     args = parser.parse_args()
-    pre_process_dataset(args.path, args.new_path)
+    try:
+        check_compression(args.compression)
+    except ImportError as e:
+        parser.error(str(e))
+    with profile_from_args("pre_processing", args):
+        pre_process_dataset(args.path, args.new_path, args.validation,
+                            args.sample_frac, args.partition, args.aggregates,
+                            args.compression, args.dedup, args.canonicalize)
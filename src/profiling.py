@@ -0,0 +1,243 @@
+'''
+Stage timers, peak memory tracking and optional cProfile dumps shared by the
+command line scripts.
+
+Code marks its hot paths with `with stage("join"):`. Unless a script enabled
+profiling with `--profile` this is a no-op, otherwise the wall time, number of
+calls, peak traced Python memory and the peak RSS of every stage are
+collected and saved as a json report when the script finishes.
+'''
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+_active_profiler = None
+# the fallback start of process_uptime where /proc is not available
+_IMPORTED_AT = time.perf_counter()
+
+
+class Profiler:
+    '''Collect per stage timings and memory usage of a run.
+
+    Stages can be nested, a stage entered while another one is running is
+    reported as "outer/inner". Entering the same stage several times adds up
+    its time and keeps the largest peak memory.
+    '''
+
+    def __init__(self, name, output_dir=".", use_cprofile=False):
+        '''
+        Args:
+            name (str): The name of the run, used to name the output files.
+            output_dir (str): The directory to save the report and dumps in.
+            use_cprofile (bool): Whether to also run cProfile over the run.
+        '''
+        assert isinstance(name, str)
+        assert isinstance(output_dir, str)
+        self.name = name
+        self.output_dir = output_dir
+        self.stages = {}
+        self._stack = []
+        self._start = time.perf_counter()
+        self._cprofile = cProfile.Profile() if use_cprofile else None
+
+    def start(self):
+        '''Start tracing memory allocations and, if requested, cProfile.'''
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self._cprofile is not None:
+            self._cprofile.enable()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Time and measure the peak memory of the enclosed block.
+
+        Args:
+            name (str): The name of the stage.
+        '''
+        path = "/".join([frame["path"] for frame in self._stack[-1:]] + [name])
+        # the peak so far belongs to the enclosing stage, fold it in before
+        # resetting so that nested stages do not hide it
+        if self._stack:
+            self._stack[-1]["peak"] = max(self._stack[-1]["peak"],
+                                          tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        frame = {"path": path, "peak": 0}
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._stack.pop()
+            peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+            if self._stack:
+                self._stack[-1]["peak"] = max(self._stack[-1]["peak"], peak)
+            record = self.stages.setdefault(path, {
+                "stage": path, "calls": 0, "seconds": 0.0,
+                "peak_traced_mb": 0.0, "max_rss_mb": 0.0})
+            record["calls"] += 1
+            record["seconds"] += seconds
+            record["peak_traced_mb"] = max(record["peak_traced_mb"],
+                                           peak / 2 ** 20)
+            record["max_rss_mb"] = max_rss_mb()
+
+    def report(self):
+        '''Get the collected measurements.
+
+        Returns:
+            dict: The run name, total wall time, peak RSS and the stages in
+                the order they were first entered.
+        '''
+        return {
+            "name": self.name,
+            "argv": sys.argv,
+            "total_seconds": time.perf_counter() - self._start,
+            "max_rss_mb": max_rss_mb(),
+            "stages": list(self.stages.values()),
+        }
+
+    def stop(self):
+        '''Stop profiling and save the report (and cProfile dump).
+
+        Returns:
+            str: The path of the saved json report.
+        '''
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(
+                os.path.join(self.output_dir, f"{self.name}.prof"))
+        tracemalloc.stop()
+        filename = os.path.join(self.output_dir, f"{self.name}_profile.json")
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        return filename
+
+
+def max_rss_mb():
+    '''Get the peak resident set size of this process.
+
+    Returns:
+        float: The peak RSS in MiB. Without the resource module, e.g. on
+            Windows, the peak traced Python memory instead, 0 if memory is
+            not being traced.
+    '''
+    if resource is None:
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB everywhere else
+    if sys.platform == "darwin":
+        return max_rss / 2 ** 20
+    return max_rss / 2 ** 10
+
+
+def process_uptime():
+    '''Get the time since this process started, including the interpreter
+    startup and the imports.
+
+    Returns:
+        float: The seconds since the process started, from /proc on Linux
+            with a resolution of a clock tick. Elsewhere the seconds since
+            this module was imported, which misses the startup before it.
+    '''
+    try:
+        with open("/proc/self/stat") as f:
+            # the command name in parentheses can contain spaces
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime_s = float(f.read().split()[0])
+        return max(uptime_s - start_ticks / os.sysconf("SC_CLK_TCK"), 0.0)
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - _IMPORTED_AT
+
+
+def stage(name):
+    '''Measure the enclosed block as a stage of the active profiler.
+
+    Args:
+        name (str): The name of the stage, e.g. "load", "join", "groupby",
+            "clustering", "api_fetch" or "plotting".
+
+    Returns:
+        A context manager, which does nothing if profiling is not enabled.
+    '''
+    if _active_profiler is None:
+        return contextlib.nullcontext()
+    return _active_profiler.stage(name)
+
+
+def enable_profiling(name, output_dir=".", use_cprofile=False):
+    '''Start a profiler that the stage() calls report to.
+
+    Args:
+        name (str): The name of the run, used to name the output files.
+        output_dir (str): The directory to save the report and dumps in.
+        use_cprofile (bool): Whether to also run cProfile over the run.
+
+    Returns:
+        Profiler: The started profiler.
+    '''
+    global _active_profiler
+    assert _active_profiler is None, "profiling is already enabled"
+    _active_profiler = Profiler(name, output_dir, use_cprofile)
+    _active_profiler.start()
+    return _active_profiler
+
+
+def disable_profiling():
+    '''Stop the active profiler and save its report.
+
+    Returns:
+        str: The path of the saved report, or None if profiling was not
+            enabled.
+    '''
+    global _active_profiler
+    if _active_profiler is None:
+        return None
+    filename = _active_profiler.stop()
+    _active_profiler = None
+    return filename
+
+
+def add_profile_arguments(parser):
+    '''Add the --profile, --profile_dir and --cprofile flags to a parser.
+
+    Args:
+        parser (ArgumentParser): The parser of a command line script.
+    '''
+    parser.add_argument("--profile", action="store_true",
+                        help="save a per stage time and memory report")
+    parser.add_argument("--profile_dir", type=str, default=".",
+                        help="directory to save the profiling output in")
+    parser.add_argument("--cprofile", action="store_true",
+                        help="with --profile, also save a cProfile dump")
+
+
+@contextlib.contextmanager
+def profile_from_args(name, args):
+    '''Profile the enclosed block if the parsed arguments ask for it.
+
+    Args:
+        name (str): The name of the run, used to name the output files.
+        args (Namespace): Arguments parsed by a parser that had
+            add_profile_arguments called on it.
+    '''
+    if not args.profile:
+        yield
+        return
+    enable_profiling(name, args.profile_dir, args.cprofile)
+    try:
+        yield
+    finally:
+        print(f"Profiling report saved to {disable_profiling()}")
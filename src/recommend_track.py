@@ -1,16 +1,27 @@
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.metrics.pairwise import cosine_similarity
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
-from dotenv import load_dotenv
-import os
-from analysis import *
 import time
+import sys
+import os
 import argparse
-from sklearn.metrics import davies_bouldin_score, silhouette_score, calinski_harabasz_score
+import pandas as pd
+import numpy as np
+from tqdm import tqdm
+from pre_processing import (read_pre_processed_table, TRACKS_DF_FILENAME,
+                            PLAYLIST_TRACKS_DF_FILENAME)
+from profiling import stage, add_profile_arguments, profile_from_args, process_uptime
+from indexes import build_index, spotify_ids
+from compact_features import CompactFeatures, QUANTIZED_DTYPES
+from recommendation_cache import RecommendationCache, top_seed_ids
+
+# matplotlib, seaborn, scikit-learn and spotipy take seconds to import, so
+# they are imported inside the functions that need them to keep the common
+# path of reading the clusters and sampling from them fast, the budget counts
+# from the start of the process so it includes the interpreter startup
+STARTUP_BUDGET_S = 0.5
+CLUSTER_SOURCES = ('kmeans', 'graph')
+# written by graph_clustering.py, which imports scipy, so the path is repeated here
+GRAPH_CLUSTER_PATH = '../data/tracks_graph_cluster.csv'
+KMEANS_CLUSTER_PATH = '../data/tracks_cluster.csv'
+TRACK_FEATURES_PATH = '../data/tracks_features.csv'
 
 def get_time():
     '''Get the current time in a readable format
@@ -31,49 +42,64 @@ def most_followed_playlist(playlist_df,N=10):
     Returns:
         The id of the most followed playlist.
     """
+    from plots import save_bar_plot
+
     assert isinstance(playlist_df, pd.DataFrame)
-    playlist_df.sort_values(by='num_followers', ascending=False, inplace=True)
-    top_10_playlists = playlist_df.head(N)
+    # select the top N without sorting the caller's DataFrame in place
+    top_10_playlists = playlist_df.nlargest(N, 'num_followers')
     save_bar_plot(f"top{N}_playlist.png", top_10_playlists, x="name", y="num_followers", title=f"Top {N} Most Followed Playlists")
     return top_10_playlists
    
 
 def spotipy_authenticate():
+    import spotipy
+    from spotipy.oauth2 import SpotifyClientCredentials
+
     sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(
         client_id=os.environ['SPOTIFY_CLIENT_ID'],
         client_secret=os.environ['SPOTIFY_CLIENT_SECRET']
     ))
     return sp
 
-def get_playlist_tracks(playlist_tracks_df,playlist_id):
+def get_playlist_tracks(playlist_tracks_df,playlist_id,index=None):
     """Get the track_ids in the playlists.
 
     Args:
         playlist_id : The id of the playlist.
         playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
             associations.
+        index (DatasetIndex): Lookup indexes of the data, the dataframe is
+            scanned if None.
 
     Returns:
         A DataFrame of the track_ids in the playlist.
     """
     assert isinstance(playlist_tracks_df, pd.DataFrame)
-    assert playlist_id > 0
+    assert playlist_id >= 0
+    if index is not None and index.playlist_tracks is not None:
+        return pd.Series(index.playlist_tracks.group(playlist_id), name='track_id')
     return playlist_tracks_df[playlist_tracks_df['pid'] == playlist_id]['track_id']
 
 
-def get_track_info(tracks_df,track_index):
+def get_track_info(tracks_df,track_index,index=None):
     """Get track info for the given track_id
 
     Args:
         track_index : The index of the track.
         tracks_df (DataFrame): A DataFrame of the unique tracks data.
+        index (DatasetIndex): Lookup indexes of the data, the dataframe is
+            scanned if None.
 
     Returns:
         A DataFrame of the track info for the given track_index.
     """
     assert isinstance(tracks_df, pd.DataFrame)
     assert isinstance(track_index, pd.Series)
-    tracks_info = tracks_df[tracks_df['track_id'].isin(track_index)][['track_uri', 'track_name']]
+    if index is not None:
+        rows = np.unique(index.tracks_rows(track_index.to_numpy()))
+        tracks_info = tracks_df.iloc[rows[rows >= 0]][['track_uri', 'track_name']]
+    else:
+        tracks_info = tracks_df[tracks_df['track_id'].isin(track_index)][['track_uri', 'track_name']]
     tracks_info['track_id'] = tracks_info['track_uri'].apply(lambda x: x.split(':')[-1])
     return tracks_info
 
@@ -87,6 +113,8 @@ def fetch_audio_features(sp, tracks_info):
     Returns:
         A DataFrame of the audio features for the tracks in the tracks_info.
     """
+    import spotipy
+
     assert isinstance(tracks_info, pd.DataFrame)
     assert isinstance(sp, spotipy.client.Spotify)
     assert 'track_uri' in tracks_info.columns
@@ -98,12 +126,15 @@ def fetch_audio_features(sp, tracks_info):
     audio_features = []
     
     while index < playlist.shape[0]:
-        audio_features += sp.audio_features(playlist.iloc[index:index + 50]["track_uri"])
+        with stage("api_fetch"):
+            audio_features += sp.audio_features(playlist.iloc[index:index + 50]["track_uri"])
         index += 50
     
+    # hash the names once instead of scanning tracks_info for every track
+    track_names = dict(zip(tracks_info['track_id'][::-1], tracks_info['track_name'][::-1]))
     features_list = []
     for features in audio_features:
-        features_list.append([features['id'],tracks_info[tracks_info['track_id'] == features['id']]["track_name"].values[0],
+        features_list.append([features['id'],track_names[features['id']],
                               features['danceability'],
                               features['energy'], features['tempo'],
                               features['loudness'], features['valence'],
@@ -119,51 +150,134 @@ def fetch_audio_features(sp, tracks_info):
         
     return df_audio_features
 
-def reccomended_track_similarity(tracks_df,cluster_tracks_df,recommended_tracks,current_song_id,plot=True):
-    song = cluster_tracks_df[cluster_tracks_df['id'] == current_song_id].drop('id', axis=1)
-    track_audio_features = cluster_tracks_df[cluster_tracks_df['id'].isin(recommended_tracks['id'])].drop('id', axis=1).drop_duplicates()
-    song = song.to_numpy()
-    song = song[0]
-    track_audio_features = track_audio_features.to_numpy()
-
-    cos_sim = cosine_similarity([song], track_audio_features)
+def reccomended_track_similarity(tracks_df,cluster_tracks_df,recommended_tracks,current_song_id,plot=True,index=None,return_ids=False):
+    from sklearn.metrics.pairwise import cosine_similarity
+
+    if isinstance(cluster_tracks_df, CompactFeatures):
+        # compare the dequantized raw feature values, like the DataFrame path
+        rows = np.unique(cluster_tracks_df.rows(recommended_tracks['id']))
+        rows = rows[rows >= 0]
+        cos_sim = cluster_tracks_df.cosine_similarity(cluster_tracks_df.row(current_song_id), rows, standardized=False)
+        candidate_ids = cluster_tracks_df.spotify_ids(rows)
+    else:
+        if index is not None and index.cluster_rows is not None:
+            song = cluster_tracks_df.iloc[[index.cluster_rows.row(current_song_id)]].drop('id', axis=1)
+            rows = np.unique(index.cluster_rows.rows(recommended_tracks['id']))
+            candidates = cluster_tracks_df.iloc[rows[rows >= 0]]
+        else:
+            song = cluster_tracks_df[cluster_tracks_df['id'] == current_song_id].drop('id', axis=1)
+            candidates = cluster_tracks_df[cluster_tracks_df['id'].isin(recommended_tracks['id'])]
+        # keep the first of the rows with the same features, and its id
+        candidates = candidates[~candidates.drop('id', axis=1).duplicated()]
+        candidate_ids = candidates['id'].to_numpy()
+        song = song.to_numpy()
+        song = song[0]
+        track_audio_features = candidates.drop('id', axis=1).to_numpy()
+
+        cos_sim = cosine_similarity([song], track_audio_features)
 
     if plot :
-        plt.figure(figsize=(20, 1))
-        sns.heatmap(cos_sim, cmap='coolwarm', annot=True,) 
-        current_song = recommended_tracks[recommended_tracks['id'] == current_song_id]['track_name'].values[0]
-        plt.title(f'Cosine Similarity Matrix of song {current_song} with all other songs in the playlist')
-        plt.show()
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+
+        with stage("plotting"):
+            plt.figure(figsize=(20, 1))
+            sns.heatmap(cos_sim, cmap='coolwarm', annot=True,) 
+            current_song = recommended_tracks[recommended_tracks['id'] == current_song_id]['track_name'].values[0]
+            plt.title(f'Cosine Similarity Matrix of song {current_song} with all other songs in the playlist')
+            plt.show()
+    if return_ids :
+        # the similarities are in the order of the candidate rows, not of recommended_tracks
+        return cos_sim, candidate_ids
     return cos_sim
 
-def next_song_from_playlist(tracks_df,cluster_tracks_df,track_audio_features, current_song_id,N=10):
+def next_song_from_playlist(tracks_df,cluster_tracks_df,track_audio_features, current_song_id,N=10,index=None,diversity=None,cache=None):
     """Get the next song from the playlist
 
     Args:
         current_song_id : The id of the song to compare with the playlist.
         track_audio_features (DataFrame): A DataFrame of the audio features for the tracks in the playlist.
+        index (DatasetIndex): Lookup indexes of the data, the dataframes are
+            scanned if None.
+        diversity (dict): Options of diversity.diversify to re-rank the
+            similar songs with MMR, e.g. {"lambda_": 0.7, "max_per_artist": 2},
+            the N most similar songs if None.
+        cache (RecommendationCache): Reuse the songs recommended for the same
+            song, playlist, N and diversity, computed every time if None.
 
     Returns:
         A DataFrame of the next song from the playlist based in similarity with current song.
     """
-    cos_sim = reccomended_track_similarity(tracks_df,cluster_tracks_df,track_audio_features, current_song_id, plot = False)[0]
-    similarity_index = sorted(cos_sim)[-N:][::-1]
-    top_similar_songs = cos_sim.argsort()[-N:][::-1]
-    top_similar_songs = top_similar_songs.tolist()
-    track_audio_features = track_audio_features.to_numpy()
-
-    similar_songs = []
-    for song in top_similar_songs:
-        similar_songs.append(track_audio_features[song][0])
-
-    similar_songs = np.array(similar_songs)
-
+    if cache is not None :
+        params = {'playlist': tuple(track_audio_features['id']),
+                  'diversity': tuple(sorted((diversity or {}).items()))}
+        return cache.get_or_compute('playlist', current_song_id, N, lambda seed, N :
+                                    next_song_from_playlist(tracks_df, cluster_tracks_df, track_audio_features,
+                                                            seed, N, index, diversity), params)
+    cos_sim, candidate_ids = reccomended_track_similarity(tracks_df,cluster_tracks_df,track_audio_features, current_song_id, plot = False, index=index, return_ids=True)
+    cos_sim = cos_sim[0]
+    if diversity is not None :
+        from diversity import diversify
+
+        # look up the candidates by id, the similarities are not in the order of the playlist
+        if index is not None:
+            rows = index.spotify_rows.rows(candidate_ids)
+        else:
+            rows = pd.Index(tracks_df['id']).get_indexer(candidate_ids)
+        artists = np.where(rows >= 0, tracks_df['artist_uri'].to_numpy()[rows], None)
+        albums = np.where(rows >= 0, tracks_df['album_uri'].to_numpy()[rows], None)
+        candidates = track_audio_features.drop_duplicates('id').set_index('id').loc[candidate_ids]
+        features = candidates.drop(columns=['track_name']).to_numpy(dtype=np.float32)
+        top_similar_songs = diversify(cos_sim, features, N, artists, albums, **diversity).tolist()
+    else :
+        top_similar_songs = cos_sim.argsort()[-N:][::-1]
+        top_similar_songs = top_similar_songs.tolist()
+
+    similar_songs = np.asarray(candidate_ids)[top_similar_songs]
+
+    if index is not None:
+        rows = np.unique(index.spotify_rows.rows(similar_songs))
+        similar_tracks = tracks_df.iloc[rows[rows >= 0]]
+    else:
+        similar_tracks = tracks_df[tracks_df['id'].isin(similar_songs)]
     recommended_tracks = pd.DataFrame({
-        'track_name' : tracks_df[tracks_df['id'].isin(similar_songs)]['track_name'],
+        'track_name' : similar_tracks['track_name'],
     })
     return recommended_tracks
 
-def playlist_track_features(tracks_df, playlist_tracks_df, playlist_id):
+def similar_tracks_from_embeddings(tracks_df, embeddings, current_song_id, candidate_tracks=None, N=10, index=None):
+    """Get the songs with the most similar embeddings to the current song
+
+    Args:
+        tracks_df (DataFrame): A DataFrame of the unique tracks data.
+        embeddings (CompactFeatures): The track embeddings, from
+            embeddings.load_track_embeddings.
+        current_song_id : The id of the song to compare with.
+        candidate_tracks (Series): The track_ids to choose from, e.g. the
+            tracks of a playlist, all the tracks if None.
+        N (int): The number of songs to recommend.
+        index (DatasetIndex): Lookup indexes of the data, the dataframes are
+            scanned if None.
+
+    Returns:
+        A DataFrame of the recommended songs, most similar first.
+    """
+    assert isinstance(embeddings, CompactFeatures)
+    candidate_rows = None
+    if candidate_tracks is not None:
+        candidate_ids = get_track_info(tracks_df, candidate_tracks, index)['track_id']
+        candidate_rows = embeddings.rows(candidate_ids)
+        candidate_rows = np.unique(candidate_rows[candidate_rows >= 0])
+    rows, _ = embeddings.top_n_similar(embeddings.row(current_song_id), N, candidate_rows, standardized=False)
+    similar_songs = embeddings.spotify_ids(rows)
+    if index is not None:
+        rows = index.spotify_rows.rows(similar_songs)
+        similar_tracks = tracks_df.iloc[rows[rows >= 0]]
+    else:
+        similar_tracks = tracks_df.set_index('id').loc[similar_songs].reset_index()
+    return similar_tracks[['track_name']]
+
+def playlist_track_features(tracks_df, playlist_tracks_df, playlist_id, index=None):
     """Get the track features for the given playlist
 
     Args:
@@ -171,15 +285,17 @@ def playlist_track_features(tracks_df, playlist_tracks_df, playlist_id):
         track_df (DataFrame): A DataFrame of the unique tracks data.
         playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
             associations.
+        index (DatasetIndex): Lookup indexes of the data, the dataframes are
+            scanned if None.
 
     Returns:
         A DataFrame of the track features for the given playlist.
     """
     assert isinstance(tracks_df, pd.DataFrame)
     assert isinstance(playlist_tracks_df, pd.DataFrame)
-    assert playlist_id > 0
-    playlist_tracks = get_playlist_tracks(playlist_tracks_df, playlist_id)
-    track_info = get_track_info(tracks_df, playlist_tracks)
+    assert playlist_id >= 0
+    playlist_tracks = get_playlist_tracks(playlist_tracks_df, playlist_id, index)
+    track_info = get_track_info(tracks_df, playlist_tracks, index)
     sp = spotipy_authenticate()
     track_audio_features = fetch_audio_features(sp, track_info)
     track_audio_features.reset_index(inplace=True)
@@ -195,92 +311,132 @@ def get_track_features(sp,tracks_df,save_df=False):
         A DataFrame of the audio features for the tracks in the tracks_df.
     '''
     
-    track_features = sp.audio_features(tracks_df['track_uri'])
+    with stage("api_fetch"):
+        track_features = sp.audio_features(tracks_df['track_uri'])
     track_features = pd.DataFrame(track_features)
     track_features.drop(['analysis_url','track_href','uri','type','key','mode','time_signature'],axis=1,inplace=True)
     return track_features
 
 # get the features in chunks
-def get_track_features_in_chunks(tracks_df,chunk_size=100):
+def get_track_features_in_chunks(tracks_df,chunk_size=100,save=False,path=TRACK_FEATURES_PATH):
     '''Get the audio features of the tracks in the tracks_df DataFrame in chunks
     Args:
         tracks_df (DataFrame): A DataFrame of the unique tracks data.
         chunk_size (int): The size of the chunks to get the features in.
+        save (bool): Write the features to path as they are fetched, each chunk
+            is appended once. A path ending in .gz or .zst is compressed, as
+            appended gzip members or zstd frames.
+        path (str): The CSV of the features.
         
     Returns:
         A DataFrame of the audio features for the tracks in the tracks_df.
     '''
     sp = spotipy_authenticate()
-    track_features = pd.DataFrame()
+    chunks = []
     for i in tqdm(range(0,len(tracks_df),chunk_size)):
         try : 
-            track_features = pd.concat([track_features,get_track_features(sp,tracks_df[i:i+chunk_size])])
+            chunk = get_track_features(sp,tracks_df[i:i+chunk_size])
         except :
             sp = spotipy_authenticate()
-            track_features = pd.concat([track_features,get_track_features(sp,tracks_df[i:i+chunk_size])])
-        # update the existing csv file ../data/tracks_features.csv
-        track_features.to_csv('../data/tracks_features1.csv',mode='a', index=False)
+            chunk = get_track_features(sp,tracks_df[i:i+chunk_size])
+        if save :
+            # replace the file on the first chunk and append the new rows after
+            chunk.to_csv(path,mode='a' if chunks else 'w',header=not chunks,index=False)
+        chunks.append(chunk)
         
-    return track_features
+    return pd.concat(chunks,ignore_index=True) if chunks else pd.DataFrame()
 
 def clustering_tracks(tracks_df,k=10):
     '''Cluster the tracks in the tracks_df DataFrame
     Args:
-        tracks_df (DataFrame): A DataFrame of the unique tracks data.
+        tracks_df (DataFrame/CompactFeatures): A DataFrame of the unique tracks data,
+            or their compact features.
         
     Returns:
-        A DataFrame of the tracks and their clusters.
+        A DataFrame of the tracks and their clusters, only the id and cluster
+        columns for compact features.
     '''
+    if isinstance(tracks_df, CompactFeatures):
+        return pd.DataFrame({'id': tracks_df.spotify_ids(), 'cluster': tracks_df.kmeans(k)})
+
 
     from sklearn.cluster import KMeans
     from sklearn.preprocessing import StandardScaler
     # load the data from ../data/tracks_features.csv
-    scaler = StandardScaler()
-    tracks_df_scaled = scaler.fit_transform(tracks_df.drop("id", axis=1))
-    kmeans = KMeans(n_clusters=k, random_state=42)
-    kmeans.fit(tracks_df_scaled)
+    with stage("clustering"):
+        scaler = StandardScaler()
+        tracks_df_scaled = scaler.fit_transform(tracks_df.drop("id", axis=1))
+        kmeans = KMeans(n_clusters=k, random_state=42)
+        kmeans.fit(tracks_df_scaled)
     tracks_df['cluster'] = kmeans.labels_
     return tracks_df
 
-def get_song_cluster(cluster_tracks_df,track_id):
+def get_song_cluster(cluster_tracks_df,track_id,index=None):
     '''
     Get the cluster of the given song
     Args:
         cluster_tracks_df (DataFrame): A DataFrame of the tracks and their clusters.
         track_id (int): The id of the song.
+        index (DatasetIndex): Lookup indexes of the data, the dataframe is
+            scanned if None.
     Returns:
         The cluster of the given song.
     '''
+    if index is not None and index.cluster_rows is not None:
+        return cluster_tracks_df['cluster'].iat[index.cluster_rows.row(track_id)]
     song = cluster_tracks_df[cluster_tracks_df['id'] == track_id]
     return song['cluster'].values[0]
 
-def get_recommendation_from_cluster(cluster_tracks_df,tracks_df,track_id, N=10):
+def get_recommendation_from_cluster(cluster_tracks_df,tracks_df,track_id, N=10, index=None, cache=None):
     '''Get N songs from the same cluster as the given song
     Args:
         cluster_tracks_df (DataFrame): A DataFrame of the tracks and their clusters.
         tracks_df (DataFrame): A DataFrame of the unique tracks data.
         track_id (int): The id of the song.
         N (int): The number of songs to recommend.
+        index (DatasetIndex): Lookup indexes of the data, the dataframes are
+            scanned if None.
+        cache (RecommendationCache): Reuse the songs recommended for the same
+            song and N, computed every time if None.
     Returns:
         A DataFrame of the recommended songs.
     '''
-    cluster = get_song_cluster(cluster_tracks_df,track_id)
-    recommended_songs = cluster_tracks_df[cluster_tracks_df['cluster'] == cluster]
-    return get_song_name(tracks_df,recommended_songs.sample(N))[['track_name']]
-
-def get_song_name(tracks_df,recommended_tracks):
+    if cache is not None :
+        return cache.get_or_compute('cluster', track_id, N, lambda seed, N :
+                                    get_recommendation_from_cluster(cluster_tracks_df, tracks_df, seed, N, index))
+    cluster = get_song_cluster(cluster_tracks_df,track_id,index)
+    if index is not None and index.cluster_members is not None:
+        members = index.cluster_members.group(cluster)
+        # co-occurrence clusters can be smaller than N
+        rows = np.random.choice(members, size=min(N, len(members)), replace=False)
+        recommended_songs = cluster_tracks_df.iloc[rows]
+    else:
+        cluster_songs = cluster_tracks_df[cluster_tracks_df['cluster'] == cluster]
+        recommended_songs = cluster_songs.sample(min(N, len(cluster_songs)))
+    return get_song_name(tracks_df,recommended_songs,index)[['track_name']]
+
+def get_song_name(tracks_df,recommended_tracks,index=None):
     '''
     Get the song names from the recommended_tracks DataFrame
     Args:
         tracks_df (DataFrame): A DataFrame of the unique tracks data.
         recommended_tracks (DataFrame): A DataFrame of the recommended songs.
+        index (DatasetIndex): Lookup indexes of the data, the dataframe is
+            scanned if None.
     Returns:
         A DataFrame of the song names and their ids.
     '''
-    filtered_tracks = tracks_df[tracks_df['id'].isin(recommended_tracks['id'])]
+    if index is not None:
+        rows = np.unique(index.spotify_rows.rows(recommended_tracks['id']))
+        filtered_tracks = tracks_df.iloc[rows[rows >= 0]]
+    else:
+        filtered_tracks = tracks_df[tracks_df['id'].isin(recommended_tracks['id'])]
     return filtered_tracks[['track_name','id']]
 
 def cluster_analysis(tracks_feature_df):
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import davies_bouldin_score, silhouette_score, calinski_harabasz_score
+
     x = []
     y = []
     z = []
@@ -328,36 +484,115 @@ if __name__ == "__main__":
     parser.add_argument('--create_tracks_feature', action='store_true', help='Create dataframe of the tracks features')
     parser.add_argument('--create_cluster', action='store_true', help='Create cluster of the tracks')
     parser.add_argument('--N', type=int, default=10, help='The number of songs to recommend')
-    parser.add_argument('--playlist_id', type=int, default=0, help='The id of the playlist')
-
+    parser.add_argument('--playlist_id', type=int, default=None, help='The id of the playlist')
+    parser.add_argument('--playlist_name', type=str, default=None, help='The name of the playlist, resolved to the most followed playlist with that name')
+    parser.add_argument('--cluster_source', choices=CLUSTER_SOURCES, default='kmeans', help='Recommend from the K-means audio feature clusters or the playlist co-occurrence graph clusters')
+    parser.add_argument('--embeddings', type=str, default=None, help='Recommend by the cosine similarity of the track embeddings saved by embeddings.py at this path')
+    parser.add_argument('--mmr_lambda', type=float, default=None, help='Re-rank the songs from the playlist with maximal marginal relevance, weighting similarity by this and diversity by 1 minus this')
+    parser.add_argument('--max_per_artist', type=int, default=None, help='The most songs from the playlist per artist')
+    parser.add_argument('--max_per_album', type=int, default=None, help='The most songs from the playlist per album')
+    parser.add_argument('--compact', choices=QUANTIZED_DTYPES, default=None, help='Keep the audio features quantized to this dtype in memory')
+    parser.add_argument('--warm', type=int, default=0, help='Warm the recommendation cache with the cluster recommendations of this many most common tracks')
+
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    if args.cluster_source == 'graph' and (args.playlist_id is not None or args.playlist_name) :
+        # the songs from a playlist are ranked by their audio features
+        parser.error('--cluster_source graph can not recommend from a playlist, '
+                     'drop --playlist_id/--playlist_name or use the kmeans clusters')
     current_song_id = args.current_song_id
     create_cluster = args.create_cluster
     create_tracks_feature = args.create_tracks_feature
     N = args.N
     playlist_id = args.playlist_id
     dir = args.dir
-
-    playlist_df, tracks_df, playlist_tracks_df = read_pre_processed_data(dir)
-    tracks_df['id'] = tracks_df['track_uri'].apply(lambda x: x.split(':')[-1])
-
-    if create_cluster : 
-        if create_tracks_feature : 
-            tracks_feature_df = get_track_features_in_chunks(tracks_df,chunk_size=100,save=True)
-        else : tracks_feature_df = pd.read_csv('../data/tracks_features.csv',header=0)
-        cluster_tracks_df = clustering_tracks(tracks_feature_df)
-        cluster_tracks_df.to_csv('../data/tracks_cluster.csv',index=False)
-    else : 
-        cluster_tracks_df = pd.read_csv('../data/tracks_cluster.csv',header=0)
-
-    print(f"Recommended songs for ",tracks_df[tracks_df['id'] == current_song_id]['track_name'].values[0])
-    if playlist_id : 
-        # Reccommend next song to the song from playlist
-        track_audio_features = playlist_track_features(tracks_df, playlist_tracks_df, playlist_id)
-        recommended_tracks = next_song_from_playlist(tracks_df,cluster_tracks_df,track_audio_features, current_song_id, N=N)
-
-    else : 
-        # Reccommend next song to the song from tracks_df
-        recommended_tracks = get_recommendation_from_cluster(cluster_tracks_df,tracks_df,current_song_id, N=N)
-
-    print(recommended_tracks.to_string(index=False))
\ No newline at end of file
+    diversity = None
+    if args.mmr_lambda is not None or args.max_per_artist or args.max_per_album :
+        diversity = {'lambda_': 1.0 if args.mmr_lambda is None else args.mmr_lambda,
+                     'max_per_artist': args.max_per_artist, 'max_per_album': args.max_per_album}
+
+    startup_s = process_uptime()
+    if startup_s > STARTUP_BUDGET_S:
+        print(f"Warning: startup took {startup_s:.2f}s, over the "
+              f"{STARTUP_BUDGET_S}s budget", file=sys.stderr)
+
+    with profile_from_args("recommend_track", args):
+        if args.playlist_name :
+            from playlist_search import load_playlist_search_index
+            try :
+                playlist_id = load_playlist_search_index(dir).resolve(args.playlist_name)
+            except KeyError :
+                parser.error(f"No playlist named {args.playlist_name!r}")
+            print(f"Playlist {args.playlist_name!r} resolved to pid {playlist_id}")
+
+        # only the recommendations from the clusters are warmed
+        warm = args.warm if playlist_id is None and not args.embeddings else 0
+        # the relations are only needed to recommend from a playlist or to warm the cache
+        tracks_df = read_pre_processed_table(dir, TRACKS_DF_FILENAME)
+        if playlist_id is not None or warm :
+            playlist_tracks_df = read_pre_processed_table(dir, PLAYLIST_TRACKS_DF_FILENAME)
+        tracks_df['id'] = spotify_ids(tracks_df['track_uri'])
+
+        if args.embeddings :
+            # the playlist co-occurrence embeddings replace the audio features
+            from embeddings import load_track_embeddings
+            embeddings = load_track_embeddings(args.embeddings, dtype=args.compact or 'float16')
+            cluster_tracks_df = None
+        elif args.cluster_source == 'graph' :
+            # the clusters of the playlist co-occurrence graph have no audio features
+            if create_cluster :
+                from graph_clustering import cluster_tracks_by_cooccurrence, save_graph_clusters
+                cluster_tracks_df = cluster_tracks_by_cooccurrence(tracks_df, read_pre_processed_table(dir, PLAYLIST_TRACKS_DF_FILENAME))
+                save_graph_clusters(cluster_tracks_df, GRAPH_CLUSTER_PATH)
+            else :
+                with stage("load"):
+                    cluster_tracks_df = pd.read_csv(GRAPH_CLUSTER_PATH,header=0)
+        elif create_cluster : 
+            if create_tracks_feature : 
+                tracks_feature_df = get_track_features_in_chunks(tracks_df,chunk_size=100,save=True)
+            else :
+                with stage("load"):
+                    tracks_feature_df = pd.read_csv(TRACK_FEATURES_PATH,header=0)
+            cluster_tracks_df = clustering_tracks(tracks_feature_df)
+            cluster_tracks_df.to_csv(KMEANS_CLUSTER_PATH,index=False)
+        else : 
+            with stage("load"):
+                cluster_tracks_df = pd.read_csv(KMEANS_CLUSTER_PATH,header=0)
+
+        # keep only the quantized features and the cluster labels in memory
+        features = cluster_tracks_df
+        if args.compact and not args.embeddings and args.cluster_source == 'kmeans' :
+            features = CompactFeatures.from_frame(cluster_tracks_df, dtype=args.compact)
+            cluster_tracks_df = cluster_tracks_df[['id', 'cluster']]
+
+        with stage("index"):
+            index = build_index(tracks_df, playlist_tracks_df if playlist_id is not None else None, cluster_tracks_df)
+
+        # the cached results are dropped when the clusters they were sampled from are rewritten
+        cache = RecommendationCache(artifacts=[GRAPH_CLUSTER_PATH if args.cluster_source == 'graph' else KMEANS_CLUSTER_PATH])
+        if warm :
+            with stage("warm"):
+                # the tracks without audio features have no cluster to recommend from
+                clustered = pd.Index(cluster_tracks_df['id'])
+                warm_seeds = [seed for seed in top_seed_ids(tracks_df, playlist_tracks_df, warm) if seed in clustered]
+                cache.warm('cluster', warm_seeds, N, lambda seed, N :
+                           get_recommendation_from_cluster(cluster_tracks_df, tracks_df, seed, N, index))
+
+        print(f"Recommended songs for ",tracks_df['track_name'].iat[index.spotify_rows.row(current_song_id)])
+        if args.embeddings :
+            # Reccommend the most similar songs, from the playlist if given
+            candidate_tracks = get_playlist_tracks(playlist_tracks_df, playlist_id, index) if playlist_id is not None else None
+            recommended_tracks = similar_tracks_from_embeddings(tracks_df, embeddings, current_song_id, candidate_tracks, N=N, index=index)
+
+        elif playlist_id is not None : 
+            # Reccommend next song to the song from playlist
+            track_audio_features = playlist_track_features(tracks_df, playlist_tracks_df, playlist_id, index)
+            recommended_tracks = next_song_from_playlist(tracks_df,features,track_audio_features, current_song_id, N=N, index=index, diversity=diversity, cache=cache)
+
+        else : 
+            # Reccommend next song to the song from tracks_df
+            recommended_tracks = get_recommendation_from_cluster(cluster_tracks_df,tracks_df,current_song_id, N=N, index=index, cache=cache)
+
+        print(recommended_tracks.to_string(index=False))
+        if warm :
+            print(cache.stats())
\ No newline at end of file
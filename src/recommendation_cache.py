@@ -0,0 +1,263 @@
+'''
+A bounded cache of recommendation results for the seeds that are asked for
+over and over.
+
+Results are keyed by (engine, seed, N, params), evicted least recently used
+first once the cache is full, and expire after a time to live. The cache
+watches the artifacts the results were computed from (cluster CSVs, saved
+indexes and embeddings) by modification time and size, and drops all the
+results when any of them changes. warm precomputes the results of the most
+common tracks at startup, and stats reports the hit rate.
+
+Run `python recommendation_cache.py [pre-processed data dir]` to warm a
+cache of K-means cluster recommendations and replay queries against it.
+'''
+from argparse import ArgumentParser
+from collections import OrderedDict
+import os
+import time
+
+import pandas as pd
+
+from profiling import stage
+
+
+def artifact_fingerprint(paths):
+    """Get the modification time and size of files.
+
+    Args:
+        paths (list): The file paths.
+
+    Returns:
+        tuple: A (path, mtime_ns, size) tuple per path, with None for missing
+            files.
+    """
+    fingerprint = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            fingerprint.append((path, None, None))
+        else:
+            fingerprint.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(fingerprint)
+
+
+class RecommendationCache:
+    '''LRU and TTL cache of recommendation DataFrames.'''
+
+    def __init__(self, maxsize=1024, ttl=None, artifacts=()):
+        '''
+        Args:
+            maxsize (int): The most results kept.
+            ttl (float): The seconds a result is valid for, forever if None.
+            artifacts (list): Paths of the files the results depend on, the
+                cache is cleared when one of them changes.
+        '''
+        assert isinstance(maxsize, int) and maxsize > 0
+        assert ttl is None or ttl > 0
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.artifacts = tuple(artifacts)
+        self._fingerprint = artifact_fingerprint(self.artifacts)
+        self._entries = OrderedDict()
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    @staticmethod
+    def key(engine, seed, N, params=None):
+        """Get the cache key of a query.
+
+        Args:
+            engine (str): The recommendation method, e.g. "cluster".
+            seed (str): The id of the current song.
+            N (int): The number of songs.
+            params (dict): Any other arguments that change the result, with
+                hashable values.
+
+        Returns:
+            tuple: The key.
+        """
+        return (engine, seed, N, tuple(sorted((params or {}).items())))
+
+    def _check_artifacts(self):
+        """Clear the cache if an artifact changed."""
+        if not self.artifacts:
+            return
+        fingerprint = artifact_fingerprint(self.artifacts)
+        if fingerprint != self._fingerprint:
+            self._fingerprint = fingerprint
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+
+    def _expired(self, entry):
+        """Whether a cached (result, time) entry is older than the ttl."""
+        return self.ttl is not None and time.monotonic() - entry[1] > self.ttl
+
+    def get(self, key):
+        """Get a cached result.
+
+        Args:
+            key (tuple): The key from RecommendationCache.key.
+
+        Returns:
+            A copy of the DataFrame, None if it is not cached.
+        """
+        self._check_artifacts()
+        entry = self._entries.get(key)
+        if entry is not None and self._expired(entry):
+            del self._entries[key]
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0].copy()
+
+    def put(self, key, result):
+        """Cache a result, evicting the least recently used one if full.
+
+        Args:
+            key (tuple): The key from RecommendationCache.key.
+            result (DataFrame): The recommendations.
+        """
+        assert isinstance(result, pd.DataFrame)
+        self._entries[key] = (result.copy(), time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_compute(self, engine, seed, N, compute, params=None):
+        """Get a cached result or compute and cache it.
+
+        Args:
+            engine (str): The recommendation method.
+            seed (str): The id of the current song.
+            N (int): The number of songs.
+            compute (callable): Maps (seed, N) to the recommendations, e.g. a
+                functools.partial of get_recommendation_from_cluster.
+            params (dict): Any other arguments that change the result.
+
+        Returns:
+            DataFrame: The recommendations.
+        """
+        key = self.key(engine, seed, N, params)
+        result = self.get(key)
+        if result is None:
+            result = compute(seed, N)
+            self.put(key, result)
+        return result
+
+    def warm(self, engine, seeds, N, compute, params=None):
+        """Precompute the results of seeds that are not cached or expired.
+
+        Args:
+            engine (str): The recommendation method.
+            seeds (list): The ids of the songs.
+            N (int): The number of songs.
+            compute (callable): Maps (seed, N) to the recommendations.
+            params (dict): Any other arguments that change the result.
+
+        Returns:
+            int: The number of results computed.
+        """
+        self._check_artifacts()
+        computed = 0
+        for seed in seeds:
+            key = self.key(engine, seed, N, params)
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.put(key, compute(seed, N))
+                computed += 1
+        return computed
+
+    def clear(self):
+        """Drop all the results."""
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        """The fraction of lookups that were hits, 0 before any lookup."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """Get the cache metrics.
+
+        Returns:
+            dict: The size, hits, misses, hit rate, evictions, expirations
+                and invalidations.
+        """
+        return {"size": len(self), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hit_rate, "evictions": self.evictions,
+                "expirations": self.expirations, "invalidations": self.invalidations}
+
+
+def top_seed_ids(tracks_df, playlist_tracks_df, k=100):
+    """Get the song ids of the most common tracks, the seeds to warm.
+
+    Args:
+        tracks_df (DataFrame): A DataFrame of the unique tracks data.
+        playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
+            associations.
+        k (int): The number of seeds.
+
+    Returns:
+        list: The song ids, most common first.
+    """
+    from analysis import get_most_common_tracks
+    from indexes import spotify_ids
+
+    top_tracks = get_most_common_tracks(tracks_df, playlist_tracks_df, n=k)
+    return spotify_ids(top_tracks["track_uri"]).tolist()
+
+
+if __name__ == "__main__":
+    from indexes import build_index, spotify_ids
+    from pre_processing import read_pre_processed_table, TRACKS_DF_FILENAME, PLAYLIST_TRACKS_DF_FILENAME
+    from recommend_track import get_recommendation_from_cluster
+
+    parser = ArgumentParser(description="Warm a recommendation cache and replay queries against it.")
+    parser.add_argument("input_data", type=str, help="Path to the directory of the pre-processed data.")
+    parser.add_argument("--cluster", type=str, default="../data/tracks_cluster.csv", help="The track clusters CSV.")
+    parser.add_argument("-K", type=int, default=100, help="The number of most common tracks to warm.")
+    parser.add_argument("-N", type=int, default=10, help="The number of songs to recommend.")
+    parser.add_argument("--queries", type=int, default=10000, help="The number of queries to replay.")
+    parser.add_argument("--maxsize", type=int, default=1024, help="The most results kept.")
+    parser.add_argument("--ttl", type=float, default=None, help="The seconds a result is valid for.")
+    args = parser.parse_args()
+
+    tracks_df = read_pre_processed_table(args.input_data, TRACKS_DF_FILENAME)
+    playlist_tracks_df = read_pre_processed_table(args.input_data, PLAYLIST_TRACKS_DF_FILENAME)
+    tracks_df["id"] = spotify_ids(tracks_df["track_uri"])
+    cluster_tracks_df = pd.read_csv(args.cluster)
+    index = build_index(tracks_df, None, cluster_tracks_df)
+    def compute(seed, N):
+        return get_recommendation_from_cluster(cluster_tracks_df, tracks_df, seed, N, index)
+
+    # the tracks without audio features have no cluster to recommend from
+    clustered = pd.Index(cluster_tracks_df["id"])
+    cache = RecommendationCache(args.maxsize, args.ttl, artifacts=[args.cluster])
+    with stage("warm"):
+        warm_seeds = [seed for seed in top_seed_ids(tracks_df, playlist_tracks_df, args.K) if seed in clustered]
+        cache.warm("cluster", warm_seeds, args.N, compute)
+
+    # replay queries with seeds drawn like the playlist tracks are
+    track_ids = playlist_tracks_df["track_id"].sample(args.queries, replace=True, random_state=0)
+    seeds = pd.Series(tracks_df["id"].to_numpy(), index=tracks_df["track_id"].to_numpy())[track_ids]
+    seeds = seeds[seeds.isin(clustered)]
+    start = time.perf_counter()
+    for seed in seeds:
+        get_recommendation_from_cluster(cluster_tracks_df, tracks_df, seed, args.N, index, cache=cache)
+    print(f"{len(seeds)} queries in {time.perf_counter() - start:.2f}s, "
+          f"{args.queries - len(seeds)} seeds without a cluster skipped")
+    print(cache.stats())
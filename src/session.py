@@ -0,0 +1,238 @@
+'''
+An online "next song" recommender for a listening session.
+
+A SessionIndex holds the unit length feature vectors of the candidate
+tracks, built once from the compact audio features (or embeddings) and
+shared by every session. A PlaylistSession keeps a running sum of the
+vectors of the songs played and of the songs skipped. Playing or skipping a
+song adds one vector, in O(d) for d features. The next songs are the
+candidates most cosine similar to the played centroid, pushed away from the
+skipped centroid, that were not played or skipped yet. A query is one
+matrix-vector product over the candidates, so its latency depends on the
+size of the index but not on the length of the session.
+
+Run `python session.py [audio features CSV]` to simulate sessions and
+report the latency per step.
+'''
+from argparse import ArgumentParser
+import time
+
+import numpy as np
+import pandas as pd
+
+from compact_features import CompactFeatures, QUANTIZED_DTYPES, normalize
+from profiling import stage
+
+
+class SessionIndex:
+    '''The unit length vectors of the candidate tracks of sessions.'''
+
+    def __init__(self, features, candidate_rows=None, standardized=True):
+        '''
+        Args:
+            features (CompactFeatures): The track features or embeddings.
+            candidate_rows (array): The rows that can be recommended, all rows
+                if None.
+            standardized (bool): Whether to compare standardized values.
+        '''
+        assert isinstance(features, CompactFeatures)
+        self.features = features
+        self.rows = np.arange(len(features)) if candidate_rows is None else np.asarray(candidate_rows)
+        with stage("index"):
+            self.vectors = normalize(features.dequantize(self.rows, standardized))
+        # the position of every feature row in the candidates, -1 if it is not one
+        self.positions = np.full(len(features), -1, dtype=np.int64)
+        self.positions[self.rows] = np.arange(len(self.rows))
+        self.standardized = standardized
+
+    def __len__(self):
+        return len(self.rows)
+
+    def vector(self, row):
+        """Get the unit length vector of a feature row, candidate or not.
+
+        Args:
+            row (int): The row of the features.
+
+        Returns:
+            array: The vector.
+        """
+        position = self.positions[row]
+        if position >= 0:
+            return self.vectors[position]
+        return normalize(self.features.dequantize([row], self.standardized))[0]
+
+
+class PlaylistSession:
+    '''The state of a listening session, updated as songs are played or
+    skipped.'''
+
+    def __init__(self, index, skip_weight=0.5, decay=1.0):
+        '''
+        Args:
+            index (SessionIndex): The candidates to recommend from.
+            skip_weight (float): How strongly the next songs are pushed away
+                from the skipped ones.
+            decay (float): The weight of the earlier songs every time a song
+                is added, 1 weighs all songs equally and lower values follow
+                the recent songs.
+        '''
+        assert isinstance(index, SessionIndex)
+        assert skip_weight >= 0 and 0 < decay <= 1
+        self.index = index
+        self.skip_weight = skip_weight
+        self.decay = decay
+        dimensions = index.vectors.shape[1]
+        self.played = np.zeros(dimensions, dtype=np.float32)
+        self.skipped = np.zeros(dimensions, dtype=np.float32)
+        self.history = []
+        # the candidates that were played or skipped
+        self._seen = np.zeros(len(index), dtype=bool)
+        self._n_seen = 0
+
+    @classmethod
+    def from_playlist(cls, index, rows, **kwargs):
+        """Start a session with the songs of a playlist as played.
+
+        Args:
+            index (SessionIndex): The candidates to recommend from.
+            rows (array): The feature rows of the playlist tracks.
+            kwargs: The other arguments of PlaylistSession.
+
+        Returns:
+            PlaylistSession: The session.
+        """
+        session = cls(index, **kwargs)
+        for row in np.asarray(rows):
+            session.play(int(row))
+        return session
+
+    def _add(self, row, played):
+        """Add a song to the session, in O(d)."""
+        vector = self.index.vector(row)
+        if played:
+            self.played *= self.decay
+            self.played += vector
+        else:
+            self.skipped *= self.decay
+            self.skipped += vector
+        position = self.index.positions[row]
+        if position >= 0 and not self._seen[position]:
+            self._seen[position] = True
+            self._n_seen += 1
+        self.history.append((row, played))
+
+    def play(self, row):
+        """Record that a song was played.
+
+        Args:
+            row (int): The feature row of the song.
+        """
+        self._add(row, True)
+
+    def skip(self, row):
+        """Record that a song was skipped.
+
+        Args:
+            row (int): The feature row of the song.
+        """
+        self._add(row, False)
+
+    def query_vector(self):
+        """Get the vector the next songs are compared to.
+
+        Returns:
+            array: The unit played centroid minus skip_weight times the unit
+                skipped centroid.
+        """
+        query = normalize(self.played)
+        if self.skip_weight > 0 and self.skipped.any():
+            query = query - self.skip_weight * normalize(self.skipped)
+        return query
+
+    def next_rows(self, N=10):
+        """Get the next songs of the session.
+
+        Args:
+            N (int): The number of songs.
+
+        Returns:
+            A tuple of the feature rows of the songs, best first, and their
+                scores.
+        """
+        if not self.played.any() and not self.skipped.any():
+            raise ValueError("The session has no played or skipped songs.")
+        scores = self.index.vectors @ self.query_vector()
+        scores[self._seen] = -np.inf
+        N = min(N, len(scores) - self._n_seen)
+        if N <= 0:
+            return self.index.rows[:0], scores[:0]
+        top = np.argpartition(-scores, N - 1)[:N]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return self.index.rows[top], scores[top]
+
+    def next_ids(self, N=10):
+        """Get the Spotify ids of the next songs of the session.
+
+        Args:
+            N (int): The number of songs.
+
+        Returns:
+            array: The Spotify ids, best first.
+        """
+        rows, _ = self.next_rows(N)
+        return self.index.features.spotify_ids(rows)
+
+
+def simulate(index, seed_rows, steps=100, N=10, skip_rate=0.2, seed=0):
+    """Simulate sessions that play or skip the best next song at every step.
+
+    Args:
+        index (SessionIndex): The candidates to recommend from.
+        seed_rows (array): The first song of every session.
+        steps (int): The number of steps per session.
+        N (int): The number of songs asked for at every step.
+        skip_rate (float): The chance that a song is skipped.
+        seed (int): The seed of the skips.
+
+    Returns:
+        array: The seconds of every step, of shape (sessions, steps).
+    """
+    rng = np.random.default_rng(seed)
+    latencies = np.zeros((len(seed_rows), steps))
+    for i, row in enumerate(seed_rows):
+        session = PlaylistSession(index)
+        session.play(int(row))
+        for step in range(steps):
+            start = time.perf_counter()
+            rows, _ = session.next_rows(N)
+            if len(rows) == 0:
+                break
+            if rng.random() < skip_rate:
+                session.skip(int(rows[0]))
+            else:
+                session.play(int(rows[0]))
+            latencies[i, step] = time.perf_counter() - start
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Simulate online sessions and report the latency per step.")
+    parser.add_argument("features_path", type=str, help="The audio features CSV with an id column.")
+    parser.add_argument("--compact", choices=QUANTIZED_DTYPES, default="int8", help="The dtype of the compact features.")
+    parser.add_argument("--sessions", type=int, default=10, help="The number of sessions.")
+    parser.add_argument("--steps", type=int, default=200, help="The number of steps per session.")
+    parser.add_argument("-N", type=int, default=10, help="The number of songs asked for at every step.")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the first songs and the skips.")
+    args = parser.parse_args()
+
+    features = CompactFeatures.from_frame(pd.read_csv(args.features_path), dtype=args.compact)
+    index = SessionIndex(features)
+    seed_rows = np.random.default_rng(args.seed).choice(len(features), args.sessions, replace=False)
+    latencies = simulate(index, seed_rows, args.steps, args.N, seed=args.seed) * 1000
+    quarter = max(1, args.steps // 4)
+    print(f"{len(index)} candidates, {args.sessions} sessions of {args.steps} steps")
+    print(f"first {quarter} steps: median {np.median(latencies[:, :quarter]):.3f} ms, "
+          f"p99 {np.percentile(latencies[:, :quarter], 99):.3f} ms")
+    print(f"last {quarter} steps: median {np.median(latencies[:, -quarter:]):.3f} ms, "
+          f"p99 {np.percentile(latencies[:, -quarter:], 99):.3f} ms")
@@ -0,0 +1,281 @@
+'''
+Sharded computation of the most common artists and albums and of the number
+of popular artists per playlist, for data too large for one process.
+
+The playlist track relations are split by pid range into shards. A worker
+counts the playlists of every artist and album within its shard, and since
+a playlist is in a single shard the counts of the shards add up to the
+counts of the whole data. The coordinator sums the partial counts and keeps
+the top n with the same ties as analysis.get_most_common_artists, so the
+results are identical to the single-node functions. The popular artist
+counts take a second pass: every worker merges the artist counts itself,
+takes the top n names and counts them in the playlists of its shard.
+
+The workers only share files, so they can be local processes or jobs on
+nodes that mount the same filesystem:
+
+    python sharded.py split ../data/ --shards 8
+    python sharded.py count ../data/ --shard 3      # on every node, per shard
+    python sharded.py popular ../data/ --shard 3    # after all the counts
+    python sharded.py merge ../data/
+
+or `python sharded.py run ../data/ --shards 8 --workers 4` to run all the
+steps with local processes.
+'''
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from analysis import get_inclusion_counts, top_counts, count_artists_in_playlists
+from pre_processing import (read_pre_processed_table, pre_processed_table_path, TRACKS_DF_FILENAME,
+                            PLAYLISTS_DF_FILENAME, PLAYLIST_TRACKS_DF_FILENAME)
+from profiling import stage, add_profile_arguments, profile_from_args
+
+SHARDS_DIRNAME = "shards"
+SHARDS_MANIFEST_FILENAME = "shards.json"
+SHARD_COLUMNS = {"artist": ["artist_uri", "artist_name"], "album": ["album_uri", "album_name"]}
+STEPS = ("split", "count", "popular", "merge", "run")
+
+
+def _shard_filename(shards_path, shard):
+    return os.path.join(shards_path, f"playlist_tracks_{shard:04d}.csv")
+
+
+def _counts_filename(shards_path, shard, kind):
+    return os.path.join(shards_path, f"{kind}_counts_{shard:04d}.csv")
+
+
+def _popular_filename(shards_path, shard):
+    return os.path.join(shards_path, f"popular_artists_{shard:04d}.csv")
+
+
+def shard_bounds(max_pid, n_shards):
+    """Split the pids into ranges of about equal size.
+
+    Args:
+        max_pid (int): The largest pid.
+        n_shards (int): The number of ranges.
+
+    Returns:
+        array: The n_shards + 1 bounds, shard i has the pids in
+            [bounds[i], bounds[i + 1]).
+    """
+    assert isinstance(n_shards, int) and n_shards > 0
+    return np.linspace(0, max_pid + 1, n_shards + 1).round().astype(np.int64)
+
+
+def write_shards(data_path, n_shards, shards_path=None, chunksize=1000000):
+    """Split the playlist track relations into shards by pid range.
+
+    Args:
+        data_path (str): The directory of the pre-processed data.
+        n_shards (int): The number of shards.
+        shards_path (str): The directory of the shards, data_path/shards if
+            None.
+        chunksize (int): The relations read at a time.
+
+    Returns:
+        dict: The manifest saved as shards.json, with the data path and the
+            pid bounds of the shards.
+    """
+    shards_path = shards_path or os.path.join(data_path, SHARDS_DIRNAME)
+    os.makedirs(shards_path, exist_ok=True)
+    # only the pid column is parsed, streamed like the relations
+    max_pid = 0
+    playlists = pd.read_csv(pre_processed_table_path(data_path, PLAYLISTS_DF_FILENAME), usecols=["pid"],
+                            chunksize=chunksize)
+    for chunk in playlists:
+        if len(chunk):
+            max_pid = max(max_pid, int(chunk["pid"].max()))
+    bounds = shard_bounds(max_pid, n_shards)
+
+    with stage("split"):
+        relations_filename = pre_processed_table_path(data_path, PLAYLIST_TRACKS_DF_FILENAME)
+        header = pd.read_csv(relations_filename, nrows=0)
+        for shard in range(n_shards):
+            header.to_csv(_shard_filename(shards_path, shard), index=False)
+            # the partial results of an earlier split are stale
+            for filename in (*(_counts_filename(shards_path, shard, kind) for kind in SHARD_COLUMNS),
+                             _popular_filename(shards_path, shard)):
+                if os.path.isfile(filename):
+                    os.remove(filename)
+        relations = pd.read_csv(relations_filename, chunksize=chunksize)
+        for chunk in tqdm(relations, desc="Splitting relations"):
+            shards = np.searchsorted(bounds, chunk["pid"].to_numpy(), side="right") - 1
+            for shard, rows in chunk.groupby(shards, sort=False):
+                rows.to_csv(_shard_filename(shards_path, shard), mode="a", header=False, index=False)
+
+    manifest = {"data_path": os.path.abspath(data_path), "bounds": bounds.tolist()}
+    with open(os.path.join(shards_path, SHARDS_MANIFEST_FILENAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_manifest(shards_path):
+    """Read the manifest of the shards.
+
+    Args:
+        shards_path (str): The directory of the shards.
+
+    Returns:
+        dict: The manifest from write_shards.
+    """
+    with open(os.path.join(shards_path, SHARDS_MANIFEST_FILENAME)) as f:
+        return json.load(f)
+
+
+def _read_shard(shards_path, shard):
+    return pd.read_csv(_shard_filename(shards_path, shard))
+
+
+def count_shard(shards_path, shard):
+    """Count the playlists of the artists and albums of one shard and save
+    the partial counts.
+
+    Args:
+        shards_path (str): The directory of the shards.
+        shard (int): The shard to count.
+    """
+    tracks_df = read_pre_processed_table(load_manifest(shards_path)["data_path"], TRACKS_DF_FILENAME)
+    playlist_tracks_df = _read_shard(shards_path, shard)
+    for kind, columns in SHARD_COLUMNS.items():
+        counts_df = get_inclusion_counts(tracks_df, playlist_tracks_df, columns)
+        counts_df.to_csv(_counts_filename(shards_path, shard, kind), index=False)
+
+
+def merge_counts(shards_path, kind):
+    """Sum the partial counts of all the shards.
+
+    Args:
+        shards_path (str): The directory of the shards.
+        kind (str): "artist" or "album".
+
+    Returns:
+        A DataFrame of the uri, name and count of playlists, like
+            analysis.get_inclusion_counts over all the data.
+    """
+    columns = SHARD_COLUMNS[kind]
+    n_shards = len(load_manifest(shards_path)["bounds"]) - 1
+    # keep the names as written, the NaN names were already dropped
+    partials = [pd.read_csv(_counts_filename(shards_path, shard, kind), keep_default_na=False, na_values=[])
+                for shard in range(n_shards)]
+    with stage("merge"):
+        return pd.concat(partials).groupby(columns, sort=False)["count"].sum().reset_index()
+
+
+def count_popular_shard(shards_path, shard, n=100):
+    """Count the top n artists in the playlists of one shard and save the
+    counts. Needs the partial counts of all the shards.
+
+    Args:
+        shards_path (str): The directory of the shards.
+        shard (int): The shard to count.
+        n (int): Top N most common artists would be considered as popular.
+    """
+    columns = SHARD_COLUMNS["artist"]
+    top_n_artists = top_counts(merge_counts(shards_path, "artist"), columns, n)
+    tracks_df = read_pre_processed_table(load_manifest(shards_path)["data_path"], TRACKS_DF_FILENAME)
+    counts = count_artists_in_playlists(tracks_df, _read_shard(shards_path, shard), top_n_artists.index)
+    counts.to_csv(_popular_filename(shards_path, shard))
+
+
+def merge_popular(shards_path):
+    """Concatenate the popular artist counts of all the shards.
+
+    Args:
+        shards_path (str): The directory of the shards.
+
+    Returns:
+        pd.Series: The number of top n artists in each playlist, like
+            analysis.get_popular_artist_cnt.
+    """
+    n_shards = len(load_manifest(shards_path)["bounds"]) - 1
+    partials = [pd.read_csv(_popular_filename(shards_path, shard), index_col="pid")["artist_name"]
+                for shard in range(n_shards)]
+    return pd.concat(partials).sort_index()
+
+
+def merge_shards(shards_path, n=10, ascending=False):
+    """Merge the partial results of all the shards.
+
+    Args:
+        shards_path (str): The directory of the shards.
+        n (int): The number of artists and albums to keep.
+        ascending (bool): Keep the rarest artists and albums instead.
+
+    Returns:
+        dict: The most common "artists" and "albums" DataFrames, and the
+            "popular_artist_cnt" Series if the popular step ran.
+    """
+    results = {f"{kind}s": top_counts(merge_counts(shards_path, kind), columns, n, ascending)
+               for kind, columns in SHARD_COLUMNS.items()}
+    n_shards = len(load_manifest(shards_path)["bounds"]) - 1
+    if all(os.path.isfile(_popular_filename(shards_path, shard)) for shard in range(n_shards)):
+        results["popular_artist_cnt"] = merge_popular(shards_path)
+    return results
+
+
+def run_sharded(data_path, n_shards, n=10, popular_n=100, workers=None, shards_path=None):
+    """Run all the steps with local worker processes.
+
+    Args:
+        data_path (str): The directory of the pre-processed data.
+        n_shards (int): The number of shards.
+        n (int): The number of artists and albums to keep.
+        popular_n (int): Top N most common artists would be considered as
+            popular.
+        workers (int): The number of processes, the number of CPUs if None.
+        shards_path (str): The directory of the shards, data_path/shards if
+            None.
+
+    Returns:
+        dict: The results of merge_shards.
+    """
+    shards_path = shards_path or os.path.join(data_path, SHARDS_DIRNAME)
+    write_shards(data_path, n_shards, shards_path)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        with stage("count"):
+            list(executor.map(count_shard, [shards_path] * n_shards, range(n_shards)))
+        with stage("popular"):
+            list(executor.map(count_popular_shard, [shards_path] * n_shards, range(n_shards),
+                              [popular_n] * n_shards))
+    return merge_shards(shards_path, n)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Count the most common artists and albums over shards of the playlists.")
+    parser.add_argument("step", choices=STEPS, help="The step to run, run does all of them with local processes.")
+    parser.add_argument("input_data", type=str, help="Path to the directory of the pre-processed data.")
+    parser.add_argument("--shards_path", type=str, default=None, help="The directory of the shards, input_data/shards by default.")
+    parser.add_argument("--shards", type=int, default=8, help="The number of shards to split into.")
+    parser.add_argument("--shard", type=int, default=None, help="The shard of a count or popular step.")
+    parser.add_argument("--workers", type=int, default=None, help="The number of processes of the run step.")
+    parser.add_argument("-N", type=int, default=10, help="The number of most common artists and albums.")
+    parser.add_argument("--popular_n", type=int, default=100, help="The top N artists counted in every playlist.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    shards_path = args.shards_path or os.path.join(args.input_data, SHARDS_DIRNAME)
+
+    with profile_from_args("sharded", args):
+        if args.step == "split":
+            write_shards(args.input_data, args.shards, shards_path)
+        elif args.step in ("count", "popular"):
+            assert args.shard is not None, f"The {args.step} step needs --shard"
+            if args.step == "count":
+                count_shard(shards_path, args.shard)
+            else:
+                count_popular_shard(shards_path, args.shard, args.popular_n)
+        else:
+            if args.step == "run":
+                results = run_sharded(args.input_data, args.shards, args.N, args.popular_n, args.workers, shards_path)
+            else:
+                results = merge_shards(shards_path, args.N)
+            print(results["artists"])
+            print(results["albums"])
+            if "popular_artist_cnt" in results:
+                results["popular_artist_cnt"].to_csv(os.path.join(shards_path, "popular_artist_cnt.csv"))
@@ -0,0 +1,275 @@
+'''
+A handle to the core numeric arrays of the dataset in shared memory, so that
+worker processes can use them without each receiving a pickled copy of the
+dataframes.
+
+The parent creates the handle, e.g. with share_pre_processed_data, and passes
+the small picklable `handle.spec` to the workers, which attach to the same
+memory by name without copying:
+
+    with share_pre_processed_data("../data/") as dataset:
+        with ProcessPoolExecutor(initializer=attach_worker_dataset,
+                                 initargs=(dataset.spec,)) as executor:
+            ...
+
+and inside the workers `get_worker_dataset()["pids"]` is a NumPy view of the
+shared memory. `read_pre_processed_data(data_path, shared=get_worker_dataset())`
+builds the tracks and relations dataframes over the shared arrays without
+reading any file. Only the small lookups of the artist and album URIs and
+names are copied to every worker, with the spec. The arrays can also be kept
+in memory mapped .npy files in a directory instead, which works across
+processes that do not share a parent.
+'''
+from multiprocessing import shared_memory
+import os
+
+import numpy as np
+import pandas as pd
+
+from pre_processing import (read_pre_processed_table, MULTIPLICITY_COLUMN, TRACKS_DF_FILENAME,
+                            PLAYLIST_TRACKS_DF_FILENAME)
+from profiling import stage
+
+SHARED_BACKENDS = ("shm", "mmap")
+
+_worker_dataset = None
+
+
+class SharedDataset:
+    '''Named NumPy arrays backed by shared memory or memory mapped files.'''
+
+    def __init__(self, arrays, spec, segments=(), owner=False):
+        '''Use SharedDataset.create or SharedDataset.attach instead.
+
+        Args:
+            arrays (dict): Maps names to the shared arrays.
+            spec (dict): The picklable description to attach with.
+            segments (tuple): The SharedMemory blocks backing the arrays.
+            owner (bool): Whether this handle created the memory and should
+                free it.
+        '''
+        self._arrays = arrays
+        self.spec = spec
+        # small object arrays that cannot be shared, copied with the spec
+        self.lookups = spec.get("lookups", {})
+        self._segments = segments
+        self._owner = owner
+
+    @classmethod
+    def create(cls, arrays, backend="shm", directory=None, lookups=None):
+        """Copy arrays into shared memory.
+
+        Args:
+            arrays (dict): Maps names to NumPy arrays.
+            backend (str): One of SHARED_BACKENDS.
+            directory (str): The directory of the .npy files for the "mmap"
+                backend.
+            lookups (dict): Maps names to small object arrays, which are
+                pickled with the spec instead of shared.
+
+        Returns:
+            SharedDataset: The owning handle.
+        """
+        assert isinstance(arrays, dict)
+        assert backend in SHARED_BACKENDS
+        shared, layout, segments = {}, {}, []
+        if backend == "mmap":
+            assert isinstance(directory, str)
+            os.makedirs(directory, exist_ok=True)
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            if backend == "shm":
+                segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                segments.append(segment)
+                view = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)
+                layout[name] = (segment.name, array.dtype.str, array.shape)
+            else:
+                filename = os.path.join(directory, f"{name}.npy")
+                view = np.lib.format.open_memmap(filename, mode="w+", dtype=array.dtype,
+                                                 shape=array.shape)
+                layout[name] = (filename, array.dtype.str, array.shape)
+            view[...] = array
+            shared[name] = view
+        spec = {"backend": backend, "arrays": layout, "lookups": dict(lookups or {})}
+        return cls(shared, spec, tuple(segments), owner=True)
+
+    @classmethod
+    def attach(cls, spec):
+        """Attach to arrays created by another process, without copying.
+
+        Args:
+            spec (dict): The spec of the creating handle.
+
+        Returns:
+            SharedDataset: A non-owning handle.
+        """
+        arrays, segments = {}, []
+        for name, (location, dtype, shape) in spec["arrays"].items():
+            if spec["backend"] == "shm":
+                # pool workers share the resource tracker of the creating
+                # process, so attaching does not make them unlink the memory
+                segment = shared_memory.SharedMemory(name=location)
+                segments.append(segment)
+                arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+            else:
+                arrays[name] = np.load(location, mmap_mode="r")
+        return cls(arrays, spec, tuple(segments), owner=False)
+
+    def __getitem__(self, name):
+        return self._arrays[name]
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def keys(self):
+        return self._arrays.keys()
+
+    @property
+    def nbytes(self):
+        """The size of the shared arrays in bytes."""
+        return sum(array.nbytes for array in self._arrays.values())
+
+    def close(self):
+        """Detach from the arrays, and free them if this handle owns them."""
+        self._arrays = {}
+        for segment in self._segments:
+            segment.close()
+            if self._owner:
+                segment.unlink()
+        self._segments = ()
+        if self._owner and self.spec["backend"] == "mmap":
+            for filename, _, _ in self.spec["arrays"].values():
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def dataset_arrays(tracks_df, playlist_tracks_df, feature_matrix=None):
+    """Get the core numeric arrays of the dataset.
+
+    Args:
+        tracks_df (DataFrame): A DataFrame of the unique tracks data.
+        playlist_tracks_df (DataFrame): A DataFrame of the playlist and track id
+            associations.
+        feature_matrix (array): Audio features indexed by track id, e.g. from
+            audio_comparison.load_audio_feature_store.
+
+    Returns:
+        A tuple of two dicts. The first holds the shareable arrays:
+        "track_ids" and "pids" of the playlist/track relations, their
+        "multiplicity" if they were deduplicated, and
+        "durations", "artist_codes" and "album_codes" indexed by track id,
+        plus "features" if a feature matrix was given. A code numbers a
+        (uri, name) pair and indexes into the "artist_uris" and
+        "artist_names" (or "album_uris" and "album_names") object arrays of
+        the second dict, which cannot be shared.
+    """
+    assert isinstance(tracks_df, pd.DataFrame)
+    assert isinstance(playlist_tracks_df, pd.DataFrame)
+    track_ids = tracks_df["track_id"].to_numpy(dtype=np.int64)
+    n_tracks = int(track_ids.max()) + 1 if len(track_ids) else 0
+
+    arrays = {
+        "track_ids": playlist_tracks_df["track_id"].to_numpy(dtype=np.int32),
+        "pids": playlist_tracks_df["pid"].to_numpy(dtype=np.int32),
+    }
+    if MULTIPLICITY_COLUMN in playlist_tracks_df:
+        arrays[MULTIPLICITY_COLUMN] = playlist_tracks_df[MULTIPLICITY_COLUMN].to_numpy(dtype=np.int32)
+    durations = np.zeros(n_tracks, dtype=np.int32)
+    durations[track_ids] = tracks_df["duration_s"].to_numpy()
+    arrays["durations"] = durations
+    lookups = {}
+    for kind in ("artist", "album"):
+        columns = [f"{kind}_uri", f"{kind}_name"]
+        # number the pairs in order of first appearance, like drop_duplicates keeps them
+        codes = tracks_df.groupby(columns, sort=False).ngroup().fillna(-1).to_numpy(dtype=np.int32)
+        keys = tracks_df.loc[codes >= 0, columns].drop_duplicates()
+        by_track_id = np.full(n_tracks, -1, dtype=np.int32)
+        by_track_id[track_ids] = codes
+        arrays[f"{kind}_codes"] = by_track_id
+        lookups[f"{kind}_uris"] = keys[columns[0]].to_numpy(dtype=object)
+        lookups[f"{kind}_names"] = keys[columns[1]].to_numpy(dtype=object)
+    if feature_matrix is not None:
+        arrays["features"] = np.asarray(feature_matrix, dtype=np.float32)
+    return arrays, lookups
+
+
+def share_pre_processed_data(data_path, feature_matrix=None, backend="shm",
+                             directory=None):
+    """Read the pre-processed MPD data and put its numeric arrays in shared
+    memory.
+
+    Args:
+        data_path (str): A path to the directory that contains the pre-processed
+            MPD data CSVs.
+        feature_matrix (array): Audio features indexed by track id.
+        backend (str): One of SHARED_BACKENDS.
+        directory (str): The directory of the .npy files for the "mmap"
+            backend, defaults to a "shared" directory inside data_path.
+
+    Returns:
+        SharedDataset: The owning handle, with the artist and album URI and
+            name lookups of dataset_arrays in its lookups.
+    """
+    tracks_df = read_pre_processed_table(data_path, TRACKS_DF_FILENAME)
+    playlist_tracks_df = read_pre_processed_table(data_path, PLAYLIST_TRACKS_DF_FILENAME)
+    arrays, lookups = dataset_arrays(tracks_df, playlist_tracks_df, feature_matrix)
+    del tracks_df, playlist_tracks_df
+    if backend == "mmap" and directory is None:
+        directory = os.path.join(data_path, "shared")
+    with stage("share"):
+        return SharedDataset.create(arrays, backend, directory, lookups)
+
+
+def shared_frames(dataset):
+    """Build the tracks and relations dataframes over a shared dataset.
+
+    The numeric columns are views of the shared int32 arrays. The URI and
+    name columns only hold references to the strings of the lookups.
+
+    Args:
+        dataset (SharedDataset): A handle from share_pre_processed_data, or
+            attached to one.
+
+    Returns:
+        A tuple of the tracks data, with the track_id, duration_s, artist and
+        album uri and name columns, and the playlist/track relations.
+    """
+    durations = dataset["durations"]
+    tracks = {"track_id": np.arange(len(durations)), "duration_s": durations}
+    for kind in ("artist", "album"):
+        codes = dataset[f"{kind}_codes"]
+        for field in ("uri", "name"):
+            # code -1 takes the None appended last
+            values = np.append(np.asarray(dataset.lookups[f"{kind}_{field}s"], dtype=object), None)
+            tracks[f"{kind}_{field}"] = values[codes]
+    relations = {"track_id": dataset["track_ids"], "pid": dataset["pids"]}
+    if MULTIPLICITY_COLUMN in dataset:
+        relations[MULTIPLICITY_COLUMN] = dataset[MULTIPLICITY_COLUMN]
+    return pd.DataFrame(tracks, copy=False), pd.DataFrame(relations, copy=False)
+
+
+def attach_worker_dataset(spec):
+    """Attach this worker process to a shared dataset, for use as a pool
+    initializer.
+
+    Args:
+        spec (dict): The spec of the creating handle.
+    """
+    global _worker_dataset
+    _worker_dataset = SharedDataset.attach(spec)
+
+
+def get_worker_dataset():
+    """Get the dataset attached with attach_worker_dataset.
+
+    Returns:
+        SharedDataset: The attached handle.
+    """
+    assert _worker_dataset is not None, "attach_worker_dataset was not called"
+    return _worker_dataset
@@ -1,19 +1,34 @@
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
+from functools import lru_cache
 import os
 from dotenv import load_dotenv
 
 
-def get_spotipy_client(client_id=None, client_secret=None):
+@lru_cache(maxsize=None)
+def get_spotipy_client(client_id=None, client_secret=None, prefix=None, token=None):
     """Get the spotipy client to access the Spotify API with.
 
+    The clients are cached, so the credentials are only loaded and the
+    session only created once per set of arguments.
+
     Args:
         client_id (str): The client id to connect to the Spotify API with.
         client_secret (str): The client secret to connect to the Spotify API with.
+        prefix (str): The base URL of the API, e.g. "http://localhost:8000/v1/"
+            for a local mock server, the Spotify API if None.
+        token (str): An access token to send instead of authenticating with
+            the client credentials, e.g. for a mock server.
 
     Returns:
         A spotipy client.
     """
+    if token is not None:
+        sp = spotipy.Spotify(auth=token)
+        if prefix is not None:
+            sp.prefix = prefix
+        return sp
+
     if client_id is None and client_secret is None:
         # load credentials from the .env file
         assert load_dotenv(), "no enviromental variables found!"
@@ -25,6 +40,8 @@ def get_spotipy_client(client_id=None, client_secret=None):
         client_id=client_id,
         client_secret=client_secret
     ))
+    if prefix is not None:
+        sp.prefix = prefix
     return sp
 
 
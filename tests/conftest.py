@@ -0,0 +1,47 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+def make_slice(first_pid, n_playlists, seed=0, n_tracks=60, n_artists=12):
+    """Build a synthetic MPD slice. Tracks repeat within playlists and
+    several tracks share an artist and an album."""
+    rng = np.random.default_rng(seed)
+    playlists = []
+    for pid in range(first_pid, first_pid + n_playlists):
+        ids = rng.integers(0, n_tracks, rng.integers(1, 15))
+        tracks = []
+        for pos, i in enumerate(ids.tolist()):
+            artist, album = i % n_artists, i % (2 * n_artists)
+            tracks.append({"pos": pos, "artist_name": f"Artist {artist}", "track_uri": f"spotify:track:{i:022d}",
+                           "artist_uri": f"spotify:artist:{artist:022d}", "track_name": f"song {i % 40}",
+                           "album_uri": f"spotify:album:{album:022d}", "duration_ms": 120000 + 1000 * (i % 7),
+                           "album_name": f"Album {album}"})
+        playlists.append({"name": f"mix {pid % 5}", "collaborative": "true" if pid % 3 == 0 else "false",
+                          "pid": pid, "modified_at": 1400000000 + 86400 * 30 * (pid % 6),
+                          "num_tracks": len(tracks), "num_albums": 1, "num_followers": int(pid % 7),
+                          "num_edits": 1, "duration_ms": sum(t["duration_ms"] for t in tracks),
+                          "num_artists": 1, "tracks": tracks})
+    return {"info": {"slice": f"{first_pid}-{first_pid + n_playlists - 1}", "version": "v1"},
+            "playlists": playlists}
+
+
+def write_slice(path, mpd_slice, name=None):
+    os.makedirs(path, exist_ok=True)
+    name = name or f"mpd.slice.{mpd_slice['info']['slice']}.json"
+    with open(os.path.join(path, name), "w") as f:
+        json.dump(mpd_slice, f)
+
+
+@pytest.fixture
+def mpd_path(tmp_path):
+    """A directory of four synthetic slices of 50 playlists."""
+    path = str(tmp_path / "mpd")
+    for i in range(4):
+        write_slice(path, make_slice(50 * i, 50, seed=i))
+    return path
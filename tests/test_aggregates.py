@@ -0,0 +1,26 @@
+import os
+
+from aggregates import AggregateState, TABLE_FILENAMES, fold_new_slices
+from conftest import make_slice, write_slice
+
+
+def test_save_drops_rows_of_interrupted_save(tmp_path):
+    mpd = str(tmp_path / "mpd")
+    write_slice(mpd, make_slice(0, 50, seed=0))
+    fold_new_slices(mpd, str(tmp_path / "state"))
+    # rows appended by a save that stopped before writing state.json
+    for filename in TABLE_FILENAMES.values():
+        with open(tmp_path / "state" / filename, "a") as f:
+            f.write("spotify:orphan,orphan,1,1,1\n")
+    write_slice(mpd, make_slice(50, 50, seed=1, n_tracks=120, n_artists=30))
+    state = fold_new_slices(mpd, str(tmp_path / "state"))
+    reference = fold_new_slices(mpd, str(tmp_path / "reference"))
+
+    for filename in TABLE_FILENAMES.values():
+        with open(tmp_path / "state" / filename) as f, open(tmp_path / "reference" / filename) as g:
+            assert f.read() == g.read()
+    loaded = AggregateState.load(str(tmp_path / "state"))
+    assert len(loaded.tracks) == len(state.tracks) == len(reference.tracks)
+    assert loaded.most_common_artists(5).equals(reference.most_common_artists(5))
+    assert len(loaded.playlist_stats()) == 100
+    assert not os.path.isfile(tmp_path / "state" / "counts-1.npz")
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from compact_features import CompactFeatures
+
+
+def test_id_lookups():
+    rng = np.random.default_rng(0)
+    ids = [f"T{i:021d}" for i in rng.permutation(50)] + ["T000000000000000000007"]
+    df = pd.DataFrame({"id": ids, "energy": rng.random(51), "tempo": rng.random(51)})
+    features = CompactFeatures.from_frame(df)
+
+    first_row = {spotify_id: row for row, spotify_id in reversed(list(enumerate(ids)))}
+    queries = ids + ["unknown", "T0000000000000000000070", ""]
+    expected = [first_row.get(spotify_id, -1) for spotify_id in queries]
+    assert features.rows(queries).tolist() == expected
+    assert features.row(ids[3]) == 3
+    assert features.row("T000000000000000000007") == ids.index("T000000000000000000007")
+    assert features.rows([]).tolist() == []
+    with pytest.raises(KeyError):
+        features.row("unknown")
+    # the lookup order is counted in the memory
+    assert features.nbytes == features.codes.nbytes + features.ids.nbytes + 4 * len(ids)
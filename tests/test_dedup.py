@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import analysis
+from audio_comparison import track_popularity
+from embeddings import interaction_matrix
+from pre_processing import MULTIPLICITY_COLUMN, pre_process_dataset, read_pre_processed_data
+
+
+@pytest.fixture
+def relations(mpd_path, tmp_path):
+    """The tracks and the raw and deduplicated relations of the same slices."""
+    pre_process_dataset(mpd_path, str(tmp_path / "raw"))
+    pre_process_dataset(mpd_path, str(tmp_path / "dedup"), dedup=True)
+    _, tracks_df, raw = read_pre_processed_data(str(tmp_path / "raw"))
+    _, dedup_tracks_df, dedup = read_pre_processed_data(str(tmp_path / "dedup"))
+    pd.testing.assert_frame_equal(tracks_df, dedup_tracks_df)
+    assert MULTIPLICITY_COLUMN in dedup and len(dedup) < len(raw)
+    return tracks_df, raw, dedup
+
+
+@pytest.mark.parametrize("function, kwargs", [
+    (analysis.get_most_common_tracks, {"n": 10}),
+    (analysis.get_most_common_tracks, {"n": 10, "distinct": True}),
+    (analysis.get_most_common_artists, {"n": 10}),
+    (analysis.get_most_common_artists, {"n": 10, "ascending": True}),
+    (analysis.get_most_common_albums, {"n": 10}),
+    (analysis.get_largest_albums, {"n": 10}),
+    (analysis.get_most_prolific_artists, {"n": 10}),
+    (analysis.get_unique_track_features, {}),
+    (analysis.get_track_durations_stdev_distribution, {}),
+    (analysis.get_artist_diversity_distribution, {}),
+    (analysis.get_most_popular_one_hit_wonder, {"n": 10}),
+    (analysis.get_popular_artist_cnt, {"n": 5}),
+])
+def test_analysis_equal_on_dedup(relations, function, kwargs):
+    tracks_df, raw, dedup = relations
+    expected, result = function(tracks_df, raw, **kwargs), function(tracks_df, dedup, **kwargs)
+    if isinstance(expected, pd.DataFrame):
+        pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True),
+                                      check_dtype=False)
+    else:
+        pd.testing.assert_series_equal(result, expected, check_dtype=False)
+
+
+def test_counts_equal_on_dedup(relations):
+    tracks_df, raw, dedup = relations
+    np.testing.assert_array_equal(track_popularity(dedup, len(tracks_df)), track_popularity(raw, len(tracks_df)))
+    expected = interaction_matrix(raw, n_tracks=len(tracks_df))
+    result = interaction_matrix(dedup, n_tracks=len(tracks_df))
+    assert expected.max() > 1
+    np.testing.assert_array_equal(result.toarray(), expected.toarray())
@@ -0,0 +1,91 @@
+import threading
+
+import pandas as pd
+import spotipy
+
+from enrichment import BATCH_SIZES, MetadataStore, enrich
+
+
+class StubClient:
+    '''Answers artists() and albums() like spotipy, without a network.'''
+
+    def __init__(self, known, failing=()):
+        self.known = set(known)
+        # URIs whose batch fails once, like a transient API error
+        self.failing = set(failing)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def _fetch(self, uris, uri_type):
+        with self.lock:
+            self.requests.append((uri_type, list(uris)))
+            failing = self.failing.intersection(uris)
+            self.failing -= failing
+        if failing:
+            raise spotipy.exceptions.SpotifyException(503, -1, "unavailable")
+        return {uri_type + "s": [{"name": uri.upper(), "popularity": 1, "followers": {"total": 7},
+                                  "genres": ["rock"], "album_type": "album"}
+                                 if uri in self.known else None for uri in uris]}
+
+    def artists(self, uris):
+        return self._fetch(uris, "artist")
+
+    def albums(self, uris):
+        return self._fetch(uris, "album")
+
+
+def tracks(n):
+    return pd.DataFrame({"artist_uri": [f"spotify:artist:{i % n}" for i in range(2 * n)],
+                         "album_uri": [f"spotify:album:{i}" for i in range(2 * n)]})
+
+
+def test_enrich_batches(tmp_path):
+    tracks_df = tracks(120)
+    uris = [f"spotify:artist:{i}" for i in range(120)]
+    sp = StubClient(uris[:-3])
+    stats = enrich(tracks_df, "artist", MetadataStore(str(tmp_path), "artist"), sp, workers=2)
+    assert stats == {"fetched": 120, "skipped": 0, "failed": 0}
+    # every URI is requested once, in batches of at most 50
+    assert sorted(len(batch) for _, batch in sp.requests) == [20, 50, 50]
+    assert sorted(uri for _, batch in sp.requests for uri in batch) == sorted(uris)
+
+    metadata = MetadataStore(str(tmp_path), "artist").to_frame().set_index("uri")
+    assert len(metadata) == 120
+    # the unknown URIs are stored as not found, so they are not retried
+    assert metadata.index[~metadata["found"].astype(bool)].tolist() == uris[-3:]
+    assert metadata.loc[uris[0], "followers"] == 7
+    assert metadata.loc[uris[0], "name"] == uris[0].upper()
+
+    album_sp = StubClient([])
+    stats = enrich(tracks_df, "album", MetadataStore(str(tmp_path), "album"), album_sp, workers=2)
+    assert stats["fetched"] == 240
+    assert max(len(batch) for _, batch in album_sp.requests) == BATCH_SIZES["album"]
+
+
+def test_enrich_resumes(tmp_path):
+    tracks_df = tracks(120)
+    uris = [f"spotify:artist:{i}" for i in range(120)]
+    # the batch of the 60th artist fails on the first run
+    sp = StubClient(uris, failing=[uris[60]])
+    stats = enrich(tracks_df, "artist", MetadataStore(str(tmp_path), "artist"), sp, workers=2)
+    assert stats == {"fetched": 70, "skipped": 0, "failed": 50}
+
+    # a cut off write of an interrupted run is skipped
+    with open(tmp_path / "artists.jsonl", "a") as f:
+        f.write('{"uri": "spotify:artist:1')
+    sp.requests.clear()
+    store = MetadataStore(str(tmp_path), "artist")
+    assert len(store) == 70
+    stats = enrich(tracks_df, "artist", store, sp, workers=2)
+    assert stats == {"fetched": 50, "skipped": 70, "failed": 0}
+    assert sorted(uri for _, batch in sp.requests for uri in batch) == sorted(uris[50:100])
+
+    metadata = MetadataStore(str(tmp_path), "artist").to_frame()
+    assert sorted(metadata["uri"]) == sorted(uris)
+    assert metadata["found"].all()
+
+    # nothing is left to fetch
+    sp.requests.clear()
+    stats = enrich(tracks_df, "artist", MetadataStore(str(tmp_path), "artist"), sp, workers=2)
+    assert stats == {"fetched": 0, "skipped": 120, "failed": 0}
+    assert sp.requests == []
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from graph_clustering import cooccurrence_matrix
+
+
+@pytest.mark.parametrize("chunksize, merge_blocks", [(1, None), (1, 3), (7, 1), (1000, None)])
+@pytest.mark.parametrize("min_count", [1, 2, 3])
+def test_cooccurrence_matrix(chunksize, merge_blocks, min_count):
+    rng = np.random.default_rng(0)
+    pids = rng.integers(0, 40, 400)
+    nodes = rng.integers(0, 30, 400)
+    incidence = np.zeros((40, 30))
+    incidence[pids, nodes] = 1
+    expected = incidence.T @ incidence
+    np.fill_diagonal(expected, 0)
+    expected[expected < min_count] = 0
+
+    adjacency = cooccurrence_matrix(pids, nodes, 30, min_count, chunksize, workers=1, merge_blocks=merge_blocks)
+    np.testing.assert_array_equal(adjacency.toarray(), expected)
+    assert (adjacency.data >= min_count).all()
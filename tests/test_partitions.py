@@ -0,0 +1,43 @@
+import os
+
+import pandas as pd
+import pytest
+
+from partitions import PARTITIONS_DIRNAME, months_in_range, partition_pre_processed_data, read_time_range
+from pre_processing import pre_process_dataset, read_pre_processed_data
+
+
+def check_time_range(data_path, start, end):
+    playlists_df, _, playlist_tracks_df = read_pre_processed_data(data_path)
+    selected = pd.Series(True, index=playlists_df.index)
+    if start is not None:
+        selected &= playlists_df["modified_at"] >= pd.Timestamp(start, tz="UTC").timestamp()
+    if end is not None:
+        selected &= playlists_df["modified_at"] < pd.Timestamp(end, tz="UTC").timestamp()
+    expected_playlists = playlists_df[selected]
+    expected_relations = playlist_tracks_df[playlist_tracks_df["pid"].isin(expected_playlists["pid"])]
+
+    playlists, _, relations = read_time_range(data_path, start, end)
+    sort = ["pid", "track_id"]
+    pd.testing.assert_frame_equal(playlists.sort_values("pid").reset_index(drop=True),
+                                  expected_playlists.sort_values("pid").reset_index(drop=True))
+    pd.testing.assert_frame_equal(relations.sort_values(sort, kind="stable").reset_index(drop=True),
+                                  expected_relations.sort_values(sort, kind="stable").reset_index(drop=True))
+
+
+@pytest.mark.parametrize("dedup", [False, True])
+def test_partitions(mpd_path, tmp_path, dedup):
+    data_path = str(tmp_path / "data")
+    pre_process_dataset(mpd_path, data_path, partition=True, dedup=dedup)
+    for start, end in ((None, None), ("2014-06-01", "2014-09-01"), ("2014-07-15", None)):
+        check_time_range(data_path, start, end)
+
+    # a month written by an earlier run is removed when partitioning again
+    stale = os.path.join(data_path, PARTITIONS_DIRNAME, "1999-01")
+    os.makedirs(stale)
+    partition_pre_processed_data(data_path, compression="gzip")
+    assert not os.path.exists(stale)
+    months = months_in_range(data_path)
+    assert months and all(os.path.isfile(os.path.join(data_path, PARTITIONS_DIRNAME, month, "playlist_tracks_df.csv.gz"))
+                          for month in months)
+    check_time_range(data_path, None, None)
@@ -0,0 +1,33 @@
+import pandas as pd
+import pytest
+
+from playlist_filters import parse_filter, pid_bitmap
+
+PLAYLISTS = pd.DataFrame({
+    "pid": [0, 1, 2, 3],
+    "name": ["Rock and Roll", "rock", "Roll and Rock", "1999"],
+    "num_followers": [5, 20, 30, 1],
+    "collaborative": ["false", "true", "false", "false"],
+})
+
+
+@pytest.mark.parametrize("text, pids", [
+    ("num_followers > 10", [1, 2]),
+    ("name contains rock and roll", [0]),
+    ("name contains 'rock and roll'", [0]),
+    ('name contains "rock and roll" and num_followers < 10', [0]),
+    ("name contains rock and roll and num_followers>=5", [0]),
+    ("name contains rock and num_followers > 10", [1, 2]),
+    ("collaborative == false and name contains roll", [0, 2]),
+    ("name == '1999'", [3]),
+    ("num_followers != 1 and num_followers <= 20.5", [0, 1]),
+])
+def test_parse_filter(text, pids):
+    bitmap = pid_bitmap(PLAYLISTS, parse_filter(text))
+    assert bitmap.nonzero()[0].tolist() == pids
+
+
+@pytest.mark.parametrize("text", ["", "name", "name contains", "> 10"])
+def test_parse_filter_invalid(text):
+    with pytest.raises(ValueError):
+        parse_filter(text)
@@ -0,0 +1,19 @@
+from conftest import make_slice, write_slice
+from playlist_search import load_playlist_search_index
+from pre_processing import pre_process_dataset
+
+
+def test_index_rebuilt_when_playlists_change(mpd_path, tmp_path):
+    data_path = str(tmp_path / "data")
+    pre_process_dataset(mpd_path, data_path)
+    index = load_playlist_search_index(data_path)
+    assert len(index) == 200
+    assert load_playlist_search_index(data_path).source == index.source
+
+    # pre-processing another dataset into the same directory makes the saved index stale
+    other_path = str(tmp_path / "other")
+    write_slice(other_path, make_slice(1000, 30, seed=1))
+    pre_process_dataset(other_path, data_path)
+    index = load_playlist_search_index(data_path)
+    assert sorted(index.pids.tolist()) == list(range(1000, 1030))
+    assert index.resolve("mix 2") in range(1000, 1030)
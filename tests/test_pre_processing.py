@@ -0,0 +1,44 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import make_slice, write_slice
+from pre_processing import pre_process_dataset, read_pre_processed_data, playlist_track_ids
+
+
+def check_playlist_tracks(data_path):
+    playlists_df, _, playlist_tracks_df = read_pre_processed_data(data_path)
+    track_ids, lengths = playlist_track_ids(playlists_df)
+    assert (lengths == playlists_df["num_tracks"].to_numpy()).all()
+    expected = pd.DataFrame({"track_id": track_ids, "pid": np.repeat(playlists_df["pid"].to_numpy(), lengths)})
+    pd.testing.assert_frame_equal(playlist_tracks_df, expected)
+    return playlists_df
+
+
+@pytest.mark.parametrize("invalid", [False, True])
+def test_slice_without_playlists(tmp_path, invalid):
+    path = str(tmp_path / "mpd")
+    for first_pid in (0, 100, 150):
+        write_slice(path, make_slice(first_pid, 50, seed=first_pid))
+    empty = make_slice(50, 50 if invalid else 0)
+    for playlist in empty["playlists"]:
+        # every playlist fails validation
+        playlist["num_tracks"] = "many"
+    write_slice(path, empty, "mpd.slice.50-99.json")
+
+    report = pre_process_dataset(path, str(tmp_path / "out"), validation="full")
+    playlists_df = check_playlist_tracks(str(tmp_path / "out"))
+    assert len(playlists_df) == 150
+    assert not playlists_df["pid"].between(50, 99).any()
+    assert bool(report["errors"]) == invalid
+
+
+def test_missing_codec_fails_before_writing(mpd_path, tmp_path, monkeypatch):
+    # a None entry makes the import fail as if the package were not installed
+    monkeypatch.setitem(sys.modules, "zstandard", None)
+    with pytest.raises(ImportError, match="zstandard"):
+        pre_process_dataset(mpd_path, str(tmp_path / "data"), compression="zstd")
+    assert not os.path.exists(tmp_path / "data")
@@ -0,0 +1,34 @@
+import os
+import subprocess
+import sys
+
+import profiling
+
+
+def test_profiling_without_resource(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, "resource", None)
+    profiler = profiling.enable_profiling("test", str(tmp_path))
+    try:
+        with profiling.stage("load"):
+            data = [0] * 100000
+        del data
+    finally:
+        profiling.disable_profiling()
+    record = profiler.stages["load"]
+    assert record["calls"] == 1
+    assert record["max_rss_mb"] > 0
+    assert (tmp_path / "test_profile.json").is_file()
+
+
+def test_process_uptime_counts_the_startup_before_the_import():
+    # the time spent before profiling is imported is part of the startup
+    check = ("import time\n"
+             "time.sleep(0.3)\n"
+             f"import sys; sys.path.insert(0, {os.path.dirname(profiling.__file__)!r})\n"
+             "from profiling import process_uptime\n"
+             "print(process_uptime())\n")
+    result = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True, check=True)
+    uptime = float(result.stdout)
+    if os.path.exists("/proc/self/stat"):
+        assert uptime >= 0.25
+    assert uptime < 60
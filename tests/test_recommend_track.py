@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from compact_features import CompactFeatures
+from conftest import make_slice, write_slice
+from indexes import build_index, spotify_ids
+from pre_processing import pre_process_dataset, read_pre_processed_table, TRACKS_DF_FILENAME
+from recommend_track import next_song_from_playlist
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+HEAVY_MODULES = ("matplotlib", "seaborn", "sklearn", "spotipy")
+
+IDS = {name: f"T{i:021d}" for i, name in enumerate("XACBD")}
+FEATURES = {"X": (1.0, 0.0), "A": (1.0, 0.1), "C": (1.0, 0.5), "B": (0.0, 1.0), "D": (0.5, 0.5)}
+ARTISTS = {"X": "a1", "A": "a2", "C": "a2", "B": "a3", "D": "a4"}
+
+
+def frames():
+    tracks_df = pd.DataFrame({"track_id": range(5), "id": [IDS[name] for name in "XACBD"],
+                              "track_name": list("XACBD"),
+                              "artist_uri": [ARTISTS[name] for name in "XACBD"],
+                              "album_uri": [f"al{i}" for i in range(5)]})
+    # the cluster table is in another order than the playlist and has a
+    # track that is not in the playlist
+    cluster_tracks_df = pd.DataFrame([(IDS[name], *FEATURES[name]) for name in "DBXCA"],
+                                     columns=["id", "danceability", "energy"]).assign(cluster=0)
+    playlist = pd.DataFrame([(IDS[name], name, *FEATURES[name]) for name in "BCAX"],
+                            columns=["id", "track_name", "danceability", "energy"])
+    return tracks_df, cluster_tracks_df, playlist
+
+
+@pytest.mark.parametrize("source", ["scan", "index", "compact"])
+@pytest.mark.parametrize("diversity, expected", [
+    (None, {"X", "A", "C"}),
+    ({"lambda_": 1.0, "max_per_artist": 1}, {"X", "A", "B"}),
+])
+def test_next_song_from_playlist(source, diversity, expected):
+    tracks_df, cluster_tracks_df, playlist = frames()
+    index = build_index(tracks_df, None, cluster_tracks_df) if source != "scan" else None
+    features = CompactFeatures.from_frame(cluster_tracks_df, dtype="float16") if source == "compact" else cluster_tracks_df
+    recommended = next_song_from_playlist(tracks_df, features, playlist, IDS["X"], N=3, index=index,
+                                          diversity=diversity)
+    assert set(recommended["track_name"]) == expected
+
+
+
+def test_cluster_cli_skips_heavy_imports(tmp_path):
+    # real track ids are base62, digit only ids would be read back as numbers from the cluster CSV
+    mpd_slice = make_slice(0, 20)
+    for playlist in mpd_slice["playlists"]:
+        for track in playlist["tracks"]:
+            track["track_uri"] = track["track_uri"].replace(":0", ":a", 1)
+    write_slice(str(tmp_path / "mpd"), mpd_slice)
+    data_path = str(tmp_path / "data")
+    pre_process_dataset(str(tmp_path / "mpd"), data_path)
+    ids = spotify_ids(read_pre_processed_table(data_path, TRACKS_DF_FILENAME)["track_uri"])
+    pd.DataFrame({"id": ids, "danceability": np.linspace(0, 1, len(ids)), "cluster": np.arange(len(ids)) % 3}
+                 ).to_csv(os.path.join(data_path, "tracks_cluster.csv"), index=False)
+    (tmp_path / "work").mkdir()
+
+    # the script reads ../data/tracks_cluster.csv, list the heavy modules it imported as __main__
+    script = os.path.join(SRC_PATH, "recommend_track.py")
+    check = (f"import runpy, sys\n"
+             f"sys.path.insert(0, {SRC_PATH!r})\n"
+             f"sys.argv = [{script!r}, {ids[0]!r}, '--N', '3', '--dir', '../data/']\n"
+             f"runpy.run_path({script!r}, run_name='__main__')\n"
+             f"print(sorted(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n")
+    result = subprocess.run([sys.executable, "-c", check], cwd=tmp_path / "work",
+                            capture_output=True, text=True, check=True)
+    assert "Recommended songs for" in result.stdout
+    assert result.stdout.strip().splitlines()[-1] == "[]"
@@ -0,0 +1,47 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from indexes import build_index
+from recommend_track import get_recommendation_from_cluster
+from recommendation_cache import RecommendationCache
+
+
+def test_cluster_recommendations_are_cached(tmp_path):
+    ids = [f"T{i:021d}" for i in range(40)]
+    tracks_df = pd.DataFrame({"track_id": range(40), "id": ids, "track_name": [f"song {i}" for i in range(40)]})
+    cluster_tracks_df = pd.DataFrame({"id": ids[:30], "cluster": np.arange(30) % 3})
+    cluster_path = tmp_path / "tracks_cluster.csv"
+    cluster_tracks_df.to_csv(cluster_path, index=False)
+    index = build_index(tracks_df, None, cluster_tracks_df)
+    cache = RecommendationCache(artifacts=[str(cluster_path)])
+
+    first = get_recommendation_from_cluster(cluster_tracks_df, tracks_df, ids[0], 5, index, cache=cache)
+    again = get_recommendation_from_cluster(cluster_tracks_df, tracks_df, ids[0], 5, index, cache=cache)
+    pd.testing.assert_frame_equal(first, again)
+    assert len(first) == 5
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    get_recommendation_from_cluster(cluster_tracks_df, tracks_df, ids[0], 3, index, cache=cache)
+    assert len(cache) == 2
+
+    # a new cluster file drops the cached results
+    cluster_tracks_df.assign(cluster=10).to_csv(cluster_path, index=False)
+    get_recommendation_from_cluster(cluster_tracks_df, tracks_df, ids[0], 5, index, cache=cache)
+    assert cache.invalidations == 1 and len(cache) == 1
+
+
+def test_warm_recomputes_expired_results(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = RecommendationCache(ttl=10)
+    compute = lambda seed, N: pd.DataFrame({"track_name": [f"{seed}-{N}"]})
+    assert cache.warm("cluster", ["a", "b"], 5, compute) == 2
+    assert cache.warm("cluster", ["a", "b"], 5, compute) == 0
+
+    now[0] = 11.0
+    assert cache.warm("cluster", ["a"], 5, compute) == 1
+    assert cache.expirations == 1
+    assert cache.get(cache.key("cluster", "a", 5)) is not None
+    assert cache.get(cache.key("cluster", "b", 5)) is None
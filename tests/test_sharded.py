@@ -0,0 +1,30 @@
+import pandas as pd
+import pytest
+
+import analysis
+from pre_processing import pre_process_dataset, read_pre_processed_data
+from sharded import merge_shards, run_sharded
+
+
+@pytest.fixture
+def data_path(mpd_path, tmp_path):
+    path = str(tmp_path / "data")
+    pre_process_dataset(mpd_path, path)
+    return path
+
+
+@pytest.mark.parametrize("n_shards, workers", [(1, 1), (3, 2), (7, 2)])
+def test_sharded_matches_single_node(data_path, n_shards, workers):
+    _, tracks_df, playlist_tracks_df = read_pre_processed_data(data_path)
+    results = run_sharded(data_path, n_shards, n=5, popular_n=4, workers=workers)
+    pd.testing.assert_frame_equal(results["artists"],
+                                  analysis.get_most_common_artists(tracks_df, playlist_tracks_df, 5))
+    pd.testing.assert_frame_equal(results["albums"],
+                                  analysis.get_most_common_albums(tracks_df, playlist_tracks_df, 5))
+    pd.testing.assert_series_equal(results["popular_artist_cnt"],
+                                   analysis.get_popular_artist_cnt(tracks_df, playlist_tracks_df, 4))
+
+    # the merge step alone reads the same results from the shard files
+    merged = merge_shards(f"{data_path}/shards", 5)
+    pd.testing.assert_frame_equal(merged["artists"], results["artists"])
+    pd.testing.assert_series_equal(merged["popular_artist_cnt"], results["popular_artist_cnt"])
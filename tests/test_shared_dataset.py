@@ -0,0 +1,48 @@
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import os
+
+import pandas as pd
+import pytest
+
+import analysis
+from pre_processing import pre_process_dataset, read_pre_processed_data
+from shared_dataset import attach_worker_dataset, get_worker_dataset, share_pre_processed_data
+
+
+def _results(tracks_df, playlist_tracks_df):
+    return (analysis.get_most_common_artists(tracks_df, playlist_tracks_df, 5),
+            analysis.get_most_common_albums(tracks_df, playlist_tracks_df, 5, ascending=True),
+            analysis.get_popular_artist_cnt(tracks_df, playlist_tracks_df, 4),
+            analysis.get_track_durations_stdev_distribution(tracks_df, playlist_tracks_df),
+            analysis.get_artist_diversity_distribution(tracks_df, playlist_tracks_df))
+
+
+def _worker_results(data_path):
+    playlists_df, tracks_df, playlist_tracks_df = read_pre_processed_data(data_path, shared=get_worker_dataset())
+    assert playlists_df is None
+    return _results(tracks_df, playlist_tracks_df)
+
+
+@pytest.mark.parametrize("backend", ["shm", "mmap"])
+@pytest.mark.parametrize("dedup", [False, True])
+def test_workers_read_shared_data(mpd_path, tmp_path, backend, dedup):
+    data_path = str(tmp_path / "data")
+    pre_process_dataset(mpd_path, data_path, dedup=dedup)
+    _, tracks_df, playlist_tracks_df = read_pre_processed_data(data_path)
+    expected = _results(tracks_df, playlist_tracks_df)
+
+    with share_pre_processed_data(data_path, backend=backend) as dataset:
+        # the workers read nothing from the data directory
+        for filename in glob.glob(os.path.join(data_path, "*.csv")):
+            os.remove(filename)
+        with ProcessPoolExecutor(max_workers=2, initializer=attach_worker_dataset,
+                                 initargs=(dataset.spec,)) as executor:
+            results = list(executor.map(_worker_results, [data_path] * 2))
+    # the shared columns are int32
+    for result in results:
+        for frame, expected_frame in zip(result, expected):
+            if isinstance(frame, pd.DataFrame):
+                pd.testing.assert_frame_equal(frame, expected_frame, check_dtype=False)
+            else:
+                pd.testing.assert_series_equal(frame, expected_frame, check_dtype=False, check_index_type=False)